@@ -0,0 +1,120 @@
+"""
+Time-to-quality benchmark of the homogeneous diffusion solver (utils/homogeneous_diffusion.py).
+
+Every method is run with a growing budget until its reconstruction comes within --target dB PSNR of the converged
+solution of the Laplace equation, or until a run takes longer than --max-seconds:
+    jacobi   Jacobi sweeps, the textbook way of solving the diffusion
+    cg       conjugate gradients from the mean of the known pixels
+    pcg      conjugate gradients preconditioned with a multigrid V-cycle, from the mean of the known pixels
+    cascade  preconditioned conjugate gradients from the coarse-to-fine initial guess (the default of
+             reconstruct_with_diffusion)
+OpenCV's Telea inpainting, which the codec used before, is timed once for comparison.
+
+Usage: python3 benchmarks/bench_diffusion.py [images/image1.png] [--scale 1] [--target 40] [--q 4] [--d 3]
+                                             [--max-sweeps 4096] [--max-seconds 5]
+"""
+import argparse
+import os
+import sys
+import time
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from edge_batch import calculate_psnr
+from edge_codec import detect_edges
+from utils.contours import dequantize_pixel_values, encode_contour_pixel_values
+from utils.homogeneous_diffusion import reconstruct_with_inpaint, solve_laplace, solve_laplace_cg
+
+NEIGHBOURS = np.array([[0, 1, 0], [1, 0, 1], [0, 1, 0]], dtype=np.float32)
+
+
+def solve_laplace_jacobi(values, known, sweeps):
+    """
+    Jacobi iteration: every unknown pixel becomes the mean of its neighbours, all pixels at once.
+    """
+    degree = cv2.filter2D(np.ones(known.shape, dtype=np.float32), -1, NEIGHBOURS, borderType=cv2.BORDER_CONSTANT)
+    known = known[..., None]
+    u = np.where(known, values, values[known[..., 0]].mean(axis=0)).astype(np.float32)
+    for _ in range(sweeps):
+        neighbours = cv2.filter2D(u, -1, NEIGHBOURS, borderType=cv2.BORDER_CONSTANT) / degree[..., None]
+        u = np.where(known, u, neighbours)
+    return u
+
+
+def time_to_target(name, solve, budgets, reference, original, target, max_seconds):
+    """
+    Runs solve(budget) for growing budgets and prints every run, until the result is within target dB of reference
+    or a run takes longer than max_seconds.
+    """
+    for budget in budgets:
+        start = time.perf_counter()
+        u = np.clip(np.rint(solve(budget)), 0, 255)
+        seconds = time.perf_counter() - start
+        to_reference = calculate_psnr(reference, u)
+        print(f"{name:<8} {budget:>10g} {seconds:>9.3f} {to_reference:>14.2f} {calculate_psnr(original, u):>12.2f}")
+        if to_reference >= target:
+            return seconds
+        if seconds > max_seconds:
+            break
+    return None
+
+
+def main():
+    default_image = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "images", "image1.png")
+    parser = argparse.ArgumentParser(description="Homogeneous diffusion time-to-quality benchmark")
+    parser.add_argument("image", nargs="?", default=default_image, help="Image to reconstruct.")
+    parser.add_argument("--scale", type=float, default=1, help="Resize the image first, e.g. 2.5 for a megapixel.")
+    parser.add_argument("--target", type=float, default=40, help="PSNR to the converged solution, in dB.")
+    parser.add_argument("--q", type=int, default=4, help="Quantization parameter.")
+    parser.add_argument("--d", type=int, default=3, help="Subsampling distance.")
+    parser.add_argument("--max-sweeps", type=int, default=1 << 12, help="Largest number of Jacobi sweeps tried.")
+    parser.add_argument("--max-seconds", type=float, default=5,
+                        help="Give up on a method once a run takes longer than this (default: 5).")
+    args = parser.parse_args()
+
+    image = cv2.cvtColor(cv2.imread(args.image), cv2.COLOR_BGR2RGB)
+    if args.scale != 1:
+        image = cv2.resize(image, None, fx=args.scale, fy=args.scale, interpolation=cv2.INTER_CUBIC)
+    edges = detect_edges(image)
+    pixel_data = encode_contour_pixel_values(image, edges, args.q, args.d)
+    pixel_data[:, 2:] = dequantize_pixel_values(pixel_data[:, 2:], args.q)
+
+    known = np.zeros(edges.shape, dtype=bool)
+    known[pixel_data[:, 0], pixel_data[:, 1]] = True
+    values = np.zeros(image.shape, dtype=np.float32)
+    values[pixel_data[:, 0], pixel_data[:, 1]] = pixel_data[:, 2:]
+    print(f"{image.shape[1]}x{image.shape[0]} image, {known.mean():.1%} of the pixels known")
+
+    start = time.perf_counter()
+    reference = np.clip(np.rint(solve_laplace(values, known, tol=1e-7)), 0, 255)
+    print(f"Converged solution (tol 1e-7) in {time.perf_counter() - start:.2f}s")
+
+    print(f"{'method':<8} {'budget':>10} {'seconds':>9} {'dB converged':>14} {'dB original':>12}")
+    tolerances = [10 ** (-k / 2) for k in range(2, 15)]
+    results = {
+        "jacobi": time_to_target("jacobi", lambda sweeps: solve_laplace_jacobi(values, known, sweeps),
+                                 [1 << k for k in range(4, args.max_sweeps.bit_length())], reference, image,
+                                 args.target, args.max_seconds),
+        "cg": time_to_target("cg", lambda iterations: solve_laplace_cg(values, known, values[known].mean(axis=0),
+                                                                          tol=0, max_iter=iterations)[0],
+                             [1 << k for k in range(2, 16)], reference, image, args.target, args.max_seconds),
+        "pcg": time_to_target("pcg", lambda tol: solve_laplace(values, known, tol=tol, cascade=False), tolerances,
+                              reference, image, args.target, args.max_seconds),
+        "cascade": time_to_target("cascade", lambda tol: solve_laplace(values, known, tol=tol), tolerances,
+                                  reference, image, args.target, args.max_seconds),
+    }
+
+    start = time.perf_counter()
+    telea = cv2.cvtColor(reconstruct_with_inpaint(edges, pixel_data), cv2.COLOR_BGR2RGB)
+    print(f"telea: {time.perf_counter() - start:.3f}s, {calculate_psnr(image, telea):.2f} dB to the original, "
+          f"converged diffusion {calculate_psnr(image, reference):.2f} dB")
+
+    for name, seconds in results.items():
+        reached = f"{seconds:.3f}s" if seconds is not None else "not reached"
+        print(f"{name:<8} time to {args.target:g} dB of the converged solution: {reached}")
+
+
+if __name__ == "__main__":
+    main()
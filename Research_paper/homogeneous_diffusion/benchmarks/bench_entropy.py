@@ -0,0 +1,83 @@
+"""
+Speed and size benchmark of the entropy backends of the edge codec (utils/entropy.py).
+
+The in-process backends always run; the external ones (jbig needs pbmtojbg/jbgtopbm, paq needs paq8o6_64) only when
+their tools are found on the PATH. Every backend codes the edge map or the pixel samples of each image, the samples
+in both layouts, and the decoded result is checked against the input.
+
+Usage: python3 benchmarks/bench_entropy.py [images/image1.png ...] [--q 4] [--d 3] [--repeat 3]
+"""
+import argparse
+import glob
+import os
+import shutil
+import sys
+import time
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from edge_codec import detect_edges
+from utils.contours import encode_contour_pixel_values
+from utils.entropy import EDGE_BACKENDS, SAMPLE_BACKENDS
+
+REQUIRED_TOOLS = {"jbig": ["pbmtojbg", "jbgtopbm"], "paq": ["paq8o6_64"]}
+
+
+def is_available(name):
+    return all(shutil.which(tool) for tool in REQUIRED_TOOLS.get(name, []))
+
+
+def time_backend(backend, data, repeat, *args):
+    """
+    Returns the best encode and decode times over repeat runs, the coded size and the decoded data.
+    """
+    encode_time, decode_time = float("inf"), float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        coded = backend.encode(data, None, *args)
+        encode_time = min(encode_time, time.perf_counter() - start)
+
+        start = time.perf_counter()
+        decoded = backend.decode(coded, None, *args)
+        decode_time = min(decode_time, time.perf_counter() - start)
+    return encode_time, decode_time, len(coded), decoded
+
+
+def main():
+    image_folder = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "images")
+    default_images = sorted(glob.glob(os.path.join(image_folder, "*.png")))
+    parser = argparse.ArgumentParser(description="Entropy backend speed and size benchmark")
+    parser.add_argument("images", nargs="*", default=default_images, help="Images to code.")
+    parser.add_argument("--q", type=int, default=4, help="Quantization parameter.")
+    parser.add_argument("--d", type=int, default=3, help="Subsampling distance.")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per backend, the best time is reported.")
+    args = parser.parse_args()
+
+    skipped = [name for name in list(EDGE_BACKENDS) + list(SAMPLE_BACKENDS) if not is_available(name)]
+    if skipped:
+        print(f"Skipping {', '.join(skipped)}: external tools not on the PATH.")
+
+    print(f"{'image':<14} {'data':<8} {'backend':<8} {'bytes':>8} {'encode s':>9} {'decode s':>9} {'MB/s':>8}")
+    for image_path in args.images:
+        image = cv2.cvtColor(cv2.imread(image_path), cv2.COLOR_BGR2RGB)
+        edges = detect_edges(image)
+        pixel_data = encode_contour_pixel_values(image, edges, args.q, args.d)
+
+        raw_sizes = {"edges": edges.size / 8, "records": len(pixel_data) * 7, "compact": len(pixel_data) * 3}
+        for kind, backends, data, layout_args in (("edges", EDGE_BACKENDS, edges, ()),
+                                                  ("records", SAMPLE_BACKENDS, pixel_data, ("records",)),
+                                                  ("compact", SAMPLE_BACKENDS, pixel_data[:, 2:], ("compact",))):
+            raw_size = raw_sizes[kind]  # packed bitmap, 7-byte records, or 3 bytes of colour per sample
+            for name, backend in backends.items():
+                if name in skipped:
+                    continue
+                encode_time, decode_time, size, decoded = time_backend(backend, data, args.repeat, *layout_args)
+                assert np.array_equal(decoded, data), f"{name} did not decode {kind} of {image_path}"
+                print(f"{os.path.basename(image_path):<14} {kind:<8} {name:<8} {size:>8} {encode_time:>9.3f} "
+                      f"{decode_time:>9.3f} {raw_size / (encode_time + decode_time) / 1e6:>8.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+"""
+Concurrent batch compression of many images with the edge-based codec.
+
+Every image is a job that runs compress and decompress from edge_codec in a worker process, with its own scratch
+folder for the external coders, so jobs never share temporary files. With the jbig and paq backends, while one worker
+waits on paq8o6_64 or pbmtojbg, the others keep detecting edges and sampling contours of other images.
+
+Usage: python3 edge_batch.py <image folder or manifest.txt> [--q 4] [--d 3] [--workers N]
+                             [--edge-backend context] [--sample-backend lzma] [--layout compact]
+                             [--output-folder compressed] [--results edge_results.csv]
+                             [--trace traces.jsonl] [--trace-memory]
+
+A manifest is a text file with one image path per line, relative to the manifest. With --trace, every image also gets a
+per-stage timing record (see instrumentation.py at the root of the repository), appended to a JSON lines file.
+"""
+import argparse
+import csv
+import os
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+
+import cv2
+import numpy as np
+
+from edge_codec import compress, decompress
+from utils.entropy import EDGE_BACKENDS, LAYOUTS, SAMPLE_BACKENDS
+from utils.profiling import run_traced, write_trace
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp", ".tif", ".tiff", ".ppm")
+RESULT_COLUMNS = ["Image", "q", "d", "Compress seconds", "Decompress seconds", "Bytes", "BPP", "PSNR"]
+
+
+def list_images(source):
+    """
+    Return the sorted image paths of a folder, or the image paths listed in a manifest file.
+    """
+    if os.path.isdir(source):
+        return [os.path.join(source, name) for name in sorted(os.listdir(source))
+                if name.lower().endswith(IMAGE_EXTENSIONS)]
+
+    with open(source) as f:
+        lines = [line.strip() for line in f]
+    return [os.path.join(os.path.dirname(source), line) for line in lines if line and not line.startswith("#")]
+
+
+def calculate_psnr(original, reconstructed):
+    """
+    Peak signal-to-noise ratio in dB of an 8-bit reconstruction.
+    """
+    mse = np.mean((np.asarray(original, dtype=np.float64) - np.asarray(reconstructed, dtype=np.float64)) ** 2)
+    return float("inf") if mse == 0 else 10 * np.log10(255 ** 2 / mse)
+
+
+def run_job(image_path, compressed_file, q, d, scratch_dir=None, edge_backend="context", sample_backend="lzma",
+            layout="compact"):
+    """
+    Compress and decompress one image and return its result row (see RESULT_COLUMNS).
+    """
+    image = cv2.imread(image_path)
+    if image is None:
+        raise FileNotFoundError(f"Unable to read image from {image_path}")
+    image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+
+    # each job gets its own scratch folder for the external coders
+    with tempfile.TemporaryDirectory(dir=scratch_dir) as scratch:
+        start = time.perf_counter()
+        data = compress(image, q, d, scratch_dir=scratch, edge_backend=edge_backend, sample_backend=sample_backend,
+                        layout=layout)
+        compress_seconds = time.perf_counter() - start
+
+        # write to a temporary file first so that an interrupted job never leaves a truncated .bin behind
+        with open(compressed_file + ".part", "wb") as f:
+            f.write(data)
+        os.replace(compressed_file + ".part", compressed_file)
+
+        start = time.perf_counter()
+        reconstructed = decompress(data, scratch_dir=scratch)
+        decompress_seconds = time.perf_counter() - start
+
+    bpp = len(data) * 8 / (image.shape[0] * image.shape[1])
+    return [os.path.basename(image_path), q, d, compress_seconds, decompress_seconds, len(data), bpp,
+            calculate_psnr(image, reconstructed)]
+
+
+def run_batch(image_paths, output_folder, results_file, q, d, workers=None, scratch_dir=None, edge_backend="context",
+              sample_backend="lzma", layout="compact", trace_file=None, trace_memory=False):
+    """
+    Compress all images across a pool of worker processes, write one CSV row per image in input order and return
+    the rows. Every image is written to <output_folder>/<image name>.bin. If trace_file is given, the stage trace of
+    every image (with memory counts if trace_memory is set) is appended to it.
+    """
+    names = [os.path.splitext(os.path.basename(path))[0] for path in image_paths]
+    if len(set(names)) != len(names):
+        raise ValueError("Images must have distinct names, since each is written to <name>.bin.")
+    os.makedirs(output_folder, exist_ok=True)
+
+    rows = []
+    with open(results_file, "w", newline="") as file, \
+            open(trace_file, "a") if trace_file else nullcontext() as traces, \
+            ProcessPoolExecutor(max_workers=workers) as pool:
+        writer = csv.writer(file)
+        writer.writerow(RESULT_COLUMNS)
+
+        futures = []
+        for path, name in zip(image_paths, names):
+            job = (path, os.path.join(output_folder, f"{name}.bin"), q, d, scratch_dir, edge_backend, sample_backend,
+                   layout)
+            if traces:
+                futures.append(pool.submit(run_traced, run_job, {"image": path, "q": q, "d": d}, *job,
+                                           memory=trace_memory))
+            else:
+                futures.append(pool.submit(run_job, *job))
+
+        for future in futures:
+            row = future.result()
+            if traces:
+                row, record = row
+                write_trace(traces, record)
+            writer.writerow(row)
+            file.flush()
+            print(f"{row[0]:<24} compress {row[3]:7.2f}s  decompress {row[4]:7.2f}s  "
+                  f"{row[6]:6.3f} bpp  {row[7]:6.2f} dB")
+            rows.append(row)
+
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compress many images concurrently with the edge-based codec")
+    parser.add_argument("source", help="Folder of images, or a manifest file with one image path per line.")
+    parser.add_argument("--q", type=int, default=4, help="Quantization parameter.")
+    parser.add_argument("--d", type=int, default=3, help="Subsampling distance.")
+    parser.add_argument("--workers", type=int, default=None, help="Number of worker processes (default: all cores).")
+    parser.add_argument("--edge-backend", choices=sorted(EDGE_BACKENDS), default="context",
+                        help="Entropy backend of the edge maps.")
+    parser.add_argument("--sample-backend", choices=sorted(SAMPLE_BACKENDS), default="lzma",
+                        help="Entropy backend of the pixel samples.")
+    parser.add_argument("--layout", choices=sorted(LAYOUTS), default="compact",
+                        help="Store the colours of the samples only (compact), or their positions too (records).")
+    parser.add_argument("--output-folder", default="compressed", help="Folder for the compressed .bin files.")
+    parser.add_argument("--results", default="edge_results.csv", help="Results CSV.")
+    parser.add_argument("--scratch-dir", default=None, help="Folder for the per-job scratch folders.")
+    parser.add_argument("--trace", default=None, help="JSON lines file to append the stage trace of every image to.")
+    parser.add_argument("--trace-memory", action="store_true", help="Count the memory of every stage in the traces.")
+    args = parser.parse_args()
+
+    image_paths = list_images(args.source)
+    start = time.perf_counter()
+    rows = run_batch(image_paths, args.output_folder, args.results, args.q, args.d, args.workers, args.scratch_dir,
+                     args.edge_backend, args.sample_backend, args.layout, args.trace, args.trace_memory)
+    print(f"{len(rows)} images in {time.perf_counter() - start:.2f}s, results in {args.results}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""
+In-process edge-based image compression: compress(image) -> bytes and decompress(bytes) -> image.
+
+The stages of compressor.py and decompressor.py run here as plain function calls: the edge map and the sampled pixels
+stay in memory between them and nothing is plotted.
+
+The edge map and the pixel samples are coded by entropy backends of utils/entropy.py. The in-process backends
+("context" and "lzma") are the default; the external coders ("jbig" and "paq") work on files inside a private
+temporary folder per call. The compressed data starts with a header naming both backends (utils/storage.py), and
+files of the older JBIG/PAQ-only format still decompress.
+
+The colours of the samples are quantized to q bits. In the compact sample layout (the default) only the colours are
+stored: their positions follow from the decoded edge map and the subsampling distance d. The header stores q and d.
+"""
+import cv2
+import numpy as np
+from skimage import color
+
+from utils.contours import dequantize_pixel_values, encode_contour_pixel_values, get_sample_positions
+from utils.decoder import unpack_encoded_data
+from utils.entropy import EDGE_BACKENDS, LAYOUTS, SAMPLE_BACKENDS, get_backend, get_layout
+from utils.homogeneous_diffusion import MAX_ITERATIONS, TOLERANCE, reconstruct_with_diffusion
+from utils.marr_hildreth import marr_hildreth_edge_detection
+from utils.profiling import stage
+from utils.storage import pack_encoded_data
+
+SIGMA = 3.0  # Sigma of the Marr-Hildreth Gaussian, as used by compressor.py
+THRESHOLD = 0.0005  # LoG threshold of the Marr-Hildreth detector, as used by compressor.py
+
+
+def detect_edges(image, sigma=SIGMA, threshold=THRESHOLD):
+    """
+    Detect the edges of an RGB image with the Marr-Hildreth detector.
+    :param image: 3D array of the RGB image
+    :return: Binary edge map (1 for edge, 0 for non-edge)
+    """
+    _, zero_crossing = marr_hildreth_edge_detection(color.rgb2gray(image), sigma, threshold)
+    return (zero_crossing > 0).astype(np.uint8)
+
+
+@stage()
+def compress(image, q, d, sigma=SIGMA, threshold=THRESHOLD, scratch_dir=None, edge_backend="context",
+             sample_backend="lzma", layout="compact"):
+    """
+    Compress an image with the edge-based codec.
+    :param image: 3D array of the RGB image
+    :param q: Quantization parameter, the number of bits kept per colour channel (1 to 8)
+    :param d: Subsampling distance
+    :param scratch_dir: Folder in which the temporary folder of the external coders is created (system default if None)
+    :param edge_backend: Name of the entropy backend of the edge map (see EDGE_BACKENDS)
+    :param sample_backend: Name of the entropy backend of the pixel samples (see SAMPLE_BACKENDS)
+    :param layout: "compact" to store the colours of the samples only, "records" to store their positions too
+    :return: Compressed image
+    """
+    edges = detect_edges(image, sigma, threshold)
+    pixel_data = encode_contour_pixel_values(image, edges, q, d)
+    samples = pixel_data[:, 2:] if layout == "compact" else pixel_data
+
+    edge_coder = EDGE_BACKENDS[edge_backend]
+    sample_coder = SAMPLE_BACKENDS[sample_backend]
+    return pack_encoded_data(edge_coder.encode(edges, scratch_dir), sample_coder.encode(samples, scratch_dir, layout),
+                             edge_coder.id, sample_coder.id, LAYOUTS[layout], q, d)
+
+
+@stage()
+def decompress(data, scratch_dir=None, tol=TOLERANCE, max_iter=MAX_ITERATIONS):
+    """
+    Decompress an image compressed with compress.
+    :param data: Compressed image
+    :param scratch_dir: Folder in which the temporary folder of the external coders is created (system default if None)
+    :param tol: Relative residual at which the homogeneous diffusion solver stops
+    :param max_iter: Maximum number of solver iterations per level of the diffusion solver
+    :return: 3D array of the reconstructed RGB image
+    """
+    encoded = unpack_encoded_data(data)
+    layout = get_layout(encoded.layout_id)
+    edges = get_backend(EDGE_BACKENDS, encoded.edge_backend_id)[1].decode(encoded.edge_data, scratch_dir)
+    sample_coder = get_backend(SAMPLE_BACKENDS, encoded.sample_backend_id)[1]
+    samples = sample_coder.decode(encoded.sample_data, scratch_dir, layout)
+
+    if layout == "compact":
+        positions = get_sample_positions(edges, encoded.d)
+        if len(positions) != len(samples):
+            raise ValueError("The number of samples does not match the edge map.")
+        pixel_data = np.column_stack([positions, samples])
+    else:
+        pixel_data = samples
+    pixel_data[:, 2:] = dequantize_pixel_values(pixel_data[:, 2:], encoded.q)
+
+    reconstructed_image = reconstruct_with_diffusion(edges, pixel_data, tol, max_iter)  # BGR, as cv2 works
+    return cv2.cvtColor(reconstructed_image, cv2.COLOR_BGR2RGB)
@@ -1,10 +1,19 @@
 import subprocess
-import struct
 import os
 import numpy as np
 import cv2
 import sys
 import matplotlib.pyplot as plt
+from scipy.ndimage import binary_dilation
+
+try:
+    from utils.entropy import SAMPLE_BACKENDS, pack_pixel_records
+    from utils.profiling import stage
+except ImportError:  # run as a script from the utils folder
+    from entropy import SAMPLE_BACKENDS, pack_pixel_records
+    from profiling import stage
+
+GAP = 3  # specifies the window around edges to consider as adjacent pixels
 
 def create_colored_contour_image(edge_image, pixel_data_restored):
     """
@@ -19,49 +28,52 @@ def create_colored_contour_image(edge_image, pixel_data_restored):
     # colored_contour_image[edge_image == 1] = [255, 255, 255]  # White for edge pixels
     # colored_contour_image = 255 - colored_contour_image  # Invert colors for better visualization
 
-    for x, y, R, G, B in pixel_data_restored:
-        if 0 <= x < colored_contour_image.shape[0] and 0 <= y < colored_contour_image.shape[1]:
-            colored_contour_image[x, y] = [R, G, B]  # Assign color from pixel_data_restored
+    pixel_data_restored = np.asarray(pixel_data_restored, dtype=np.int64).reshape(-1, 5)
+    x, y = pixel_data_restored[:, 0], pixel_data_restored[:, 1]
+    inside = (0 <= x) & (x < colored_contour_image.shape[0]) & (0 <= y) & (y < colored_contour_image.shape[1])
+    colored_contour_image[x[inside], y[inside]] = pixel_data_restored[inside, 2:]  # R, G, B
 
     return colored_contour_image
 
-def get_adjacent_indices(image, edges):
+@stage()
+def get_adjacent_indices(edges):
     """
-    Extract pixel values adjacent to detected edges.
-    :param image: 3D array of the original image
+    Find the pixels adjacent to detected edges.
     :param edges: Binary edge map (1 for edge, 0 for non-edge)
-    :return: List of pixel values adjacent to edges
+    :return: (n, 2) array of the indices of the non-edge pixels within GAP pixels of an edge, in row-major order
     """
+    edge_mask = edges == 1
 
-    gap = 3    # specifies the window around edges to consider as adjacent pixels
-    directions = [(dx, dy) for dx in range(-gap, gap + 1) for dy in range(-gap, gap + 1) if dx != 0 or dy != 0]
-    indices = []
-
-    for x, y in zip(*np.where(edges == 1)):  # Edge positions
-        for dx, dy in directions:
-            nx, ny = x + dx, y + dy
-            if 0 <= nx < image.shape[0] and 0 <= ny < image.shape[1] and edges[nx, ny] == 0:
-                indices.append([nx, ny])
+    # every pixel of the (2 * GAP + 1) square window around an edge pixel, minus the edge pixels themselves
+    window = np.ones((2 * GAP + 1, 2 * GAP + 1), dtype=bool)
+    adjacent = binary_dilation(edge_mask, structure=window) & ~edge_mask
 
-    # returns unique indices
-    return list(set(map(tuple, indices)))
+    # np.argwhere scans row by row, so the order (and thus the subsampling) is the same on every run
+    return np.argwhere(adjacent)
 
 
 def quantize_pixel_values(pixel_values, q):
     """
-    Quantize pixel values to reduce the number of unique values.
-    :param pixel_values: List of pixel values
+    Quantize 8-bit pixel values to q bits to reduce the number of unique values.
+    :param pixel_values: Array of pixel values
+    :param q: Quantization parameter, the number of bits kept per channel (1 to 8)
+    :return: Array of quantization indices, from 0 to 2 ** q - 1
+    """
+    if not 1 <= q <= 8:
+        raise ValueError("The quantization parameter must be between 1 and 8 bits.")
+    return np.asarray(pixel_values, dtype=np.int64) >> (8 - q)
+
+
+def dequantize_pixel_values(indices, q):
+    """
+    Map quantization indices back to 8-bit pixel values, at the middle of their quantization interval.
+    :param indices: Array of quantization indices, as returned by quantize_pixel_values
     :param q: Quantization parameter
-    :return: Quantized pixel values
+    :return: Array of pixel values (q = 8 returns the indices unchanged)
     """
-    quantized_values = []
-    for value in pixel_values:
-        R, G, B = value
-        R_quantized = np.round(R / (256 / (2 ** q))) * (256 / (2 ** q))
-        G_quantized = np.round(G / (256 / (2 ** q))) * (256 / (2 ** q))
-        B_quantized = np.round(B / (256 / (2 ** q))) * (256 / (2 ** q))
-        quantized_values.append((R_quantized, G_quantized, B_quantized))
-    return quantized_values
+    if not 1 <= q <= 8:
+        raise ValueError("The quantization parameter must be between 1 and 8 bits.")
+    return (np.asarray(indices, dtype=np.int64) << (8 - q)) + ((1 << (8 - q)) >> 1)
 
 
 def subsample_indices(indices, d):
@@ -74,6 +86,17 @@ def subsample_indices(indices, d):
     return indices[::d]
 
 
+def get_sample_positions(edges, d):
+    """
+    Positions of the sampled pixels, which depend on the edge map and the subsampling distance only.
+    :param edges: Binary edge map (1 for edge, 0 for non-edge)
+    :param d: Subsampling distance
+    :return: (n, 2) array of the (x, y) positions of the samples, in row-major order
+    """
+    return subsample_indices(get_adjacent_indices(edges), d)
+
+
+@stage()
 def encode_contour_pixel_values(image, edges, q, d):
     """
     Encode pixel values adjacent to edges using quantization and subsampling.
@@ -81,29 +104,21 @@ def encode_contour_pixel_values(image, edges, q, d):
     :param edges: Binary edge map (1 for edge, 0 for non-edge)
     :param q: Quantization parameter
     :param d: Subsampling distance
-    :return: Encoded pixel data
+    :return: (n, 5) array of (x, y, R, G, B) samples, the colours as q-bit quantization indices
     """
-    adjacent_values = get_adjacent_indices(image, edges)
-
-    subsampled_indices = subsample_indices(adjacent_values, d)
+    subsampled_indices = get_sample_positions(edges, d)
 
-    subsampled_values = []
-    for idx in subsampled_indices:
-        x, y = idx
-        R, G, B = image[x, y]
-        subsampled_values.append((x, y, R, G, B))
-
-    return np.array(subsampled_values)
+    # gather and quantize the RGB values of all subsampled pixels at once
+    x, y = subsampled_indices[:, 0], subsampled_indices[:, 1]
+    return np.column_stack([x, y, quantize_pixel_values(image[x, y], q)])
 
 
 def serialize_pixel_data(pixel_data):
     """
-    Serialize a list of (x, y, R, G, B) tuples into binary format.
+    Serialize (x, y, R, G, B) tuples, or an (n, 5) array, into binary format: 7-byte records of uint16 x and y and
+    uint8 R, G and B.
     """
-    serialized = bytearray()
-    for x, y, R, G, B in pixel_data:
-        serialized.extend(struct.pack("HHBBB", x, y, R, G, B))  # H for uint16, B for uint8
-    return bytes(serialized)
+    return pack_pixel_records(pixel_data)
 
 
 def compress_with_paq(data, temp_file, output_file):
@@ -118,16 +133,25 @@ def compress_with_paq(data, temp_file, output_file):
     os.remove(temp_file)
 
 
+def compress_with_backend(pixel_data, output_file, backend):
+    """
+    Compress the (x, y, R, G, B) pixel values with an entropy backend of utils/entropy.py.
+    """
+    with open(os.path.join("tmp", output_file), "wb") as f:
+        f.write(SAMPLE_BACKENDS[backend].encode(pixel_data))
+
+
 if __name__ == "__main__":
 
-    if len(sys.argv) != 5:
-        print("Usage: python contours.py <path_to_image.png> <path_to_edges.pbm> <q> <d>")
+    if len(sys.argv) not in (5, 6):
+        print("Usage: python contours.py <path_to_image.png> <path_to_edges.pbm> <q> <d> [sample_backend]")
         sys.exit(1)
 
     image_path = sys.argv[1]
     edges_path = sys.argv[2]
     q = int(sys.argv[3])
     d = int(sys.argv[4])
+    backend = sys.argv[5] if len(sys.argv) > 5 else "paq"
 
     # read in the image
     image = cv2.imread(image_path)
@@ -145,12 +169,14 @@ if __name__ == "__main__":
 
     quantized_values = encode_contour_pixel_values(image, edges, q, d)
 
-    # convert quantized_values to a list of 5-element tuples and compress
-    quantized_data_list = [tuple(row) for row in quantized_values]
-    serialized_data = serialize_pixel_data(quantized_data_list)
-    compress_with_paq(serialized_data, "temp.bin", "compressed.paq8o6")
+    if backend == "paq":
+        serialized_data = serialize_pixel_data(quantized_values)
+        compress_with_paq(serialized_data, "temp.bin", "compressed.paq8o6")
+    else:
+        compress_with_backend(quantized_values, f"compressed.{backend}", backend)
 
-    colored_contour_image = create_colored_contour_image(edges, quantized_values)
+    dequantized_values = np.column_stack([quantized_values[:, :2], dequantize_pixel_values(quantized_values[:, 2:], q)])
+    colored_contour_image = create_colored_contour_image(edges, dequantized_values)
     plt.figure(figsize=(10, 10))
     plt.imshow(colored_contour_image)
     plt.title('Colored Contour Image')
@@ -2,40 +2,81 @@ import struct
 import sys
 import subprocess
 import os
+from collections import namedtuple
+
+try:
+    from utils.entropy import EDGE_BACKENDS, LAYOUTS, SAMPLE_BACKENDS, get_backend, write_pbm
+    from utils.storage import FORMAT_VERSION, HEADER, MAGIC
+except ImportError:  # run as a script from the utils folder
+    from entropy import EDGE_BACKENDS, LAYOUTS, SAMPLE_BACKENDS, get_backend, write_pbm
+    from storage import FORMAT_VERSION, HEADER, MAGIC
+
+LEGACY_HEADER = struct.Struct("I")  # files without a magic start with the size of the JBIG data
+UNQUANTIZED = 8  # files without a magic hold plain 8-bit colours
+
+EncodedData = namedtuple("EncodedData", ["edge_backend_id", "sample_backend_id", "layout_id", "q", "d", "edge_data",
+                                         "sample_data"])
+
 
 def decompress_with_jbig(input_file, output_file):
     subprocess.run(["jbgtopbm", input_file, output_file], check=True)
 
 
+def unpack_encoded_data(data):
+    """
+    Split encoded data into the coded edge map and pixel samples.
+
+    :param data: Encoded data, with a header or in the older JBIG/PAQ-only format.
+    :return: EncodedData with the backend ids, the sample layout id, the quantization parameter (8 in the older format),
+             the sampling distance (0 in the older format), the edge data and the sample data.
+    """
+    if data[:len(MAGIC)] != MAGIC:
+        jbig_size = LEGACY_HEADER.unpack_from(data)[0]
+        start = LEGACY_HEADER.size
+        return EncodedData(EDGE_BACKENDS["jbig"].id, SAMPLE_BACKENDS["paq"].id, LAYOUTS["records"], UNQUANTIZED, 0,
+                           data[start:start + jbig_size], data[start + jbig_size:])
+
+    version = data[len(MAGIC)]
+    if version != FORMAT_VERSION:
+        raise ValueError(f"Unsupported encoded data version {version}.")
+    _, _, edge_backend_id, sample_backend_id, layout_id, q, d, edge_size = HEADER.unpack_from(data)
+    start = HEADER.size
+    return EncodedData(edge_backend_id, sample_backend_id, layout_id, q, d, data[start:start + edge_size],
+                       data[start + edge_size:])
+
+
 def recover_encoded_data(encoded_file, output_jbig_file, output_paq_file):
     """
-    Recover JBIG data, PAQ data, and metadata from the encoded file.
+    Recover the edge map, the coded pixel values, and metadata from the encoded file.
 
     :param encoded_file: Path to the combined encoded file.
-    :param output_jbig_file: Path to save the extracted JBIG file.
-    :param output_paq_file: Path to save the extracted PAQ file.
+    :param output_jbig_file: Path to save the extracted JBIG file, decoded next to it as a PBM file.
+    :param output_paq_file: Path to save the extracted pixel values, still coded by their sample backend.
+    :return: Name of the sample backend that coded the pixel values, and the quantization parameter of the colours.
     """
     with open(encoded_file, "rb") as f:
-        # metadata
-        # d = struct.unpack("B", f.read(1))[0]  # subsampling parameter
-        # q = struct.unpack("B", f.read(1))[0]  # quantization parameter
-        jbig_size = struct.unpack("I", f.read(4))[0] # size of JBIG data
-        
-        # JBIG data
-        jbig_data = f.read(jbig_size)
-
-        # PAQ data
-        paq_data = f.read()
-
-    # write JBIG data to output file
-    with open(output_jbig_file, "wb") as jbig_out:
-        jbig_out.write(jbig_data)
-    decompress_with_jbig(output_jbig_file, output_jbig_file.replace(".jbg", ".pbm"))
-    os.remove(output_jbig_file)
-
-    # write PAQ data to output file
+        encoded = unpack_encoded_data(f.read())
+    if encoded.layout_id != LAYOUTS["records"]:
+        raise ValueError("The per-stage scripts only handle samples stored as records, use decompressor.py.")
+    edge_data, sample_data = encoded.edge_data, encoded.sample_data
+    edge_backend_name, edge_backend = get_backend(EDGE_BACKENDS, encoded.edge_backend_id)
+    pbm_file = output_jbig_file.replace(".jbg", ".pbm")
+
+    if edge_backend_name == "jbig":
+        # write JBIG data to output file
+        with open(output_jbig_file, "wb") as jbig_out:
+            jbig_out.write(edge_data)
+        decompress_with_jbig(output_jbig_file, pbm_file)
+        os.remove(output_jbig_file)
+    else:
+        with open(pbm_file, "wb") as pbm_out:
+            pbm_out.write(write_pbm(edge_backend.decode(edge_data)))
+
+    # write the coded pixel values to output file
     with open(output_paq_file, "wb") as paq_out:
-        paq_out.write(paq_data)
+        paq_out.write(sample_data)
+
+    return get_backend(SAMPLE_BACKENDS, encoded.sample_backend_id)[0], encoded.q
 
 
 def main():
@@ -47,7 +88,8 @@ def main():
     output_jbig_path = sys.argv[2]
     output_paq_path = sys.argv[3]   
 
-    recover_encoded_data(encoded_path, output_jbig_path, output_paq_path)
+    sample_backend, q = recover_encoded_data(encoded_path, output_jbig_path, output_paq_path)
+    print(f"Pixel values in {output_paq_path} are coded with the {sample_backend} backend, quantized to {q} bits.")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,376 @@
+"""
+Entropy backends of the edge codec.
+
+An edge backend turns the binary edge map into bytes and back, a sample backend does the same for the (n, 5) array of
+(x, y, R, G, B) pixel samples. Every backend has a one-byte id, stored in the compressed file so that the decoder
+knows which one to use.
+
+In-process backends:
+    edges "context":  adaptive binary arithmetic coding of the bitmap, every pixel modelled by the 10 already coded
+                      pixels of the JBIG three-line template around it
+    samples "lzma":   coordinates coded as differences from the previous sample, colours as differences modulo 256,
+                      split into byte planes and compressed with LZMA (in compact layout, the interleaved (R, G, B)
+                      triples as they are, without differences)
+
+External backends, which need the tools on the PATH and work on files in a temporary folder:
+    edges "jbig":     pbmtojbg / jbgtopbm
+    samples "paq":    paq8o6_64
+
+Sample backends take a layout:
+    "records":  (n, 5) array of (x, y, R, G, B) samples
+    "compact":  (n, 3) array of (R, G, B) samples only, since the decoder finds the positions again from the decoded
+                edge map and the subsampling distance; "lzma" stores interleaved (R, G, B) triples, "paq" planar
+                channels (pack_colour_planes)
+"""
+import lzma
+import os
+import struct
+import subprocess
+import tempfile
+from collections import namedtuple
+
+import numpy as np
+
+try:
+    from utils.profiling import stage, timed
+except ImportError:  # run as a script from the utils folder
+    from profiling import stage, timed
+
+Backend = namedtuple("Backend", ["id", "encode", "decode"])
+
+# JBIG three-line template: (row offset, column offset) of the context pixels, all coded before the current one
+CONTEXT_TEMPLATE = [(0, -1), (0, -2), (-1, -2), (-1, -1), (-1, 0), (-1, 1), (-1, 2), (-2, -1), (-2, 0), (-2, 1)]
+PROB_BITS = 16  # Precision of the probabilities of the arithmetic coder
+ADAPT_SHIFT = 5  # Adaptation rate of the probabilities, 1 / 2 ** ADAPT_SHIFT
+TOP = 1 << 24  # The range is renormalized whenever it falls below this
+
+# The stream is raw, so the decoder uses the same filters: the dictionary is pinned rather than left to the preset,
+# whose 64 MiB would cost about 700 MB of match finder on every call, whatever the size of the input
+LZMA_FILTERS = [{"id": lzma.FILTER_LZMA2, "preset": 9 | lzma.PRESET_EXTREME, "dict_size": 1 << 20}]
+SAMPLE_COUNT = struct.Struct("<I")
+PIXEL_RECORD = np.dtype([("x", "<u2"), ("y", "<u2"), ("R", "u1"), ("G", "u1"), ("B", "u1")])  # 7 bytes, no padding
+LAYOUTS = {"records": 0, "compact": 1}
+
+
+# ---------------------------------------------------------------- context-modelled arithmetic coding of the edge map
+
+def get_row_contexts(rows, width):
+    """
+    Compute the part of the context of every pixel of a row that comes from the two rows above.
+    :param rows: (2, width + 4) array with the two previous rows, padded with two zero columns on each side
+    :return: List of the partial context of every pixel of the row
+    """
+    context = np.zeros(width, dtype=np.int64)
+    for bit, (dr, dc) in enumerate(CONTEXT_TEMPLATE):
+        if dr < 0:
+            context |= rows[2 + dr, 2 + dc:2 + dc + width].astype(np.int64) << bit
+    return context.tolist()
+
+
+@stage()
+def encode_edges_context(edges, scratch_dir=None):
+    """
+    Compress a binary edge map with a context-modelled adaptive binary arithmetic coder.
+    """
+    height, width = edges.shape
+    bits = (edges > 0).astype(np.uint8)
+
+    # Every context is known up front when encoding, so all of them are computed at once
+    padded = np.pad(bits, ((2, 0), (2, 2)))
+    contexts = np.zeros(bits.shape, dtype=np.int64)
+    for bit, (dr, dc) in enumerate(CONTEXT_TEMPLATE):
+        contexts |= padded[2 + dr:2 + dr + height, 2 + dc:2 + dc + width].astype(np.int64) << bit
+
+    probs = [1 << (PROB_BITS - 1)] * (1 << len(CONTEXT_TEMPLATE))  # Probability of a 0 in every context
+    out = bytearray()
+    low, range_, cache, cache_size = 0, 0xFFFFFFFF, 0, 1
+    for context, bit in zip(contexts.ravel().tolist(), bits.ravel().tolist()):
+        prob = probs[context]
+        bound = (range_ >> PROB_BITS) * prob
+        if bit:
+            low += bound
+            range_ -= bound
+            probs[context] = prob - (prob >> ADAPT_SHIFT)
+        else:
+            range_ = bound
+            probs[context] = prob + (((1 << PROB_BITS) - prob) >> ADAPT_SHIFT)
+
+        while range_ < TOP:
+            range_ <<= 8
+            # Shift the top byte of low out, holding back 0xFF bytes until a carry can no longer reach them
+            if low < 0xFF000000 or low >= 1 << 32:
+                carry = low >> 32
+                out.append((cache + carry) & 0xFF)
+                out.extend([(0xFF + carry) & 0xFF] * (cache_size - 1))
+                cache, cache_size = (low >> 24) & 0xFF, 0
+            cache_size += 1
+            low = (low & 0x00FFFFFF) << 8
+
+    # Flush the remaining bytes of low
+    for _ in range(5):
+        if low < 0xFF000000 or low >= 1 << 32:
+            carry = low >> 32
+            out.append((cache + carry) & 0xFF)
+            out.extend([(0xFF + carry) & 0xFF] * (cache_size - 1))
+            cache, cache_size = (low >> 24) & 0xFF, 0
+        cache_size += 1
+        low = (low & 0x00FFFFFF) << 8
+
+    return struct.pack("<II", height, width) + bytes(out[1:])  # The first byte is always zero
+
+
+@stage()
+def decode_edges_context(data, scratch_dir=None):
+    """
+    Decompress an edge map compressed with encode_edges_context.
+    """
+    height, width = struct.unpack_from("<II", data)
+    stream = data[8:] + bytes(4)  # Reading past the end only ever needs zeros
+    code = int.from_bytes(stream[:4], "big")
+    position = 4
+    range_ = 0xFFFFFFFF
+
+    probs = [1 << (PROB_BITS - 1)] * (1 << len(CONTEXT_TEMPLATE))
+    rows = np.zeros((2, width + 4), dtype=np.uint8)  # The two previous rows, padded
+    edges = np.zeros((height, width), dtype=np.uint8)
+    for row in range(height):
+        upper = get_row_contexts(rows, width)
+        current = [0] * width
+        previous, before_previous = 0, 0
+        for column in range(width):
+            context = upper[column] | previous | (before_previous << 1)
+            prob = probs[context]
+            bound = (range_ >> PROB_BITS) * prob
+            if code < bound:
+                range_ = bound
+                probs[context] = prob + (((1 << PROB_BITS) - prob) >> ADAPT_SHIFT)
+                bit = 0
+            else:
+                code -= bound
+                range_ -= bound
+                probs[context] = prob - (prob >> ADAPT_SHIFT)
+                bit = 1
+                current[column] = 1
+
+            while range_ < TOP:
+                range_ <<= 8
+                code = (code << 8) | stream[position]
+                position += 1
+            before_previous, previous = previous, bit
+
+        edges[row] = current
+        rows[0] = rows[1]
+        rows[1, 2:2 + width] = current
+    return edges
+
+
+# ---------------------------------------------------------------- sample layouts
+
+def pack_pixel_records(pixel_data):
+    """
+    Serialize (x, y, R, G, B) samples as 7-byte records (uint16 x and y, uint8 R, G and B).
+    """
+    pixel_data = np.asarray(pixel_data).reshape(-1, 5)
+    records = np.empty(len(pixel_data), dtype=PIXEL_RECORD)
+    for column, name in enumerate(PIXEL_RECORD.names):
+        records[name] = pixel_data[:, column]
+    return records.tobytes()
+
+
+def unpack_pixel_records(data):
+    """
+    Deserialize 7-byte records into an (n, 5) array of (x, y, R, G, B) samples.
+    """
+    records = np.frombuffer(data, dtype=PIXEL_RECORD)
+    return np.column_stack([records[name].astype(np.int64) for name in PIXEL_RECORD.names]).reshape(-1, 5)
+
+
+def pack_colour_planes(colours):
+    """
+    Serialize (R, G, B) samples as planar channels: all R values, then all G values, then all B values.
+    """
+    return np.ascontiguousarray(np.asarray(colours, dtype=np.uint8).reshape(-1, 3).T).tobytes()
+
+
+def unpack_colour_planes(data):
+    """
+    Deserialize planar channels into an (n, 3) array of (R, G, B) samples.
+    """
+    return np.frombuffer(data, dtype=np.uint8).reshape(3, -1).T.astype(np.int64)
+
+
+# ---------------------------------------------------------------- delta and LZMA coding of the pixel samples
+
+@stage()
+def encode_samples_lzma(pixel_data, scratch_dir=None, layout="records"):
+    """
+    Compress pixel samples in row-major order with LZMA: in records layout the coordinates and colours as differences
+    from the previous sample, in compact layout the interleaved (R, G, B) triples as they are.
+    """
+    if layout == "compact":
+        # Plain (R, G, B) triples: LZMA finds the colours repeated along the contours as matches, which planar
+        # channels or differences would break up
+        colours = np.asarray(pixel_data, dtype=np.uint8).reshape(-1, 3)
+        return SAMPLE_COUNT.pack(len(colours)) + lzma.compress(colours.tobytes(), format=lzma.FORMAT_RAW,
+                                                               filters=LZMA_FILTERS)
+
+    pixel_data = np.asarray(pixel_data, dtype=np.int64).reshape(-1, 5)
+    x, y = pixel_data[:, 0], pixel_data[:, 1]
+
+    # Rows only grow, and within a row the columns only grow, so both differences are small and non-negative
+    dx = np.diff(x, prepend=0)
+    dy = np.where(dx == 0, np.diff(y, prepend=0), y)
+    coordinates = np.stack([dx, dy]).astype("<u2")
+
+    # Low bytes and high bytes of the coordinates in separate planes, then the colour differences
+    coordinate_planes = coordinates.view(np.uint8).reshape(2, -1, 2).transpose(0, 2, 1)
+    colours = np.diff(pixel_data[:, 2:], axis=0, prepend=0).astype(np.uint8)
+    payload = coordinate_planes.tobytes() + colours.tobytes()
+    return SAMPLE_COUNT.pack(len(pixel_data)) + lzma.compress(payload, format=lzma.FORMAT_RAW, filters=LZMA_FILTERS)
+
+
+@stage()
+def decode_samples_lzma(data, scratch_dir=None, layout="records"):
+    """
+    Decompress pixel samples compressed with encode_samples_lzma into an (n, 5) array, or (n, 3) in compact layout.
+    """
+    n = SAMPLE_COUNT.unpack_from(data)[0]
+    payload = np.frombuffer(lzma.decompress(data[SAMPLE_COUNT.size:], format=lzma.FORMAT_RAW, filters=LZMA_FILTERS),
+                            dtype=np.uint8)
+    if layout == "compact":
+        return payload.reshape(n, 3).astype(np.int64)
+
+    coordinates = payload[:4 * n].reshape(2, 2, n).transpose(0, 2, 1).copy().view("<u2").reshape(2, n)
+    dx, dy = coordinates.astype(np.int64)
+    x = np.cumsum(dx)
+
+    # Columns restart at every new row, so accumulate dy only within runs of samples on the same row
+    new_row = np.r_[True, dx[1:] != 0] if n else np.zeros(0, dtype=bool)
+    row_start = np.maximum.accumulate(np.where(new_row, np.arange(n), 0))
+    cumulative = np.cumsum(dy)
+    y = cumulative - cumulative[row_start] + dy[row_start]
+
+    colours = np.cumsum(payload[4 * n:].reshape(n, 3), axis=0, dtype=np.uint8)
+    return np.column_stack([x, y, colours])
+
+
+# ---------------------------------------------------------------- external coders
+
+def run_tool(command, cwd):
+    """
+    Run an external coder in the given folder and raise if it fails. The call is a stage named after the tool.
+    """
+    with timed(command[0]):
+        subprocess.run(command, cwd=cwd, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+
+
+def write_pbm(edges):
+    """
+    Encode a binary edge map as a binary PBM (P4) file, with edges white (0 bits) as the edge detector script saves them.
+    """
+    rows = np.packbits(edges == 0, axis=1)
+    return b"P4\n%d %d\n" % (edges.shape[1], edges.shape[0]) + rows.tobytes()
+
+
+def read_pbm(data):
+    """
+    Decode a binary PBM (P4) file into a binary edge map (1 for edge, 0 for non-edge).
+    """
+    fields = []
+    offset = 0
+    while len(fields) < 3:
+        end = data.index(b"\n", offset)
+        fields += data[offset:end].split(b"#")[0].split()
+        offset = end + 1
+    if fields[0] != b"P4":
+        raise ValueError("Edge map is not a binary PBM file.")
+    width, height = int(fields[1]), int(fields[2])
+
+    rows = np.frombuffer(data, dtype=np.uint8, offset=offset).reshape(height, -1)
+    return (np.unpackbits(rows, axis=1)[:, :width] == 0).astype(np.uint8)
+
+
+def encode_edges_jbig(edges, scratch_dir=None):
+    """
+    Compress a binary edge map with JBIG (pbmtojbg).
+    """
+    with tempfile.TemporaryDirectory(dir=scratch_dir) as scratch:
+        with open(os.path.join(scratch, "edges.pbm"), "wb") as f:
+            f.write(write_pbm(edges))
+        run_tool(["pbmtojbg", "edges.pbm", "edges.jbg"], scratch)
+        with open(os.path.join(scratch, "edges.jbg"), "rb") as f:
+            return f.read()
+
+
+def decode_edges_jbig(data, scratch_dir=None):
+    """
+    Decompress a JBIG edge map (jbgtopbm) into a binary edge map.
+    """
+    with tempfile.TemporaryDirectory(dir=scratch_dir) as scratch:
+        with open(os.path.join(scratch, "edges.jbg"), "wb") as f:
+            f.write(data)
+        run_tool(["jbgtopbm", "edges.jbg", "edges.pbm"], scratch)
+        with open(os.path.join(scratch, "edges.pbm"), "rb") as f:
+            return read_pbm(f.read())
+
+
+def encode_samples_paq(pixel_data, scratch_dir=None, layout="records"):
+    """
+    Serialize pixel samples and compress them with PAQ8o6.
+    """
+    serialized = pack_colour_planes(pixel_data) if layout == "compact" else pack_pixel_records(pixel_data)
+    with tempfile.TemporaryDirectory(dir=scratch_dir) as scratch:
+        with open(os.path.join(scratch, "samples.bin"), "wb") as f:
+            f.write(serialized)
+        run_tool(["paq8o6_64", "samples.bin"], scratch)
+        with open(os.path.join(scratch, "samples.bin.paq8o6"), "rb") as f:
+            return f.read()
+
+
+def decode_samples_paq(data, scratch_dir=None, layout="records"):
+    """
+    Decompress PAQ8o6 pixel samples into an (n, 5) array, or (n, 3) in compact layout.
+    """
+    with tempfile.TemporaryDirectory(dir=scratch_dir) as scratch:
+        with open(os.path.join(scratch, "samples.paq8o6"), "wb") as f:
+            f.write(data)
+        run_tool(["paq8o6_64", "-d", "samples.paq8o6"], scratch)
+
+        # PAQ restores the file name stored in the archive
+        restored = [name for name in os.listdir(scratch) if name != "samples.paq8o6"]
+        if len(restored) != 1:
+            raise ValueError("PAQ data did not decompress to a single file.")
+        with open(os.path.join(scratch, restored[0]), "rb") as f:
+            serialized = f.read()
+
+    return unpack_colour_planes(serialized) if layout == "compact" else unpack_pixel_records(serialized)
+
+
+EDGE_BACKENDS = {
+    "jbig": Backend(0, encode_edges_jbig, decode_edges_jbig),
+    "context": Backend(1, encode_edges_context, decode_edges_context),
+}
+SAMPLE_BACKENDS = {
+    "paq": Backend(0, encode_samples_paq, decode_samples_paq),
+    "lzma": Backend(1, encode_samples_lzma, decode_samples_lzma),
+}
+
+
+def get_backend(backends, backend_id):
+    """
+    Return the name and backend of the given id.
+    """
+    for name, backend in backends.items():
+        if backend.id == backend_id:
+            return name, backend
+    raise ValueError(f"Unknown entropy backend id {backend_id}.")
+
+
+def get_layout(layout_id):
+    """
+    Return the name of the sample layout of the given id.
+    """
+    for name, known_id in LAYOUTS.items():
+        if known_id == layout_id:
+            return name
+    raise ValueError(f"Unknown sample layout id {layout_id}.")
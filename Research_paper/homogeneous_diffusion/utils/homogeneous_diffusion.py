@@ -1,12 +1,252 @@
 import cv2
 import numpy as np
-import struct
 import os
+import scipy.sparse
+import scipy.sparse.linalg
 import sys
+from collections import namedtuple
 from tqdm import tqdm
 import matplotlib.pyplot as plt
 import subprocess
 
+try:
+    from utils.contours import dequantize_pixel_values
+    from utils.entropy import SAMPLE_BACKENDS, unpack_pixel_records
+    from utils.profiling import stage
+except ImportError:  # run as a script from the utils folder
+    from contours import dequantize_pixel_values
+    from entropy import SAMPLE_BACKENDS, unpack_pixel_records
+    from profiling import stage
+
+# 5-point Laplacian with the sign flipped (4u minus the neighbours), positive definite on the unknown pixels. With a
+# replicated border the missing neighbours cancel part of the centre, which gives reflecting (Neumann) image borders.
+LAPLACIAN = np.array([[0, -1, 0], [-1, 4, -1], [0, -1, 0]], dtype=np.float32)
+TOLERANCE = 1e-3  # Relative residual at which conjugate gradients stops on every level
+MAX_ITERATIONS = 1000  # Conjugate gradient iterations allowed on every level
+MIN_LEVEL_SIZE = 16  # The coarsest level of the multigrid hierarchy has a side between this and twice this
+SMOOTHING_WEIGHT = 0.8  # Damping of the Jacobi sweeps of the V-cycle
+
+# One grid of the multigrid hierarchy. unknown is 1 on the unknown pixels and 0 on the known ones, smoother is the
+# damped inverse diagonal of the Laplacian on the unknown pixels, buffers are the arrays the V-cycle works in (fresh
+# image-sized arrays cost a page fault per page on every call), and coarsest is the sparse LU factorization of the
+# Laplacian on the coarsest grid, which is the only one without buffers (None if it has no unknown pixel)
+Level = namedtuple("Level", ["values", "known", "unknown", "smoother", "buffers", "coarsest"])
+
+
+def apply_laplacian(u, unknown, dst=None):
+    """
+    Apply the negated Laplacian to an image and keep the result on the unknown pixels only.
+    :param u: (height, width, channels) float32 image
+    :param unknown: float32 array of the shape of u, 1 on unknown pixels and 0 on known pixels
+    :param dst: Optional array of the shape of u to write the result to
+    :return: -Laplacian(u) on the unknown pixels, 0 on the known pixels
+    """
+    result = cv2.filter2D(u, -1, LAPLACIAN, dst=dst, borderType=cv2.BORDER_REPLICATE)
+    return cv2.multiply(result, unknown, dst=result)
+
+
+def restrict(fine, coarse_shape):
+    """
+    Sum every 2x2 block of a fine grid into a pixel of the coarse grid, padding odd sides with zeros.
+    """
+    coarse_height, coarse_width = coarse_shape
+    height, width = fine.shape[:2]
+    if (height, width) != (2 * coarse_height, 2 * coarse_width):
+        fine = cv2.copyMakeBorder(fine, 0, 2 * coarse_height - height, 0, 2 * coarse_width - width,
+                                  cv2.BORDER_CONSTANT, value=0)
+    return cv2.resize(fine, (coarse_width, coarse_height), interpolation=cv2.INTER_AREA) * np.float32(4)
+
+
+def prolong(coarse, fine_shape, dst=None):
+    """
+    Copy every pixel of a coarse grid to its 2x2 block of the fine grid, the transpose of restrict. dst, if given,
+    has twice the coarse size, which is one more than the fine size on odd sides.
+    """
+    height, width = fine_shape
+    fine = cv2.resize(coarse, (2 * coarse.shape[1], 2 * coarse.shape[0]), dst=dst, interpolation=cv2.INTER_NEAREST)
+    return fine[:height, :width]
+
+
+def factorize_laplacian(known):
+    """
+    Sparse LU factorization of the Laplacian on the unknown pixels of a small grid, for the exact coarsest solve.
+    """
+    height, width = known.shape
+    index = np.arange(height * width).reshape(height, width)
+    rows = np.concatenate([index[:, :-1].ravel(), index[:-1].ravel()])
+    columns = np.concatenate([index[:, 1:].ravel(), index[1:].ravel()])
+    neighbours = scipy.sparse.coo_matrix((np.ones(len(rows)), (rows, columns)), shape=(height * width,) * 2)
+    neighbours = (neighbours + neighbours.T).tocsr()
+    laplacian = scipy.sparse.diags(np.asarray(neighbours.sum(axis=1)).ravel()) - neighbours
+    unknown = np.flatnonzero(~known)
+    return scipy.sparse.linalg.splu(laplacian[unknown][:, unknown].tocsc()), unknown
+
+
+def build_levels(values, known):
+    """
+    Build the multigrid hierarchy: the grid itself and half-resolution grids down to MIN_LEVEL_SIZE, where a coarse
+    pixel is known if any of its 2x2 fine pixels is, with their mean value.
+
+    :param values: (height, width, channels) float32 image, read on the known pixels only
+    :param known: 2D boolean mask of the known pixels
+    :return: List of Level, finest first
+    """
+    levels = []
+    while True:
+        height, width = known.shape
+        unknown = np.repeat((~known)[..., None], values.shape[2], axis=2).astype(np.float32)
+        # The diagonal of the Laplacian is the number of neighbours inside the image
+        diagonal = np.full((height, width), 4, dtype=np.float32)
+        diagonal[[0, -1]] -= 1
+        diagonal[:, [0, -1]] -= 1
+        smoother = unknown * (SMOOTHING_WEIGHT / diagonal)[..., None]
+        if min(height, width) <= 2 * MIN_LEVEL_SIZE or known.all():
+            coarsest = factorize_laplacian(known) if not known.all() else None
+            levels.append(Level(values, known, unknown, smoother, None, coarsest))
+            return levels
+
+        coarse_shape = ((height + 1) // 2, (width + 1) // 2)
+        buffers = (np.empty_like(unknown), np.empty_like(unknown),
+                   np.empty((2 * coarse_shape[0], 2 * coarse_shape[1], values.shape[2]), dtype=np.float32))
+        levels.append(Level(values, known, unknown, smoother, buffers, None))
+        counts = restrict(known.astype(np.float32), coarse_shape)
+        sums = restrict(np.where(known[..., None], values, 0).astype(np.float32), coarse_shape)
+        known = counts > 0
+        values = sums / np.maximum(counts, 1)[..., None]
+
+
+def v_cycle(levels, residual):
+    """
+    Multigrid V-cycle for the Laplacian, used as the preconditioner of conjugate gradients: a damped Jacobi sweep,
+    the correction from the coarser grids, and a second Jacobi sweep, with an exact solve on the coarsest grid. The
+    sweeps before and after are the same and restrict is the transpose of prolong, so the V-cycle is symmetric.
+
+    :param levels: Multigrid hierarchy from build_levels, starting at the grid of residual
+    :param residual: (height, width, channels) float32 residual, 0 on the known pixels
+    :return: Approximate solution of the Laplace equation with residual as right-hand side, 0 on the known pixels,
+             in a buffer of the level that the next V-cycle overwrites
+    """
+    level = levels[0]
+    if len(levels) == 1:
+        correction = np.zeros_like(residual)
+        if level.coarsest is not None:
+            factorization, unknown = level.coarsest
+            flat = residual.reshape(-1, residual.shape[2])
+            correction.reshape(-1, residual.shape[2])[unknown] = factorization.solve(flat[unknown].astype(np.float64))
+        return correction
+
+    correction, defect, upsampled = level.buffers
+    cv2.multiply(residual, level.smoother, dst=correction)
+    # The defect is not masked: on a known pixel it only reaches coarse pixels that are known too
+    cv2.filter2D(correction, -1, LAPLACIAN, dst=defect, borderType=cv2.BORDER_REPLICATE)
+    cv2.subtract(residual, defect, dst=defect)
+    coarse = cv2.multiply(restrict(defect, levels[1].known.shape), levels[1].unknown)
+    coarse_correction = prolong(v_cycle(levels[1:], coarse), level.known.shape, upsampled)
+    cv2.add(correction, cv2.multiply(coarse_correction, level.unknown, dst=defect), dst=correction)
+
+    cv2.filter2D(correction, -1, LAPLACIAN, dst=defect, borderType=cv2.BORDER_REPLICATE)
+    cv2.subtract(residual, defect, dst=defect)
+    return cv2.add(correction, cv2.multiply(defect, level.smoother, dst=defect), dst=correction)
+
+
+def solve_laplace_cg(values, known, guess, tol=TOLERANCE, max_iter=MAX_ITERATIONS, levels=None):
+    """
+    Solve the Laplace equation on the unknown pixels with the known pixels as Dirichlet data, by conjugate gradients.
+    All channels are solved together as one block-diagonal system.
+
+    :param values: (height, width, channels) float32 image, read on the known pixels only
+    :param known: 2D boolean mask of the known pixels
+    :param guess: (height, width, channels) initial guess, read on the unknown pixels only
+    :param tol: Relative residual at which the iteration stops
+    :param max_iter: Maximum number of iterations
+    :param levels: Multigrid hierarchy from build_levels to precondition with a V-cycle, or None for plain CG
+    :return: The solution (equal to values on the known pixels) and the number of iterations
+    """
+    known = known[..., None]
+    unknown = levels[0].unknown if levels is not None else np.broadcast_to(~known, values.shape).astype(np.float32)
+    u = np.where(known, values, guess).astype(np.float32)
+
+    # The right-hand side is what the known pixels contribute to their unknown neighbours, so the residual of the
+    # unknown pixels is minus the Laplacian of u on them
+    b = apply_laplacian(np.where(known, -values, 0).astype(np.float32), unknown)
+    residual = np.negative(apply_laplacian(u, unknown))
+    limit = tol ** 2 * float(np.vdot(b, b))
+
+    product = np.empty_like(u)
+    iterations = 0
+    rz = None
+    while iterations < max_iter and float(np.vdot(residual, residual)) > limit:
+        preconditioned = v_cycle(levels, residual) if levels is not None else residual
+        rz, previous_rz = float(np.vdot(residual, preconditioned)), rz
+        if previous_rz is None:
+            direction = preconditioned.copy()
+        else:
+            cv2.scaleAdd(direction, rz / previous_rz, preconditioned, dst=direction)
+        apply_laplacian(direction, unknown, dst=product)
+        alpha = rz / float(np.vdot(direction, product))
+        cv2.scaleAdd(direction, alpha, u, dst=u)
+        cv2.scaleAdd(product, -alpha, residual, dst=residual)
+        iterations += 1
+    return u, iterations
+
+
+def solve_laplace(values, known, tol=TOLERANCE, max_iter=MAX_ITERATIONS, cascade=True):
+    """
+    Homogeneous diffusion: fill the unknown pixels with the solution of the Laplace equation, with the known pixels
+    as Dirichlet data and reflecting image borders.
+
+    The equation is solved by conjugate gradients preconditioned with a multigrid V-cycle. With cascade, it is first
+    solved on the coarser grids of the hierarchy, from the coarsest (exactly) up, and every upsampled solution is the
+    initial guess on the next finer grid, which then only has to remove the fine-scale error.
+
+    :param values: (height, width, channels) image, read on the known pixels only
+    :param known: 2D boolean mask of the known pixels
+    :param tol: Relative residual at which conjugate gradients stops on every level
+    :param max_iter: Maximum number of conjugate gradient iterations on every level
+    :param cascade: Start from the coarse-to-fine initial guess instead of the mean of the known pixels
+    :return: (height, width, channels) float32 solution
+    """
+    values = np.asarray(values, dtype=np.float32)
+    if not known.any():
+        return np.zeros(values.shape, dtype=np.float32)
+
+    levels = build_levels(values, known)
+    u = None
+    for depth in range(len(levels) - 1 if cascade else 0, -1, -1):
+        level = levels[depth]
+        if u is None:
+            guess = np.broadcast_to(level.values[level.known].mean(axis=0), level.values.shape)
+        else:
+            guess = prolong(u, level.known.shape)
+        u = solve_laplace_cg(level.values, level.known, guess, tol, max_iter, levels[depth:])[0]
+    return u
+
+
+@stage()
+def reconstruct_with_diffusion(edge_image, pixel_data_restored, tol=TOLERANCE, max_iter=MAX_ITERATIONS):
+    """
+    Reconstruct the image by homogeneous diffusion from the pixel values sampled next to the edges.
+
+    :param edge_image: Binary edge map (1 for edge, 0 for non-edge), which gives the image size.
+    :param pixel_data_restored: Array of dequantized pixel values (n, 5) with (x, y, R, G, B).
+    :param tol: Relative residual at which the solver stops.
+    :param max_iter: Maximum number of solver iterations per level.
+    :return: Reconstructed image (BGR).
+    """
+    height, width = edge_image.shape
+    pixel_data_restored = np.asarray(pixel_data_restored, dtype=np.int64).reshape(-1, 5)
+    x, y = pixel_data_restored[:, 0], pixel_data_restored[:, 1]
+
+    known = np.zeros((height, width), dtype=bool)
+    known[x, y] = True
+    values = np.zeros((height, width, 3), dtype=np.float32)
+    values[x, y] = pixel_data_restored[:, :1:-1]  # B, G, R
+
+    reconstructed = solve_laplace(values, known, tol, max_iter)
+    return np.clip(np.rint(reconstructed), 0, 255).astype(np.uint8)
+
+
+@stage()
 def reconstruct_with_inpaint(edge_image, pixel_data_restored):
     """
     Reconstruct the image using OpenCV's inpainting based on known edge and pixel data.
@@ -18,11 +258,12 @@ def reconstruct_with_inpaint(edge_image, pixel_data_restored):
     height, width = edge_image.shape
 
     inpainted_image = np.zeros((height, width, 3), dtype=np.uint8)
+    pixel_data_restored = np.asarray(pixel_data_restored, dtype=np.int64).reshape(-1, 5)
+    x, y = pixel_data_restored[:, 0], pixel_data_restored[:, 1]
 
     mask = np.zeros((height, width), dtype=np.uint8)  # inpainting mask
-    for x, y, R, G, B in pixel_data_restored:
-        inpainted_image[x, y] = [B, G, R]
-        mask[x, y] = 255
+    inpainted_image[x, y] = pixel_data_restored[:, :1:-1]  # B, G, R
+    mask[x, y] = 255
     mask[edge_image == 1] = 255
     mask = 255 - mask
 
@@ -36,14 +277,9 @@ def reconstruct_with_inpaint(edge_image, pixel_data_restored):
 
 def deserialize_pixel_data(serialized_data):
     """
-    Deserialize binary data into a list of (x, y, R, G, B) tuples.
+    Deserialize 7-byte records (uint16 x and y, uint8 R, G and B) into an (n, 5) array of (x, y, R, G, B) rows.
     """
-    pixel_data = []
-    tuple_size = struct.calcsize("HHBBB")
-    for i in range(0, len(serialized_data), tuple_size):
-        x, y, R, G, B = struct.unpack("HHBBB", serialized_data[i:i + tuple_size])
-        pixel_data.append((x, y, R, G, B))
-    return pixel_data
+    return unpack_pixel_records(serialized_data)
 
 
 def decompress_with_paq(input_file, temp_file):
@@ -57,6 +293,17 @@ def decompress_with_paq(input_file, temp_file):
     os.rename(decompressed_file, temp_file)
 
 
+def decompress_with_backend(input_file, backend):
+    """
+    Decompress pixel values coded by an entropy backend of utils/entropy.py.
+    :param input_file: Path to the compressed file.
+    :param backend: Name of the sample backend.
+    :return: Array of (x, y, R, G, B) rows.
+    """
+    with open(input_file, "rb") as f:
+        return SAMPLE_BACKENDS[backend].decode(f.read())
+
+
 def display_pixel_data(pixel_data_restored, height, width):
     """
     Create an image from the pixel data and display it.
@@ -67,36 +314,44 @@ def display_pixel_data(pixel_data_restored, height, width):
     :return: Image created from pixel data.
     """
     pixel_image = np.zeros((height, width, 3), dtype=np.uint8)
+    pixel_data_restored = np.asarray(pixel_data_restored, dtype=np.int64).reshape(-1, 5)
+    x, y = pixel_data_restored[:, 0], pixel_data_restored[:, 1]
 
-    for x, y, R, G, B in pixel_data_restored:
-        if 0 <= x < height and 0 <= y < width:
-            pixel_image[x, y] = [B, G, R]
+    inside = (0 <= x) & (x < height) & (0 <= y) & (y < width)
+    pixel_image[x[inside], y[inside]] = pixel_data_restored[inside, :1:-1]  # B, G, R
 
     return pixel_image
 
 
 def main():
-    if len(sys.argv) != 4:
-        print("Usage: python3 decoder.py <contour_paq_file> <edge_pbm_file> <image_number>")
+    if len(sys.argv) not in (4, 5, 6):
+        print("Usage: python3 decoder.py <contour_paq_file> <edge_pbm_file> <image_number> [sample_backend] [q]")
         sys.exit(1)
 
     contour_paq_file = sys.argv[1]
     edge_pbm_file = sys.argv[2]
     image_number = sys.argv[3]
+    backend = sys.argv[4] if len(sys.argv) > 4 else "paq"
+    q = int(sys.argv[5]) if len(sys.argv) > 5 else 8  # as printed by decoder.py
 
     # loading the compressed pixel data
-    decompress_with_paq(contour_paq_file, "decompressed.bin")
-    with open("decompressed.bin", "rb") as f:
-        decompressed_data = f.read()
-    pixel_data_restored = np.array(deserialize_pixel_data(decompressed_data))
-    os.remove("decompressed.bin")
+    if backend == "paq":
+        decompress_with_paq(contour_paq_file, "decompressed.bin")
+        with open("decompressed.bin", "rb") as f:
+            decompressed_data = f.read()
+        pixel_data_restored = deserialize_pixel_data(decompressed_data)
+        os.remove("decompressed.bin")
+    else:
+        pixel_data_restored = decompress_with_backend(contour_paq_file, backend)
+
+    pixel_data_restored[:, 2:] = dequantize_pixel_values(pixel_data_restored[:, 2:], q)
 
     # loading edge map
     edge_image = cv2.imread(edge_pbm_file, cv2.IMREAD_GRAYSCALE)
     edge_image = (edge_image > 0).astype(np.uint8)
 
     # reconstruction
-    reconstructed_image = reconstruct_with_inpaint(edge_image, pixel_data_restored)
+    reconstructed_image = reconstruct_with_diffusion(edge_image, pixel_data_restored)
 
     output_dir = "reconstructed_images"
     os.makedirs(output_dir, exist_ok=True)
@@ -1,15 +1,57 @@
 #!/usr/bin/env python
 
 import argparse
+from concurrent.futures import ProcessPoolExecutor
+
 import numpy as np
 import skimage.io as io
 import matplotlib.pyplot as plt
 from skimage import color
 from skimage.util import img_as_ubyte
-from scipy.ndimage import gaussian_laplace
+from scipy.ndimage import gaussian_laplace, maximum_filter, minimum_filter
+
+try:
+    from utils.profiling import stage
+except ImportError:  # run as a script from the utils folder
+    from profiling import stage
+
+TRUNCATE = 4.0  # Radius of the Gaussian kernel in standard deviations (the scipy default)
+
+
+def find_zero_crossings(log_image):
+    """
+    Find the zero crossings of a LoG image in 3x3 neighborhoods.
+
+    Parameters:
+        log_image (ndarray): Thresholded Laplacian of Gaussian image.
+
+    Returns:
+        zero_crossing (ndarray): 255 where the 3x3 neighborhood holds both a negative and a positive value, 0 elsewhere.
+            The outermost rows and columns are never marked.
+    """
+    # A neighborhood holds values of both signs exactly when its minimum is negative and its maximum positive
+    crossing = (minimum_filter(log_image, size=3) < 0) & (maximum_filter(log_image, size=3) > 0)
+
+    zero_crossing = np.zeros_like(log_image, dtype=np.uint8)
+    zero_crossing[1:-1, 1:-1][crossing[1:-1, 1:-1]] = 255
+    return zero_crossing
 
 
-def marr_hildreth_edge_detection(img, sigma, threshold=0.01):
+def detect_tile(img, sigma, threshold):
+    """
+    Run the LoG, thresholding and zero crossing steps on a single image or tile.
+
+    Returns:
+        log_image (ndarray): Laplacian of Gaussian image.
+        zero_crossing (ndarray): Binary edge-detected image.
+    """
+    log_image = gaussian_laplace(img, sigma=sigma, truncate=TRUNCATE)
+    log_image[np.abs(log_image) < threshold] = 0
+    return log_image, find_zero_crossings(log_image)
+
+
+@stage()
+def marr_hildreth_edge_detection(img, sigma, threshold=0.01, tile_size=None, workers=None):
     """
     Perform Marr-Hildreth edge detection with adjustable sensitivity.
     
@@ -17,24 +59,38 @@ def marr_hildreth_edge_detection(img, sigma, threshold=0.01):
         img (ndarray): Grayscale input image.
         sigma (float): Sigma value for the Gaussian filter.
         threshold (float): Threshold for LoG values to reduce sensitivity.
+        tile_size (int): If given, the image is processed in square tiles of this size, each read with a halo wide
+            enough for the Gaussian kernel and the 3x3 neighborhood, so the result is identical to the whole image.
+        workers (int): Number of processes the tiles are spread across (all cores by default).
 
     Returns:
         log_image (ndarray): Laplacian of Gaussian image.
         zero_crossing (ndarray): Binary edge-detected image.
     """
-    # LoG step with thresholding
-    log_image = gaussian_laplace(img, sigma=sigma)
-    log_image[np.abs(log_image) < threshold] = 0
-
-    # computing zero crossings in 3x3 neighborhood
-    zero_crossing = np.zeros_like(log_image, dtype=np.uint8)
-    rows, cols = log_image.shape
-
-    for i in range(1, rows - 1):
-        for j in range(1, cols - 1):
-            patch = log_image[i - 1:i + 2, j - 1:j + 2]
-            if np.min(patch) < 0 < np.max(patch):
-                zero_crossing[i, j] = 255
+    if tile_size is None:
+        return detect_tile(img, sigma, threshold)
+
+    # Kernel radius used by gaussian_laplace, plus one pixel for the zero crossing neighborhood
+    halo = int(TRUNCATE * sigma + 0.5) + 1
+    rows, cols = img.shape
+    tiles = [(row, col) for row in range(0, rows, tile_size) for col in range(0, cols, tile_size)]
+
+    log_image = np.empty_like(img)  # gaussian_laplace keeps the dtype of its input
+    zero_crossing = np.zeros(img.shape, dtype=np.uint8)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = []
+        for row, col in tiles:
+            top, left = max(row - halo, 0), max(col - halo, 0)
+            bottom, right = min(row + tile_size + halo, rows), min(col + tile_size + halo, cols)
+            futures.append(pool.submit(detect_tile, img[top:bottom, left:right], sigma, threshold))
+
+        for (row, col), future in zip(tiles, futures):
+            tile_log, tile_crossing = future.result()
+            # Keep the core of the tile; the halo is only there to make it exact
+            top, left = row - max(row - halo, 0), col - max(col - halo, 0)
+            core = (slice(top, top + min(tile_size, rows - row)), slice(left, left + min(tile_size, cols - col)))
+            log_image[row:row + tile_size, col:col + tile_size] = tile_log[core]
+            zero_crossing[row:row + tile_size, col:col + tile_size] = tile_crossing[core]
 
     return log_image, zero_crossing
 
@@ -45,6 +101,8 @@ def main():
     parser.add_argument("--output", required=True, help="Path to the output edge-detected image.")
     parser.add_argument("--sigma", type=float, default=3.0, help="Sigma value for Gaussian filter.")
     parser.add_argument("--threshold", type=float, default=0.0005, help="Threshold for edge sensitivity.")
+    parser.add_argument("--tile-size", type=int, default=None, help="Process the image in tiles of this size.")
+    parser.add_argument("--workers", type=int, default=None, help="Number of processes for tiles (default: all cores).")
     args = parser.parse_args()
 
     # loading the input image
@@ -56,7 +114,7 @@ def main():
     if img.ndim == 3:
         img = color.rgb2gray(img)
 
-    log_image, edges = marr_hildreth_edge_detection(img, args.sigma, args.threshold)
+    log_image, edges = marr_hildreth_edge_detection(img, args.sigma, args.threshold, args.tile_size, args.workers)
 
     # Save the edge-detected image
     io.imsave(args.output, img_as_ubyte(edges))
@@ -0,0 +1,10 @@
+"""
+Stage instrumentation of the edge codec. The layer is instrumentation.py at the root of the repository, shared with the
+JPEG codec; see there for how stages are marked and traces recorded. Nothing is recorded unless a trace is active.
+"""
+import os
+import sys
+
+# Appended rather than prepended, so the root modules never shadow those of the edge codec
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", ".."))
+from instrumentation import aggregate_traces, read_traces, run_traced, stage, timed, tracing, write_trace
@@ -3,48 +3,78 @@ import os
 import sys
 import subprocess
 
+try:
+    from utils.entropy import EDGE_BACKENDS, LAYOUTS, SAMPLE_BACKENDS, read_pbm
+except ImportError:  # run as a script from the utils folder
+    from entropy import EDGE_BACKENDS, LAYOUTS, SAMPLE_BACKENDS, read_pbm
+
+MAGIC = b"EDGC"
+FORMAT_VERSION = 3
+# magic, version, edge backend id, sample backend id, sample layout id, quantization parameter, subsampling distance,
+# size of the edge data
+HEADER = struct.Struct("<4sBBBBBBI")
+
+
 def compress_with_jbig(input_file, output_file):
     subprocess.run(["pbmtojbg", input_file, output_file], check=True)
 
-def store_encoded_data(pbm_file, paq_file, output_file, q, d):
+def pack_encoded_data(edge_data, sample_data, edge_backend_id, sample_backend_id, layout_id=0, q=8, d=0):
+    """
+    Combine the coded edge map and pixel samples into the final encoded data.
+
+    :param edge_data: Edge map coded by the edge backend.
+    :param sample_data: Pixel samples coded by the sample backend.
+    :param edge_backend_id: Id of the edge backend (see utils/entropy.py).
+    :param sample_backend_id: Id of the sample backend (see utils/entropy.py).
+    :param layout_id: Id of the sample layout (see utils/entropy.py).
+    :param q: Quantization parameter, the number of bits of the stored colours (8 for unquantized colours).
+    :param d: Sampling distance, which the compact layout needs to find the sample positions again.
+    :return: Header, edge data and sample data.
     """
-    Combine JBIG data, PAQ data, and metadata into the final encoded file.
+    if not 1 <= q <= 8:
+        raise ValueError("The quantization parameter must be between 1 and 8 bits.")
+    if not 0 <= d <= 255:
+        raise ValueError("The sampling distance must fit in a byte.")
+    header = HEADER.pack(MAGIC, FORMAT_VERSION, edge_backend_id, sample_backend_id, layout_id, q, d, len(edge_data))
+    return header + edge_data + sample_data
+
+
+def store_encoded_data(pbm_file, paq_file, output_file, q, d, edge_backend="jbig", sample_backend="paq"):
+    """
+    Combine the coded edge map, the coded pixel values, and metadata into the final encoded file.
     
-    :param jbig_file: Path to the JBIG-encoded contour file.
-    :param paq_file: Path to the PAQ-compressed pixel values file.
+    :param pbm_file: Path to the PBM edge map.
+    :param paq_file: Path to the pixel values coded by the sample backend (PAQ-compressed by default).
     :param output_file: Path to the final output encoded file.
     :param q: Quantization parameter.
     :param d: Sampling distance.
-    :param channels: Number of color channels (1 for grayscale, 3 for RGB).
+    :param edge_backend: Name of the edge backend.
+    :param sample_backend: Name of the backend that coded the pixel values.
     """
 
-    jbig_file = os.path.splitext(pbm_file)[0] + ".jbg"
-    compress_with_jbig(pbm_file, jbig_file)
+    if edge_backend == "jbig":
+        jbig_file = os.path.splitext(pbm_file)[0] + ".jbg"
+        compress_with_jbig(pbm_file, jbig_file)
+        with open(jbig_file, "rb") as f:
+            edge_data = f.read()
+    else:
+        with open(pbm_file, "rb") as f:
+            edge_data = EDGE_BACKENDS[edge_backend].encode(read_pbm(f.read()))
 
-    # read JBIG and PAQ data
-    with open(jbig_file, "rb") as f:
-        jbig_data = f.read()
-    
     with open(paq_file, "rb") as f:
-        paq_data = f.read()
+        sample_data = f.read()
 
     with open(output_file, "wb") as f:
-        # metadata
-        # f.write(struct.pack("B", d))             # subsampling parameter (1 byte)    
-        # f.write(struct.pack("B", q))             # quantization parameter (1 byte)        
-        f.write(struct.pack("I", len(jbig_data)))  # Size of JBIG data (4 bytes)
-        
-        # JBIG data
-        f.write(jbig_data)                
-        f.write(paq_data)
+        f.write(pack_encoded_data(edge_data, sample_data, EDGE_BACKENDS[edge_backend].id,
+                                  SAMPLE_BACKENDS[sample_backend].id, LAYOUTS["records"], q, d))
 
     print(f"Encoded data stored in {output_file}")
 
 
 def main():
     
-    if len(sys.argv) != 6:
-        print("Usage: python storage.py <jbig_file> <paq_file> <output_file> <q> <d>")
+    if len(sys.argv) not in (6, 7, 8):
+        print("Usage: python storage.py <jbig_file> <paq_file> <output_file> <q> <d> [edge_backend] [sample_backend]")
         sys.exit(1)
 
     jbig_path = sys.argv[1]
@@ -52,8 +82,10 @@ def main():
     out_path = sys.argv[3]
     q = int(sys.argv[4])
     d = int(sys.argv[5])
+    edge_backend = sys.argv[6] if len(sys.argv) > 6 else "jbig"
+    sample_backend = sys.argv[7] if len(sys.argv) > 7 else "paq"
     
-    store_encoded_data(jbig_path, paq_path, out_path, q, d)
+    store_encoded_data(jbig_path, paq_path, out_path, q, d, edge_backend, sample_backend)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
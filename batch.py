@@ -0,0 +1,217 @@
+"""
+Parallel batch compression of a dataset over a range of quality factors.
+
+Every (image, Q) pair is a job, and the jobs of an image are run together so the image is only transformed once.
+These tasks are sharded across a process pool with a bounded number in flight, and their results are written in job
+order by a single writer. Jobs already present in the results file (with their .bin file on disk) are skipped, so an
+interrupted run can simply be started again.
+
+With --cache, compressed files are also kept in a content-addressed cache (see cache.py), so the same image at the same
+quality factor is never compressed twice, whatever its path or results file.
+
+With --trace, every image also gets a per-stage timing record (see instrumentation.py), appended to a JSON lines file.
+
+Usage: python batch.py <dataset_path> [--colour] [--subsampling 4:2:0] [--quality START STOP STEP] [--workers N]
+                       [--compressed-folder compressed] [--results results.csv] [--trace traces.jsonl] [--trace-memory]
+                       [--cache codec_cache]
+"""
+import argparse
+import csv
+import os
+from collections import deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+
+from cache import CodecCache
+from codec import calculate_bpp, calculate_relative_rmse, jpeg_compress_sweep, jpeg_decompress, read_image
+from container import SUBSAMPLING_MODES
+from instrumentation import run_traced, write_trace
+
+RESULT_COLUMNS = ["Category", "Image", "Quality", "RMSE", "BPP"]
+
+Job = namedtuple("Job", ["category", "img_name", "img_path", "idx", "Q", "compressed_file"])
+
+
+def select_images(dataset_path, positions=(9, 19)):
+    """
+    Takes as argument the path to a dataset with one folder per category and returns a list of
+    (category, img_name, img_path, idx) tuples for the images at the given positions of each sorted folder
+    (images 10 and 20 by default). idx numbers the selected images of a category from 1.
+    """
+    selected = []
+    for category in sorted(os.listdir(dataset_path)):
+        category_path = os.path.join(dataset_path, category)
+        if not os.path.isdir(category_path):
+            continue
+
+        images = sorted(os.listdir(category_path))
+        for idx, position in enumerate(positions, start=1):
+            if position < len(images):
+                img_name = images[position]
+                selected.append((category, img_name, os.path.join(category_path, img_name), idx))
+    return selected
+
+
+def make_jobs(images, quality_factors, compressed_folder):
+    """
+    Takes as argument the selected images and the list of quality factors and returns one job per (image, Q) pair
+    """
+    return [Job(category, img_name, img_path, idx, Q, os.path.join(compressed_folder, f"{category}_{img_name}_Q{Q}.bin"))
+            for category, img_name, img_path, idx in images
+            for Q in quality_factors]
+
+
+def run_sweep(jobs, colour=False, subsampling="4:2:0", cache_dir=None):
+    """
+    Compresses and decompresses the image shared by the given jobs at each of their quality factors and returns
+    the (rmse, bpp) of every job. The image is transformed once for the whole sweep.
+    If a cache folder is given, the .bin files found there are copied instead of compressed again, and the new ones
+    are added to it.
+    """
+    cache = CodecCache(cache_dir, memory_budget=0) if cache_dir else None
+    params = dict(colour=colour, subsampling=subsampling)
+
+    # Write to temporary files first so that an interrupted job never leaves a truncated .bin behind
+    todo = [job for job in jobs
+            if cache is None or cache.lookup(job.img_path, job.Q, job.compressed_file + ".part", **params) is None]
+    if todo:
+        jpeg_compress_sweep(todo[0].img_path, [job.Q for job in todo], [job.compressed_file + ".part" for job in todo],
+                            colour, subsampling)
+    for job in jobs:
+        if cache is not None and job in todo:
+            cache.store(job.img_path, job.Q, job.compressed_file + ".part", **params)
+        os.replace(job.compressed_file + ".part", job.compressed_file)
+
+    original = read_image(jobs[0].img_path, colour)
+    metrics = []
+    for job in jobs:
+        decompressed_image = jpeg_decompress(job.compressed_file)
+        rmse = calculate_relative_rmse(original, decompressed_image)
+        bpp = calculate_bpp(job.compressed_file, original.shape[:2])
+        metrics.append((rmse, bpp))
+    return metrics
+
+
+def group_by_image(jobs):
+    """
+    Splits the list of jobs into lists of consecutive jobs on the same image
+    """
+    groups = []
+    for job in jobs:
+        if groups and groups[-1][0].img_path == job.img_path:
+            groups[-1].append(job)
+        else:
+            groups.append([job])
+    return groups
+
+
+def read_completed(results_file):
+    """
+    Returns a dictionary mapping the (category, img_name, Q) key of every job already in the results file to its (rmse, bpp)
+    """
+    if not os.path.exists(results_file):
+        return {}
+
+    with open(results_file, newline="") as file:
+        return {(row["Category"], row["Image"], int(row["Quality"])): (float(row["RMSE"]), float(row["BPP"]))
+                for row in csv.DictReader(file)}
+
+
+def run_batch(jobs, results_file, colour=False, workers=None, max_in_flight=None, subsampling="4:2:0",
+              trace_file=None, trace_memory=False, cache_dir=None):
+    """
+    Runs the jobs across a pool of worker processes and appends one row per finished job to the results CSV.
+    The jobs of each image form a single task, so that the image is only transformed once for all its quality factors.
+    At most max_in_flight tasks (twice the number of workers by default) are submitted at any time, and rows are
+    written in job order. Jobs already in the results file whose .bin file exists are skipped.
+    If trace_file is given, the stage trace of every task (with memory counts if trace_memory is set) is appended to it.
+    If cache_dir is given, compressed files are looked up in and added to the content-addressed cache in that folder.
+    Returns the (rmse, bpp, Q, img_name, category, idx) tuples of all jobs, in job order.
+    """
+    workers = workers or os.cpu_count()
+    max_in_flight = max_in_flight or 2 * workers
+    completed = read_completed(results_file)
+
+    results = []
+    new_file = not os.path.exists(results_file)
+    with open(results_file, mode="a", newline="") as file, \
+            open(trace_file, mode="a") if trace_file else nullcontext() as traces, \
+            ProcessPoolExecutor(max_workers=workers) as pool:
+        writer = csv.writer(file)
+        if new_file:
+            writer.writerow(RESULT_COLUMNS)
+
+        pending = deque()  # (jobs of one image, metrics of the jobs already done, future) in submission order
+
+        def submit(todo):
+            if not traces:
+                return pool.submit(run_sweep, todo, colour, subsampling, cache_dir)
+            fields = {"image": todo[0].img_path, "quality": [job.Q for job in todo]}
+            return pool.submit(run_traced, run_sweep, fields, todo, colour, subsampling, cache_dir,
+                               memory=trace_memory)
+
+        def collect_oldest():
+            group, done, future = pending.popleft()
+            metrics = future.result() if future else []
+            if future and traces:
+                metrics, record = metrics
+                write_trace(traces, record)
+            new_metrics = iter(metrics)
+            for job in group:
+                if job in done:
+                    rmse, bpp = done[job]
+                else:
+                    rmse, bpp = next(new_metrics)
+                    writer.writerow([job.category, job.img_name, job.Q, rmse, bpp])
+                results.append((rmse, bpp, job.Q, job.img_name, job.category, job.idx))
+            file.flush()  # Every written row is a finished job, even if the run is interrupted
+
+        for group in group_by_image(jobs):
+            done = {job: completed[(job.category, job.img_name, job.Q)] for job in group
+                    if (job.category, job.img_name, job.Q) in completed and os.path.exists(job.compressed_file)}
+            todo = [job for job in group if job not in done]
+
+            if len(pending) >= max_in_flight:
+                collect_oldest()
+            pending.append((group, done, submit(todo) if todo else None))
+
+        while pending:
+            collect_oldest()
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compress a dataset in parallel over a range of quality factors")
+    parser.add_argument("dataset_path", help="Dataset folder with one subfolder of images per category.")
+    parser.add_argument("--colour", action="store_true", help="Compress RGB images instead of grayscale.")
+    parser.add_argument("--subsampling", choices=SUBSAMPLING_MODES, default="4:2:0",
+                        help="Chroma subsampling of colour images (default: 4:2:0).")
+    parser.add_argument("--quality", type=int, nargs=3, default=[36, 75, 2], metavar=("START", "STOP", "STEP"),
+                        help="Range of quality factors (default: 36 75 2).")
+    parser.add_argument("--workers", type=int, default=None, help="Number of worker processes (default: all cores).")
+    parser.add_argument("--compressed-folder", default=None,
+                        help="Folder for the .bin files (default: compressed, or compressed_colour with --colour).")
+    parser.add_argument("--results", default=None,
+                        help="Results CSV (default: results.csv, or colour_results.csv with --colour).")
+    parser.add_argument("--trace", default=None, help="JSON lines file to append the stage trace of every image to.")
+    parser.add_argument("--trace-memory", action="store_true", help="Count the memory of every stage in the traces.")
+    parser.add_argument("--cache", default=None,
+                        help="Folder of a content-addressed cache of compressed files shared between runs.")
+    args = parser.parse_args()
+
+    compressed_folder = args.compressed_folder or ("compressed_colour" if args.colour else "compressed")
+    results_file = args.results or ("colour_results.csv" if args.colour else "results.csv")
+    os.makedirs(compressed_folder, exist_ok=True)
+
+    jobs = make_jobs(select_images(args.dataset_path), list(range(*args.quality)), compressed_folder)
+    if args.cache:
+        # Entries of other codec versions can never be hit again
+        CodecCache(args.cache).prune()
+    results = run_batch(jobs, results_file, args.colour, args.workers, subsampling=args.subsampling,
+                        trace_file=args.trace, trace_memory=args.trace_memory, cache_dir=args.cache)
+    print(f"{len(results)} jobs done, results in {results_file}")
+
+
+if __name__ == "__main__":
+    main()
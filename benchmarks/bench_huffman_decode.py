@@ -0,0 +1,79 @@
+"""
+Throughput benchmark of huffman.decode_huffman against the original bit-by-bit string decoder.
+
+Usage: python benchmarks/bench_huffman_decode.py [--bits 1e6 1e7 1e8] [--reference-limit 1e7]
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from huffman import decode_huffman, encode_huffman, generate_huffman_tree
+
+
+def decode_huffman_reference(encoded_string, huffman_dict):
+    """
+    The original decoder: walks the bitarray one bit at a time and looks the growing string up in a dict.
+    """
+    reverse_dict = {code.to01(): symbol for symbol, code in huffman_dict.items()}
+
+    decoded_symbols = []
+    buffer = ""
+    for bit in encoded_string:
+        buffer += str(bit)
+        if buffer in reverse_dict:
+            decoded_symbols.append(reverse_dict[buffer])
+            buffer = ""
+
+    return decoded_symbols
+
+
+def make_stream(n_bits, seed=0):
+    """
+    Returns a Huffman-encoded bitarray of roughly n_bits bits along with its dictionary and source symbols.
+    Symbols follow a two-sided geometric distribution, similar to quantized DCT coefficients and zero-run counts.
+    """
+    rng = np.random.default_rng(seed)
+    # Build the table from a small sample, then tile encoded sample until the target size is reached
+    sample = (rng.geometric(0.3, 100_000) * rng.choice([-1, 1], 100_000)).tolist()
+    huffman_dict = generate_huffman_tree(sample).traverse()
+    encoded_sample = encode_huffman(sample, huffman_dict)
+
+    repeats = max(1, int(round(n_bits / len(encoded_sample))))
+    return encoded_sample * repeats, huffman_dict, len(sample) * repeats
+
+
+def time_call(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return time.perf_counter() - start, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Huffman decode throughput benchmark")
+    parser.add_argument("--bits", type=float, nargs="+", default=[1e6, 1e7, 1e8], help="Encoded stream sizes in bits.")
+    parser.add_argument("--reference-limit", type=float, default=1e7,
+                        help="Largest stream the original decoder is run on (it is very slow).")
+    args = parser.parse_args()
+
+    print(f"{'bits':>12} {'symbols':>12} {'decoder':>10} {'seconds':>10} {'Mbit/s':>10} {'speedup':>8}")
+    for n_bits in args.bits:
+        encoded, huffman_dict, n_symbols = make_stream(int(n_bits))
+
+        fast_time, decoded = time_call(decode_huffman, encoded, huffman_dict)
+        assert len(decoded) == n_symbols
+        print(f"{len(encoded):>12} {n_symbols:>12} {'tree':>10} {fast_time:>10.3f} "
+              f"{len(encoded) / fast_time / 1e6:>10.1f} {'':>8}")
+
+        if n_bits <= args.reference_limit:
+            reference_time, reference = time_call(decode_huffman_reference, encoded, huffman_dict)
+            assert np.array_equal(decoded, reference)
+            print(f"{len(encoded):>12} {n_symbols:>12} {'original':>10} {reference_time:>10.3f} "
+                  f"{len(encoded) / reference_time / 1e6:>10.1f} {reference_time / fast_time:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
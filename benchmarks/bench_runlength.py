@@ -0,0 +1,113 @@
+"""
+Throughput benchmark of the vectorized run-length coder (codec.runlength_encode_blocks and codec.decode_runlength)
+against the original element-by-element loops.
+
+Usage: python benchmarks/bench_runlength.py [--coefficients 1e5 1e6 1e7] [--reference-limit 1e7] [--Q 50]
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from blocks import forward_transform
+from codec import decode_runlength, runlength_encode_blocks
+
+
+def encode_runlength_reference(array):
+    """
+    The original encoder: walks the block one coefficient at a time and counts the zeros of each run.
+    """
+    encoded = []
+    counter = 0
+    for element in array:
+        if element == 0:
+            counter += 1
+        else:
+            if counter != 0:
+                encoded.extend([0, counter])
+                counter = 0
+            encoded.append(element)
+
+    if counter != 0:
+        encoded.extend([0, counter])
+    return encoded
+
+
+def decode_runlength_reference(array):
+    """
+    The original decoder: expands every run into a list of zeros before converting the result to an array.
+    """
+    decoded = []
+    index = 0
+    while index < len(array):
+        if array[index] == 0:
+            decoded.extend([0] * array[index + 1])
+            index += 2
+        else:
+            decoded.append(array[index])
+            index += 1
+    return np.array(decoded)
+
+
+def make_blocks(n_coefficients, Q, seed=0):
+    """
+    Returns an (N, 64) array of quantized coefficients in zigzag order with about n_coefficients coefficients,
+    taken from a smooth random image so that the runs of zeros look like those of natural images.
+    """
+    rng = np.random.default_rng(seed)
+    side = max(8, int(np.sqrt(n_coefficients)) // 8 * 8)
+    noise = rng.normal(0, 1, (side, side))
+    image = np.cumsum(np.cumsum(noise, axis=0), axis=1)  # Brownian surface, most energy at low frequencies
+    image = (image - image.min()) / (np.ptp(image) or 1) * 200 + rng.normal(0, 4, (side, side)) + 28
+    return forward_transform(np.clip(image, 0, 255), Q)[0]
+
+
+def time_call(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return time.perf_counter() - start, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run-length coding throughput benchmark")
+    parser.add_argument("--coefficients", type=float, nargs="+", default=[1e5, 1e6, 1e7],
+                        help="Number of coefficients to encode.")
+    parser.add_argument("--reference-limit", type=float, default=1e7,
+                        help="Largest input the original loops are run on (they are slow).")
+    parser.add_argument("--Q", type=int, default=50, help="Quality factor used to quantize the coefficients.")
+    args = parser.parse_args()
+
+    print(f"{'coefficients':>12} {'symbols':>10} {'coder':>10} {'encode s':>10} {'decode s':>10} "
+          f"{'Mcoef/s':>10} {'speedup':>8}")
+    for n_coefficients in args.coefficients:
+        ordered_blocks = make_blocks(int(n_coefficients), args.Q)
+        size = ordered_blocks.size
+
+        encode_time, symbols = time_call(runlength_encode_blocks, ordered_blocks)
+        decode_time, decoded = time_call(decode_runlength, symbols)
+        assert np.array_equal(decoded, ordered_blocks.ravel())
+        fast_time = encode_time + decode_time
+        print(f"{size:>12} {len(symbols):>10} {'numpy':>10} {encode_time:>10.3f} {decode_time:>10.3f} "
+              f"{size / fast_time / 1e6:>10.1f} {'':>8}")
+
+        if n_coefficients <= args.reference_limit:
+            def encode_reference(blocks):
+                stream = []
+                for ordered_block in blocks:
+                    stream.extend(encode_runlength_reference(ordered_block))
+                return stream
+
+            reference_encode_time, reference_symbols = time_call(encode_reference, ordered_blocks)
+            reference_decode_time, _ = time_call(decode_runlength_reference, reference_symbols)
+            assert np.array_equal(symbols, reference_symbols)
+            reference_time = reference_encode_time + reference_decode_time
+            print(f"{size:>12} {len(symbols):>10} {'original':>10} {reference_encode_time:>10.3f} "
+                  f"{reference_decode_time:>10.3f} {size / reference_time / 1e6:>10.1f} "
+                  f"{reference_time / fast_time:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
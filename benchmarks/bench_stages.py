@@ -0,0 +1,281 @@
+"""
+Per-stage benchmark and regression check of the hot paths of both codecs, on synthetic images and the images bundled
+with the edge codec (Research_paper/homogeneous_diffusion/images).
+
+Stages, each timed on its own with the output of the previous ones as input:
+    dct+quantize      blocks.forward_transform of the grayscale image
+    rle-encode        codec.runlength_encode_blocks
+    rle-decode        codec.decode_runlength
+    huffman-build     huffman.SymbolHistogram and the Huffman table
+    huffman-encode    huffman.encode_huffman
+    huffman-decode    huffman.decode_huffman
+    marr-hildreth     edge detection of the edge codec
+    contour-sampling  quantized pixel samples next to the edges
+    container         in-process entropy backends, header packing and unpacking, and back
+    container-ext     the same through the external coders (JBIG and PAQ)
+    reconstruction    homogeneous diffusion from the dequantized samples
+
+Every stage reports its throughput in megapixels of the source image per second (best of --repeat runs) and its peak
+Python heap memory (tracemalloc, which numpy reports to, on one extra run). When the external coders are not on the
+PATH, stand-ins that keep their command lines are used, so the suite runs offline. Their times say nothing about the
+real coders, so the baseline records which tools were stand-ins and container-ext is only compared when they match.
+
+--save-baseline writes the results to a JSON file. --baseline compares the results with one, and the script exits
+with status 1 when a stage is slower, or needs more memory, than the baseline by more than --threshold.
+
+Usage: python benchmarks/bench_stages.py [--synthetic 256 512] [--no-images] [--repeat 3] [--Q 50] [--q 4] [--d 3]
+                                         [--save-baseline baseline.json] [--baseline baseline.json] [--threshold 0.25]
+"""
+import argparse
+import glob
+import json
+import os
+import shutil
+import stat
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import cv2
+import numpy as np
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+EDGE_CODEC = os.path.join(ROOT, "Research_paper", "homogeneous_diffusion")
+sys.path.insert(0, ROOT)
+sys.path.insert(0, EDGE_CODEC)
+from blocks import forward_transform
+from codec import decode_runlength, runlength_encode_blocks
+from huffman import SymbolHistogram, decode_huffman, encode_huffman
+from edge_codec import detect_edges
+from utils.contours import dequantize_pixel_values, encode_contour_pixel_values
+from utils.decoder import unpack_encoded_data
+from utils.entropy import EDGE_BACKENDS, LAYOUTS, SAMPLE_BACKENDS
+from utils.homogeneous_diffusion import reconstruct_with_diffusion
+from utils.storage import pack_encoded_data
+
+# Stand-ins for the external coders, with the same command lines: zlib for JBIG, LZMA (plus the stored file name,
+# which PAQ restores on decompression) for PAQ
+STUB_TOOLS = {
+    "pbmtojbg": """
+import sys, zlib
+with open(sys.argv[1], "rb") as source, open(sys.argv[2], "wb") as target:
+    target.write(zlib.compress(source.read()))
+""",
+    "jbgtopbm": """
+import sys, zlib
+with open(sys.argv[1], "rb") as source, open(sys.argv[2], "wb") as target:
+    target.write(zlib.decompress(source.read()))
+""",
+    "paq8o6_64": """
+import lzma, os, sys
+if sys.argv[1] == "-d":
+    with open(sys.argv[2], "rb") as source:
+        name, data = source.read().split(b"\\n", 1)
+    with open(os.path.join(os.path.dirname(sys.argv[2]), name.decode()), "wb") as target:
+        target.write(lzma.decompress(data))
+else:
+    with open(sys.argv[1], "rb") as source, open(sys.argv[1] + ".paq8o6", "wb") as target:
+        target.write(os.path.basename(sys.argv[1]).encode() + b"\\n" + lzma.compress(source.read()))
+""",
+}
+
+
+def install_stub_tools(folder):
+    """
+    Writes a stand-in for every external coder missing from the PATH into folder, puts folder first on the PATH and
+    returns the names of the stand-ins.
+    """
+    stubbed = sorted(tool for tool in STUB_TOOLS if shutil.which(tool) is None)
+    for tool in stubbed:
+        path = os.path.join(folder, tool)
+        with open(path, "w") as f:
+            f.write(f"#!{sys.executable}" + STUB_TOOLS[tool])
+        os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+    if stubbed:
+        os.environ["PATH"] = folder + os.pathsep + os.environ["PATH"]
+    return stubbed
+
+
+def make_image(side, seed=0):
+    """
+    Returns a side x side RGB image: a smooth Brownian surface per channel, as in the other benchmarks, with a few
+    flat rectangles pasted on so that the edge codec finds sharp edges as well.
+    """
+    rng = np.random.default_rng(seed)
+    surface = np.cumsum(np.cumsum(rng.normal(0, 1, (side, side, 3)), axis=0), axis=1)
+    surface -= surface.min(axis=(0, 1))
+    image = surface / np.maximum(np.ptp(surface, axis=(0, 1)), 1) * 200 + 28
+    for _ in range(8):
+        top, left = rng.integers(0, side, 2)
+        height, width = rng.integers(side // 16, side // 4, 2)
+        image[top:top + height, left:left + width] = rng.integers(0, 256, 3)
+    return np.clip(image, 0, 255).astype(np.uint8)
+
+
+def measure(repeat, function, *args):
+    """
+    Returns the best time of function(*args) over repeat runs, its peak traced memory in bytes on one more run,
+    and its result. Tracing slows pure Python code down, so the timed runs are not traced.
+    """
+    seconds = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function(*args)
+        seconds = min(seconds, time.perf_counter() - start)
+
+    tracemalloc.start()
+    try:
+        function(*args)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return seconds, peak, result
+
+
+def build_huffman_table(symbols):
+    histogram = SymbolHistogram()
+    histogram.update(symbols)
+    return histogram.huffman_tree().traverse()
+
+
+def container_round_trip(edges, samples, q, d, edge_backend, sample_backend):
+    """
+    Entropy codes the edge map and the compact-layout samples, packs them with their header and unpacks and decodes
+    them again, as edge_codec.compress and edge_codec.decompress do.
+    """
+    edge_coder, sample_coder = EDGE_BACKENDS[edge_backend], SAMPLE_BACKENDS[sample_backend]
+    data = pack_encoded_data(edge_coder.encode(edges), sample_coder.encode(samples, None, "compact"), edge_coder.id,
+                             sample_coder.id, LAYOUTS["compact"], q, d)
+    encoded = unpack_encoded_data(data)
+    return (edge_coder.decode(encoded.edge_data), sample_coder.decode(encoded.sample_data, None, "compact"))
+
+
+def run_stages(image, args):
+    """
+    Runs every stage on an RGB image and returns a dictionary of stage name to (seconds, peak bytes).
+    """
+    timings = {}
+
+    def stage(name, function, *stage_args):
+        seconds, peak, result = measure(args.repeat, function, *stage_args)
+        timings[name] = (seconds, peak)
+        return result
+
+    gray = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
+    ordered_blocks, _ = stage("dct+quantize", forward_transform, gray, args.Q)
+    symbols = stage("rle-encode", runlength_encode_blocks, ordered_blocks)
+    decoded = stage("rle-decode", decode_runlength, symbols)
+    assert np.array_equal(decoded, ordered_blocks.ravel()), "run-length coding does not round-trip"
+    huffman_dict = stage("huffman-build", build_huffman_table, symbols)
+    stream = stage("huffman-encode", encode_huffman, symbols.tolist(), huffman_dict)
+    decoded = stage("huffman-decode", decode_huffman, stream, huffman_dict)
+    assert np.array_equal(decoded, symbols), "Huffman coding does not round-trip"
+
+    edges = stage("marr-hildreth", detect_edges, image)
+    pixel_data = stage("contour-sampling", encode_contour_pixel_values, image, edges, args.q, args.d)
+    for name, backends in (("container", ("context", "lzma")), ("container-ext", ("jbig", "paq"))):
+        decoded_edges, samples = stage(name, container_round_trip, edges, pixel_data[:, 2:], args.q, args.d,
+                                       *backends)
+        assert np.array_equal(decoded_edges, edges) and np.array_equal(samples, pixel_data[:, 2:]), \
+            f"{name} does not round-trip"
+
+    pixel_data[:, 2:] = dequantize_pixel_values(pixel_data[:, 2:], args.q)
+    stage("reconstruction", reconstruct_with_diffusion, edges, pixel_data)
+    return timings
+
+
+def compare(results, baseline, threshold):
+    """
+    Prints the change of every stage against the baseline and returns the stages that regressed by more than
+    threshold, in throughput or in peak memory.
+    """
+    regressions = []
+    print(f"\n{'stage':<18} {'MP/s':>9} {'baseline':>9} {'change':>8} {'peak MB':>9} {'baseline':>9} {'change':>8}")
+    for name, result in results["stages"].items():
+        if name not in baseline["stages"]:
+            continue
+        if name == "container-ext" and results["stub_tools"] != baseline["stub_tools"]:
+            print(f"{name:<18} skipped, the baseline was measured with other stand-ins for the external coders")
+            continue
+        reference = baseline["stages"][name]
+        speed = result["mpixels_per_s"] / reference["mpixels_per_s"] - 1
+        # Peaks below a megabyte are noise, so memory growth is relative to at least that
+        memory = (result["peak_mb"] - reference["peak_mb"]) / max(reference["peak_mb"], 1)
+        regressed = speed < -threshold or memory > threshold
+        print(f"{name:<18} {result['mpixels_per_s']:>9.2f} {reference['mpixels_per_s']:>9.2f} {speed:>+8.0%} "
+              f"{result['peak_mb']:>9.1f} {reference['peak_mb']:>9.1f} {memory:>+8.0%}"
+              f"{'  REGRESSION' if regressed else ''}")
+        if regressed:
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    default_images = sorted(glob.glob(os.path.join(EDGE_CODEC, "images", "*.png")))
+    parser = argparse.ArgumentParser(description="Per-stage codec benchmark and regression check")
+    parser.add_argument("images", nargs="*", default=default_images, help="Images to run the stages on.")
+    parser.add_argument("--no-images", action="store_true", help="Run on the synthetic images only.")
+    parser.add_argument("--synthetic", type=int, nargs="*", default=[256, 512], help="Sides of synthetic images.")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per stage, the best time is reported.")
+    parser.add_argument("--Q", type=int, default=50, help="Quality factor of the JPEG stages.")
+    parser.add_argument("--q", type=int, default=4, help="Quantization parameter of the edge codec.")
+    parser.add_argument("--d", type=int, default=3, help="Subsampling distance of the edge codec.")
+    parser.add_argument("--save-baseline", help="JSON file to save the results to.")
+    parser.add_argument("--baseline", help="JSON file of earlier results to compare with.")
+    parser.add_argument("--threshold", type=float, default=0.25,
+                        help="Relative loss of throughput or growth of peak memory counted as a regression.")
+    args = parser.parse_args()
+
+    sources = [(f"synthetic-{side}", make_image(side, seed)) for seed, side in enumerate(args.synthetic)]
+    if not args.no_images:
+        sources += [(os.path.basename(path), cv2.cvtColor(cv2.imread(path), cv2.COLOR_BGR2RGB))
+                    for path in args.images]
+    if not sources:
+        parser.error("no images to run on")
+
+    with tempfile.TemporaryDirectory() as stub_folder:
+        stub_tools = install_stub_tools(stub_folder)
+        if stub_tools:
+            print(f"Using stand-ins for {', '.join(stub_tools)}: external tools not on the PATH.")
+
+        print(f"{'image':<16} {'stage':<18} {'seconds':>9} {'MP/s':>9} {'peak MB':>9}")
+        totals = {}
+        for name, image in sources:
+            mpixels = image.shape[0] * image.shape[1] / 1e6
+            for stage, (seconds, peak) in run_stages(image, args).items():
+                print(f"{name:<16} {stage:<18} {seconds:>9.4f} {mpixels / seconds:>9.2f} {peak / 1e6:>9.1f}")
+                total = totals.setdefault(stage, [0.0, 0.0, 0])
+                total[0] += mpixels
+                total[1] += seconds
+                total[2] = max(total[2], peak)
+
+    results = {
+        "images": [name for name, _ in sources],
+        "settings": {"Q": args.Q, "q": args.q, "d": args.d},
+        "stub_tools": stub_tools,
+        "stages": {stage: {"mpixels_per_s": mpixels / seconds, "peak_mb": peak / 1e6}
+                   for stage, (mpixels, seconds, peak) in totals.items()},
+    }
+    print(f"\n{'stage':<18} {'MP/s':>9} {'peak MB':>9}")
+    for stage, result in results["stages"].items():
+        print(f"{stage:<18} {result['mpixels_per_s']:>9.2f} {result['peak_mb']:>9.1f}")
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Saved the baseline to {args.save_baseline}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline["images"] != results["images"] or baseline["settings"] != results["settings"]:
+            sys.exit("The baseline was measured on other images or with other settings.")
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            sys.exit(f"Regressed by more than {args.threshold:.0%}: {', '.join(regressions)}")
+        print(f"No stage regressed by more than {args.threshold:.0%}.")
+
+
+if __name__ == "__main__":
+    main()
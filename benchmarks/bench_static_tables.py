@@ -0,0 +1,98 @@
+"""
+Speed and size benchmark of the built-in static Huffman tables (huffman_tables.py) against the tables built for and
+stored with every image.
+
+The images are shrunk to --size (300x200 by default, the size of most Caltech-101 images) so that the stored tables
+weigh as much as they do on that dataset. The built-in tables were trained on the bundled images, so --synthetic adds
+images the tables have never seen. Both modes decode to the same pixels, which is checked for every file.
+
+Usage: python benchmarks/bench_static_tables.py [images ...] [--size 300 200] [--quality 20 50 80] [--grayscale]
+                                                [--synthetic 2] [--repeat 5]
+"""
+import argparse
+import glob
+import os
+import sys
+import tempfile
+import time
+
+import cv2
+import numpy as np
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from bench_stages import make_image
+from codec import compress_transformed, jpeg_decompress, transform_image
+from huffman_tables import PLANE_KINDS, select_table
+
+DEFAULT_IMAGES = sorted(glob.glob(os.path.join(ROOT, "Research_paper", "homogeneous_diffusion", "images", "*.png")))
+
+
+def best_time(repeat, function, *args):
+    """
+    Returns the shortest wall time of repeat calls of function(*args) along with the result of the last call
+    """
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function(*args)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Static against per-image Huffman tables benchmark")
+    parser.add_argument("images", nargs="*", default=DEFAULT_IMAGES, help="Images (default: the bundled images).")
+    parser.add_argument("--size", type=int, nargs=2, default=[300, 200], metavar=("WIDTH", "HEIGHT"),
+                        help="Size the images are shrunk to (default: 300 200).")
+    parser.add_argument("--quality", type=int, nargs="+", default=[20, 50, 80], help="Quality factors.")
+    parser.add_argument("--grayscale", action="store_true", help="Compress grayscale instead of colour images.")
+    parser.add_argument("--synthetic", type=int, default=2, help="Number of synthetic images to add (default: 2).")
+    parser.add_argument("--repeat", type=int, default=5, help="Runs per measurement, the fastest is kept.")
+    args = parser.parse_args()
+    colour = not args.grayscale
+
+    # The tables are built once per process, which is paid by the first file only
+    start = time.perf_counter()
+    for Q in args.quality:
+        for plane in PLANE_KINDS:
+            select_table(plane, Q)
+    print(f"Built-in tables loaded in {(time.perf_counter() - start) * 1e3:.0f} ms")
+
+    images = [(os.path.basename(path), cv2.cvtColor(cv2.imread(path), cv2.COLOR_BGR2RGB)) for path in args.images]
+    images += [(f"synthetic{seed}", make_image(max(args.size), seed)) for seed in range(args.synthetic)]
+
+    print(f"{'image':<14} {'Q':>3} {'BPP image':>10} {'BPP static':>11} {'size':>7} "
+          f"{'encode ms':>10} {'static':>8} {'decode ms':>10} {'static':>8}")
+    totals = np.zeros(6)
+    with tempfile.TemporaryDirectory() as folder:
+        per_image_file, static_file = os.path.join(folder, "image.bin"), os.path.join(folder, "static.bin")
+        for name, image in images:
+            image = cv2.resize(image, tuple(args.size), interpolation=cv2.INTER_AREA)
+            if not colour:
+                image = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
+            transformed = transform_image(image, colour)
+            n_pixels = image.shape[0] * image.shape[1]
+
+            for Q in args.quality:
+                encode_time, _ = best_time(args.repeat, compress_transformed, transformed, Q, per_image_file)
+                static_encode_time, _ = best_time(args.repeat, compress_transformed, transformed, Q, static_file,
+                                                  False, None, True)
+                decode_time, decoded = best_time(args.repeat, jpeg_decompress, per_image_file)
+                static_decode_time, static_decoded = best_time(args.repeat, jpeg_decompress, static_file)
+                assert np.array_equal(decoded, static_decoded)
+
+                bits = 8 * os.path.getsize(per_image_file), 8 * os.path.getsize(static_file)
+                row = np.array([*bits, encode_time, static_encode_time, decode_time, static_decode_time])
+                totals += row
+                print(f"{name:<14} {Q:>3} {bits[0] / n_pixels:>10.3f} {bits[1] / n_pixels:>11.3f} "
+                      f"{bits[1] / bits[0] - 1:>+7.1%} {encode_time * 1e3:>10.2f} {static_encode_time * 1e3:>8.2f} "
+                      f"{decode_time * 1e3:>10.2f} {static_decode_time * 1e3:>8.2f}")
+
+    print(f"{'total':<14} {'':>3} {'':>10} {'':>11} {totals[1] / totals[0] - 1:>+7.1%} {totals[2] * 1e3:>10.2f} "
+          f"{totals[3] * 1e3:>8.2f} {totals[4] * 1e3:>10.2f} {totals[5] * 1e3:>8.2f}")
+
+
+if __name__ == "__main__":
+    main()
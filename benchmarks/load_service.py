@@ -0,0 +1,154 @@
+"""
+Load generator for the compression service (service.py): keeps a number of requests in flight over keep-alive
+connections and reports the throughput and the latency percentiles of the answered requests, along with the number of
+requests the service turned away with 503 because its queue was full. Turned away requests are sent again once the
+Retry-After delay has passed, and do not count against --requests.
+
+With --spawn, the service is started on a temporary Unix socket for the run, and the time it takes to get its workers
+warm is reported too. Otherwise it is reached at --host/--port or --unix.
+
+Usage: python benchmarks/load_service.py [--spawn] [--workers 2] [--queue 64] [--endpoint /jpeg/compress]
+                                         [--query Q=50 colour=1] [--image image.png] [--concurrency 8]
+                                         [--requests 200 | --duration 10] [--batch 1]
+"""
+import argparse
+import asyncio
+import base64
+import glob
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+from service import ServiceClient
+
+DEFAULT_IMAGE = sorted(glob.glob(os.path.join(ROOT, "Research_paper", "homogeneous_diffusion", "images", "*.png")))[0]
+
+
+async def wait_ready(client, process, timeout=300):
+    """
+    Polls the health endpoint of a spawned service until it answers, and returns the time it took
+    """
+    start = time.perf_counter()
+    while time.perf_counter() - start < timeout:
+        if process.poll() is not None:
+            raise RuntimeError(f"The service exited with code {process.returncode}.")
+        try:
+            status, _, _ = await client.request("GET", "/health")
+            if status == 200:
+                return time.perf_counter() - start
+        except (ConnectionError, FileNotFoundError):
+            await client.close()
+        await asyncio.sleep(0.1)
+    raise TimeoutError("The service did not start in time.")
+
+
+async def run_client(client, make_request, deadline, remaining, latencies, outcomes):
+    """
+    Sends requests one after the other over one connection until the deadline or until none remain. A request turned
+    away with 503 is sent again after the Retry-After delay, so that only answered requests count against the budget.
+    """
+    while time.perf_counter() < deadline and (remaining is None or remaining[0] > 0):
+        if remaining is not None:
+            remaining[0] -= 1
+        method, path, body, query = make_request()
+        start = time.perf_counter()
+        try:
+            status, headers, payload = await client.request(method, path, body, query)
+        except (ConnectionError, OSError):
+            outcomes["errors"] += 1
+            await client.close()
+            continue
+        if status == 503:
+            outcomes["rejected"] += 1
+            if remaining is not None:
+                remaining[0] += 1
+            await asyncio.sleep(min(float(headers.get("retry-after", 1)), max(deadline - time.perf_counter(), 0)))
+        elif status == 200:
+            outcomes["ok"] += 1
+            latencies.append(time.perf_counter() - start)
+        else:
+            outcomes["errors"] += 1
+            if outcomes["errors"] == 1:
+                print(f"First error: {status} {payload[:200].decode(errors='replace')}")
+    await client.close()
+
+
+async def run_load(args, unix=None):
+    connect = dict(unix=unix) if unix else dict(host=args.host, port=args.port, unix=args.unix)
+    with open(args.image, "rb") as f:
+        image = f.read()
+    query = dict(item.split("=", 1) for item in args.query)
+
+    if args.batch > 1:
+        items = json.dumps([{"path": args.endpoint, "query": query, "body": base64.b64encode(image).decode()}
+                            for _ in range(args.batch)]).encode()
+
+        def make_request():
+            return "POST", "/batch", items, None
+    else:
+        def make_request():
+            return "POST", args.endpoint, image, query
+
+    latencies, outcomes = [], {"ok": 0, "rejected": 0, "errors": 0}
+    remaining = [args.requests] if args.duration is None else None
+    deadline = time.perf_counter() + (args.duration if args.duration is not None else float("inf"))
+    start = time.perf_counter()
+    await asyncio.gather(*(run_client(ServiceClient(**connect), make_request, deadline, remaining, latencies, outcomes)
+                           for _ in range(args.concurrency)))
+    elapsed = time.perf_counter() - start
+
+    print(f"{args.endpoint} x{args.batch}, {args.concurrency} clients: {outcomes['ok']} ok, "
+          f"{outcomes['rejected']} rejected, {outcomes['errors']} errors in {elapsed:.1f}s")
+    if latencies:
+        latencies = np.array(latencies) * 1e3
+        print(f"{outcomes['ok'] / elapsed:.1f} req/s ({outcomes['ok'] * args.batch / elapsed:.1f} images/s), "
+              f"latency p50 {np.percentile(latencies, 50):.1f} ms, p99 {np.percentile(latencies, 99):.1f} ms, "
+              f"mean {latencies.mean():.1f} ms, max {latencies.max():.1f} ms")
+
+
+async def spawn_and_run(args):
+    with tempfile.TemporaryDirectory() as folder:
+        socket_path = os.path.join(folder, "service.sock")
+        command = [sys.executable, os.path.join(ROOT, "service.py"), "--unix", socket_path, "--queue", str(args.queue)]
+        if args.workers:
+            command += ["--workers", str(args.workers)]
+        process = subprocess.Popen(command)
+        try:
+            startup = await wait_ready(ServiceClient(unix=socket_path), process)
+            print(f"Service ready in {startup:.1f}s")
+            await run_load(args, socket_path)
+        finally:
+            process.terminate()
+            process.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load generator for the compression service")
+    parser.add_argument("--spawn", action="store_true", help="Start the service on a temporary Unix socket.")
+    parser.add_argument("--workers", type=int, default=None, help="Worker processes of a spawned service.")
+    parser.add_argument("--queue", type=int, default=64, help="Queue size of a spawned service (default: 64).")
+    parser.add_argument("--host", default="127.0.0.1", help="Address of a running service (default: 127.0.0.1).")
+    parser.add_argument("--port", type=int, default=8080, help="Port of a running service (default: 8080).")
+    parser.add_argument("--unix", default=None, help="Unix socket of a running service.")
+    parser.add_argument("--endpoint", default="/jpeg/compress", help="Endpoint to load (default: /jpeg/compress).")
+    parser.add_argument("--query", nargs="*", default=["Q=50", "colour=1"], metavar="NAME=VALUE",
+                        help="Query parameters of the requests (default: Q=50 colour=1).")
+    parser.add_argument("--image", default=DEFAULT_IMAGE, help="Body of the requests (default: a bundled image).")
+    parser.add_argument("--concurrency", type=int, default=8, help="Requests in flight (default: 8).")
+    parser.add_argument("--requests", type=int, default=200, help="Number of requests to send (default: 200).")
+    parser.add_argument("--duration", type=float, default=None, help="Send requests for this many seconds instead.")
+    parser.add_argument("--batch", type=int, default=1, help="Send batches of this many images to /batch instead.")
+    args = parser.parse_args()
+
+    asyncio.run(spawn_and_run(args) if args.spawn else run_load(args))
+
+
+if __name__ == "__main__":
+    main()
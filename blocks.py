@@ -0,0 +1,202 @@
+import numpy as np
+from scipy.fftpack import dct, idct
+
+BLOCK_SIZE = 8
+
+# Default JPEG quantization matrix for Q = 50
+DEFAULT_QUANTIZATION_MATRIX = np.array([
+    [16, 11, 10, 16, 24, 40, 51, 61],
+    [12, 12, 14, 19, 26, 58, 60, 55],
+    [14, 13, 16, 24, 40, 57, 69, 56],
+    [14, 17, 22, 29, 51, 87, 80, 62],
+    [18, 22, 37, 56, 68, 109, 103, 77],
+    [24, 35, 55, 64, 81, 104, 113, 92],
+    [49, 64, 78, 87, 103, 121, 120, 101],
+    [72, 92, 95, 98, 112, 100, 103, 99]
+])
+
+
+def get_quantization_matrix(Q):
+    """
+    Takes as a parameter the quality factor Q and returns the quantization matrix.
+    """
+    # Determine scaling factor S based on the quality factor Q
+    if Q < 50:
+        S = 5000 / Q  # For lower quality factors, scaling is higher
+    else:
+        S = 200 - 2 * Q  # For higher quality factors, scaling is lower
+
+    scaled_matrix = ((S * DEFAULT_QUANTIZATION_MATRIX) + 50) // 100
+    scaled_matrix[scaled_matrix == 0] = 1  # To avoid division-by-zero errors, ensure non-zero matrix entries
+
+    return scaled_matrix
+
+
+def get_zigzag_order(size=BLOCK_SIZE):
+    """
+    Takes as parameter the size of the square matrix and returns the flat (row * size + col) indices
+    of its elements in zigzag order, so that a whole (N, size * size) array can be reordered in one gather.
+    """
+    order = []
+    for diag in range(2 * size - 1):
+        i_min = max(0, diag - size + 1)  # Start index for the diagonal
+        i_max = i_min + min(diag, 2 * (size - 1) - diag)  # End index for the diagonal
+        for i in range(i_min, i_max + 1):
+            if diag % 2 == 0:  # For even diagonals, zigzag from top-right to bottom-left
+                row, col = diag - i, i
+            else:  # For odd diagonals, zigzag from bottom-left to top-right
+                row, col = i, diag - i
+            order.append(row * size + col)
+    return np.array(order)
+
+
+ZIGZAG_ORDER = get_zigzag_order(BLOCK_SIZE)
+
+
+def get_zigzag_prefix(size, block_size=BLOCK_SIZE):
+    """
+    Takes as argument the side of a top-left square of coefficients and returns the number of leading zigzag
+    coefficients that cover it: 1 for the DC coefficient alone, 5 for 2x2, 25 for 4x4 and 64 for the whole 8x8 block.
+    """
+    rows, cols = np.divmod(get_zigzag_order(block_size), block_size)
+    return int(np.flatnonzero((rows < size) & (cols < size))[-1]) + 1
+
+
+def get_padded_shape(shape, block_size=BLOCK_SIZE):
+    """
+    Takes as argument the shape of an image and returns it rounded up to the nearest multiple of the block size
+    """
+    rows, cols = shape[:2]
+    return (rows + block_size - 1) // block_size * block_size, (cols + block_size - 1) // block_size * block_size
+
+
+def block_view(image, block_size=BLOCK_SIZE):
+    """
+    Takes as argument an image array and returns a (n_block_row, n_block_col, block_size, block_size)
+    view of its blocks. The image is zero-padded to a multiple of the block size first if needed,
+    otherwise no copy is made.
+    """
+    rows, cols = image.shape
+    padded_shape = get_padded_shape(image.shape, block_size)
+    if padded_shape != image.shape:
+        padded_image = np.zeros(padded_shape)
+        padded_image[0:rows, 0:cols] = image  # pad zeros at the end of rows and columns of original image
+    else:
+        padded_image = image
+
+    n_block_row = padded_shape[0] // block_size
+    n_block_col = padded_shape[1] // block_size
+    # Splitting both axes and swapping the middle ones gives a strided view with blocks in raster order
+    return padded_image.reshape(n_block_row, block_size, n_block_col, block_size).swapaxes(1, 2)
+
+
+def merge_blocks(blocks, padded_shape):
+    """
+    Takes as argument an (N, block_size, block_size) array of blocks in raster order and the padded image shape
+    and stitches the blocks back together into a single image
+    """
+    block_size = blocks.shape[-1]
+    n_block_row = padded_shape[0] // block_size
+    n_block_col = padded_shape[1] // block_size
+    return blocks.reshape(n_block_row, n_block_col, block_size, block_size).swapaxes(1, 2).reshape(padded_shape)
+
+
+def get_tile_order(padded_shape, tile_size):
+    """
+    Takes as argument the padded image shape and the side of a tile in blocks and returns the raster indices of the
+    blocks in tile order (square tiles in raster order, the blocks of every tile in raster order, with smaller tiles
+    along the bottom and right edges), along with the index in that order of the first block of every tile followed
+    by the number of blocks
+    """
+    n_block_row = padded_shape[0] // BLOCK_SIZE
+    n_block_col = padded_shape[1] // BLOCK_SIZE
+    raster = np.arange(n_block_row * n_block_col).reshape(n_block_row, n_block_col)
+    tiles = [raster[row:row + tile_size, col:col + tile_size].ravel()
+             for row in range(0, n_block_row, tile_size) for col in range(0, n_block_col, tile_size)]
+    return np.concatenate(tiles), np.cumsum([0] + [len(tile) for tile in tiles])
+
+
+def dct_blocks(image):
+    """
+    Takes as argument an image array and returns an (N, 8, 8) float array with the DCT coefficients of every
+    8x8 block in raster order, along with the padded image shape. Nothing here depends on the quality factor,
+    so the result can be quantized for any number of quality factors.
+    """
+    blocks = block_view(image, BLOCK_SIZE)
+    padded_shape = (blocks.shape[0] * BLOCK_SIZE, blocks.shape[1] * BLOCK_SIZE)
+
+    # Same separable DCT as DCT_2D, applied along the two in-block axes of every block at once
+    dct_coeff = dct(dct(blocks, axis=2, norm='ortho'), axis=3, norm='ortho')
+    return dct_coeff.reshape(-1, BLOCK_SIZE, BLOCK_SIZE), padded_shape
+
+
+def quantize_blocks(dct_coeff, Q=50, quantization_matrix=None):
+    """
+    Takes as arguments an (N, 8, 8) array of DCT coefficients and quality factor and returns an (N, 64) integer
+    array holding the quantized coefficients of every block in zigzag order.
+    If a quantization matrix is given, it is used instead of the one of the quality factor.
+    """
+    if quantization_matrix is None:
+        quantization_matrix = get_quantization_matrix(Q)
+
+    # The quantization matrix broadcasts over all blocks, so it is only built once per image
+    q_blocks = np.round(dct_coeff / quantization_matrix).astype(int)
+
+    # Zigzag unrolling as a single gather over the flattened blocks
+    return q_blocks.reshape(-1, BLOCK_SIZE * BLOCK_SIZE)[:, ZIGZAG_ORDER]
+
+
+def forward_transform(image, Q=50):
+    """
+    Takes as arguments an image array and quality factor and returns an (N, 64) integer array holding
+    the quantized DCT coefficients of every 8x8 block in zigzag order, along with the padded image shape.
+    All blocks are transformed, quantized and reordered together as single array operations.
+    """
+    dct_coeff, padded_shape = dct_blocks(image)
+    return quantize_blocks(dct_coeff, Q), padded_shape
+
+
+def inverse_transform(ordered_blocks, padded_shape, Q=50, quantization_matrix=None):
+    """
+    Takes as arguments an (N, 64) array of quantized coefficients in zigzag order, the padded image shape and
+    quality factor and returns the reconstructed (padded) image. This is the exact inverse path of forward_transform.
+    If a quantization matrix is given, it is used instead of the one of the quality factor.
+    """
+    if quantization_matrix is None:
+        quantization_matrix = get_quantization_matrix(Q)
+    n_blocks = len(ordered_blocks)
+
+    # Undo the zigzag unrolling by scattering every block into raster order at once
+    dct_coeff = np.empty((n_blocks, BLOCK_SIZE * BLOCK_SIZE))
+    dct_coeff[:, ZIGZAG_ORDER] = ordered_blocks
+    dct_coeff = dct_coeff.reshape(n_blocks, BLOCK_SIZE, BLOCK_SIZE)
+
+    # Multiply the quantized coefficients by the quantization table to restore the original scale
+    dct_coeff = dct_coeff * quantization_matrix
+
+    blocks = idct(idct(dct_coeff, axis=1, norm='ortho'), axis=2, norm='ortho')
+    return merge_blocks(blocks, padded_shape)
+
+
+def inverse_transform_scaled(ordered_blocks, padded_shape, size, Q=50, quantization_matrix=None):
+    """
+    Takes as arguments an (N, k) array of the leading quantized coefficients of every block in zigzag order (k at least
+    get_zigzag_prefix(size)), the padded image shape, the side of the output blocks (1, 2, 4 or 8) and quality factor,
+    and returns the image reconstructed at size / 8 of the padded shape. Only the top-left size x size coefficients of
+    every block go through a size-point inverse DCT, scaled so that every output pixel is the mean of the pixels it
+    stands for; with size 1 that is the DC coefficient divided by 8.
+    If a quantization matrix is given, it is used instead of the one of the quality factor.
+    """
+    if quantization_matrix is None:
+        quantization_matrix = get_quantization_matrix(Q)
+    n_blocks, n_coefficients = ordered_blocks.shape
+
+    # Scatter the coefficients that fall in the top-left square straight into size x size blocks
+    rows, cols = np.divmod(ZIGZAG_ORDER[:n_coefficients], BLOCK_SIZE)
+    inside = (rows < size) & (cols < size)
+    dct_coeff = np.zeros((n_blocks, size, size))
+    dct_coeff[:, rows[inside], cols[inside]] = ordered_blocks[:, inside]
+    dct_coeff *= quantization_matrix[:size, :size]
+
+    blocks = idct(idct(dct_coeff, axis=1, norm='ortho'), axis=2, norm='ortho') * (size / BLOCK_SIZE)
+    return merge_blocks(blocks, (padded_shape[0] // BLOCK_SIZE * size, padded_shape[1] // BLOCK_SIZE * size))
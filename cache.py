@@ -0,0 +1,255 @@
+"""
+Content-addressed cache of the JPEG codec's outputs, for jobs that compress and decode the same images over and over.
+
+Entries are keyed by the SHA-256 of the input bytes (the image file, or the compressed file for decoding) together with
+the codec parameters and the codec version, a hash of the source of the codec modules and of the built-in Huffman
+tables. Editing the codec therefore changes every key, so stale entries are never returned.
+
+Two layers sit in front of each other:
+
+    memory  decoded arrays in a least recently used cache with a budget in bytes, evicting the oldest entries first
+    disk    compressed files, stored as <cache_dir>/<codec version>/<key[:2]>/<key>.bin (or .jpg)
+
+    cache = CodecCache("codec_cache")
+    compressed_file = cache.compress("cat.png", 50, colour=True)    # compresses on the first call only
+    image = cache.decode("cat.png", 50, colour=True)                # decodes on the first call only
+    print(cache.stats())
+
+Decoded arrays are shared between callers and returned read-only.
+"""
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+from collections import Counter, OrderedDict
+
+import blocks
+import codec
+import container
+import huffman
+import huffman_tables
+import jfif
+
+CODEC_MODULES = (blocks, codec, container, huffman, huffman_tables, jfif)
+HASH_CHUNK = 1 << 20  # Bytes read per step when hashing a file
+
+
+def file_digest(path):
+    """
+    Returns the hexadecimal SHA-256 of the contents of a file
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def get_codec_version():
+    """
+    Returns a short hash of the source files of the codec modules and of the built-in Huffman tables, which changes
+    whenever the codec does
+    """
+    digest = hashlib.sha256()
+    for path in [module.__file__ for module in CODEC_MODULES] + [huffman_tables.TABLES_FILE]:
+        digest.update(file_digest(path).encode())
+    return digest.hexdigest()[:16]
+
+
+class LRUCache:
+    """
+    In-memory least recently used cache of arrays holding at most max_bytes bytes. Storing an entry evicts the least
+    recently used ones until it fits, and entries larger than the whole budget are not stored. Safe to share between
+    threads.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.counters = Counter()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Returns the array stored under key, marking it as the most recently used, or None if there is none
+        """
+        with self.lock:
+            array = self.entries.get(key)
+            if array is None:
+                self.counters["memory_misses"] += 1
+                return None
+            self.entries.move_to_end(key)
+            self.counters["memory_hits"] += 1
+            return array
+
+    def put(self, key, array):
+        """
+        Stores an array under key, read-only, evicting the least recently used entries to stay within the budget
+        """
+        if array.nbytes > self.max_bytes:
+            return
+        array.flags.writeable = False
+        with self.lock:
+            if key in self.entries:
+                self.size -= self.entries.pop(key).nbytes
+            while self.size + array.nbytes > self.max_bytes:
+                self.size -= self.entries.popitem(last=False)[1].nbytes
+                self.counters["evictions"] += 1
+            self.entries[key] = array
+            self.size += array.nbytes
+
+
+class CodecCache:
+    """
+    Cache of compressed files on disk under cache_dir, with an LRU cache of decoded arrays of up to memory_budget
+    bytes in front of it. Every lookup counts as a hit or a miss of its layer, see stats.
+    """
+
+    def __init__(self, cache_dir, memory_budget=256 * 2 ** 20, codec_version=None):
+        self.codec_version = codec_version or get_codec_version()
+        self.root = os.path.join(cache_dir, self.codec_version)
+        self.memory = LRUCache(memory_budget)
+        self.counters = Counter()
+        self.lock = threading.Lock()
+        self.digests = {}  # (path, size, modification time) -> SHA-256, so unchanged files are hashed only once
+
+    def count(self, name):
+        """
+        Adds one to the named counter
+        """
+        with self.lock:
+            self.counters[name] += 1
+
+    def digest(self, path):
+        """
+        Returns the SHA-256 of a file, hashing it again only if its size or modification time changed
+        """
+        status = os.stat(path)
+        identity = (os.path.realpath(path), status.st_size, status.st_mtime_ns)
+        if identity not in self.digests:
+            self.digests[identity] = file_digest(path)
+        return self.digests[identity]
+
+    def key(self, kind, path, **params):
+        """
+        Returns the cache key of an operation on the contents of a file with the given parameters
+        """
+        fields = dict(params, kind=kind, content=self.digest(path), codec=self.codec_version)
+        return hashlib.sha256(json.dumps(fields, sort_keys=True).encode()).hexdigest()
+
+    def encoded_key(self, image_path, Q, colour=False, subsampling="4:2:0", progressive=False, tile_size=None,
+                    static_tables=False, suffix=".bin"):
+        """
+        Returns the cache key of the compression of an image with the parameters of codec.jpeg_compress
+        """
+        return self.key("encoded", image_path, Q=Q, colour=colour, subsampling=subsampling if colour else "4:4:4",
+                        progressive=progressive, tile_size=tile_size, static_tables=static_tables, suffix=suffix)
+
+    def entry_path(self, key, suffix):
+        """
+        Returns the path of the compressed file stored under key
+        """
+        return os.path.join(self.root, key[:2], key + suffix)
+
+    def lookup(self, image_path, Q, compressed_file=None, **params):
+        """
+        Returns the path of the cached compressed file of an image with the given codec parameters (see
+        jpeg_compress) and copies it to compressed_file if given, or returns None if it is not cached
+        """
+        path = self.entry_path(self.encoded_key(image_path, Q, **params), params.get("suffix", ".bin"))
+        if not os.path.exists(path):
+            self.count("disk_misses")
+            return None
+        self.count("disk_hits")
+        if compressed_file is not None:
+            shutil.copyfile(path, compressed_file)
+        return path
+
+    def store(self, image_path, Q, compressed_file, **params):
+        """
+        Copies a compressed file of an image, made with the given codec parameters, into the cache and returns the
+        path of the cached copy
+        """
+        path = self.entry_path(self.encoded_key(image_path, Q, **params), params.get("suffix", ".bin"))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Copy to a temporary file first, so that concurrent readers never see a partial entry
+        fd, temp_file = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".part")
+        os.close(fd)
+        shutil.copyfile(compressed_file, temp_file)
+        os.replace(temp_file, path)
+        return path
+
+    def compress(self, image_path, Q, compressed_file=None, colour=False, subsampling="4:2:0", progressive=False,
+                 tile_size=None, static_tables=False, suffix=".bin"):
+        """
+        Takes the arguments of codec.jpeg_compress and returns the path of the cached compressed file, compressing
+        the image only if it is not cached yet. If compressed_file is given, the result is also copied there.
+        """
+        params = dict(colour=colour, subsampling=subsampling, progressive=progressive, tile_size=tile_size,
+                      static_tables=static_tables, suffix=suffix)
+        path = self.lookup(image_path, Q, compressed_file, **params)
+        if path is not None:
+            return path
+
+        os.makedirs(self.root, exist_ok=True)
+        fd, temp_file = tempfile.mkstemp(dir=self.root, suffix=suffix)
+        os.close(fd)
+        try:
+            codec.jpeg_compress(image_path, Q, temp_file, colour, subsampling, progressive, tile_size, static_tables)
+            path = self.store(image_path, Q, temp_file, **params)
+        finally:
+            os.remove(temp_file)
+        if compressed_file is not None:
+            shutil.copyfile(path, compressed_file)
+        return path
+
+    def decompress(self, compressed_file, Q=None):
+        """
+        Returns codec.jpeg_decompress(compressed_file, Q), decoding the file only if a file with the same contents
+        is not in the memory cache
+        """
+        key = self.key("decoded", compressed_file, Q=Q)
+        image = self.memory.get(key)
+        if image is None:
+            image = codec.jpeg_decompress(compressed_file, Q)
+            self.memory.put(key, image)
+        return image
+
+    def decode(self, image_path, Q, **params):
+        """
+        Returns the image compressed with the given codec parameters (see compress) and decoded again, from the
+        memory cache if it is there and from the compressed file on disk otherwise
+        """
+        key = "decoded-" + self.encoded_key(image_path, Q, **params)
+        image = self.memory.get(key)
+        if image is None:
+            image = codec.jpeg_decompress(self.compress(image_path, Q, **params))
+            self.memory.put(key, image)
+        return image
+
+    def stats(self):
+        """
+        Returns a dictionary of the hit, miss and eviction counts of both layers along with the bytes and number of
+        arrays in the memory cache
+        """
+        with self.lock, self.memory.lock:
+            return dict({"disk_hits": 0, "disk_misses": 0, "memory_hits": 0, "memory_misses": 0, "evictions": 0},
+                        **self.counters, **self.memory.counters, memory_bytes=self.memory.size,
+                        memory_entries=len(self.memory.entries))
+
+    def prune(self):
+        """
+        Deletes the entries written by every other version of the codec from the cache folder and returns the number
+        of versions removed
+        """
+        cache_dir = os.path.dirname(self.root)
+        if not os.path.isdir(cache_dir):
+            return 0
+        stale = [name for name in os.listdir(cache_dir)
+                 if name != self.codec_version and os.path.isdir(os.path.join(cache_dir, name))]
+        for name in stale:
+            shutil.rmtree(os.path.join(cache_dir, name), ignore_errors=True)
+        return len(stale)
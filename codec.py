@@ -0,0 +1,664 @@
+import os
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
+
+import cv2
+import numpy as np
+
+from huffman import *
+from blocks import *
+from container import *
+from instrumentation import stage
+from huffman_tables import select_table
+from jfif import SAMPLING_FACTORS, is_jfif, read_jfif, write_jfif
+
+
+def read_image(path_to_image, colour=False):
+    """
+    Reads an image from the specified path and returns an array of pixel intensities,
+    in RGB format if colour is set and as grayscale otherwise
+    """
+    if not os.path.exists(path_to_image):
+        raise FileNotFoundError(f"No image found at the specified path: {path_to_image}")
+
+    if not colour:
+        return cv2.imread(path_to_image, cv2.IMREAD_GRAYSCALE)
+
+    # Read as BGR and convert to RGB
+    image = cv2.imread(path_to_image)  # BGR format
+    image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)  # Convert to RGB
+
+    return image
+
+
+def encode_runlength(array):
+    '''Takes as parameter an array of elements and returns the encoded array using runlength encoding on "0" because it is the most occuring element
+    '''
+    return runlength_encode_blocks(np.asarray(array).reshape(1, -1)).tolist()
+
+
+def decode_runlength(array):
+    '''Takes a runlength encoded sequences and returns the decoded array
+    '''
+    symbols = np.asarray(array)
+
+    # Run counts are never zero, so every zero symbol is a marker and the symbol after it is its count
+    is_marker = symbols == 0
+    if len(symbols) and is_marker[-1]:
+        raise ValueError("Run-length stream ends with a zero marker but no count.")
+    count_positions = np.flatnonzero(is_marker) + 1
+
+    # Every marker expands into its count of zeros, every other symbol is copied once and the counts are dropped
+    repeats = np.ones(len(symbols), dtype=np.int64)
+    repeats[is_marker] = symbols[count_positions]
+    repeats[count_positions] = 0
+    return np.repeat(symbols, repeats)
+
+
+def runlength_encode_blocks(ordered_blocks):
+    """
+    Takes as argument an (N, 64) array of quantized coefficients in zigzag order and returns the run-length encoded
+    symbols of all blocks, one after the other, as a compact int16 array. Every block is encoded on its own, exactly
+    as encode_runlength would: non-zero coefficients are kept and every run of zeros becomes [0, run length].
+    """
+    coefficients = np.asarray(ordered_blocks)
+    if coefficients.size and (coefficients.min() < -2 ** 15 or coefficients.max() >= 2 ** 15):
+        raise ValueError("Coefficients must fit in 16 bits to be run-length encoded.")
+
+    # A run of zeros starts at a zero with no zero before it in the block and ends at a zero with no zero after it
+    is_zero = coefficients == 0
+    run_start = is_zero.copy()
+    run_start[:, 1:] &= ~is_zero[:, :-1]
+    run_end = is_zero.copy()
+    run_end[:, :-1] &= ~is_zero[:, 1:]
+    run_start, run_end = run_start.ravel(), run_end.ravel()
+
+    # Only non-zero coefficients (one symbol each) and the starts of runs (two symbols, [0, run length]) are kept
+    kept = np.flatnonzero(~is_zero.ravel() | run_start)
+    starts_run = run_start[kept]
+    width = 1 + starts_run
+    position = np.cumsum(width) - width
+
+    symbols = np.empty(len(kept) + np.count_nonzero(starts_run), dtype=np.int16)
+    symbols[position] = coefficients.ravel()[kept]  # The starts of runs are zeros, which become the markers
+    run_starts = kept[starts_run]
+    symbols[position[starts_run] + 1] = np.flatnonzero(run_end) - run_starts + 1
+    return symbols
+
+
+ENCODE_CHUNK = 4096  # Number of blocks run-length encoded per step
+
+
+@stage()
+def encode_coefficients(ordered_blocks, huffman_dict=None):
+    """
+    Takes as argument an (N, 64) array of quantized coefficients in zigzag order and returns the Huffman encoded
+    stream of bits along with the Huffman dictionary. If a dictionary is given (such as a built-in StaticTable),
+    the blocks are encoded with it instead of building a Huffman tree of their own.
+    """
+    # First pass: run-length encode the blocks a chunk at a time and count their symbols. Every chunk is kept in memory
+    # as int16 until the second pass, so memory still grows with the image; streaming.stream_compress bounds it
+    histogram = SymbolHistogram()
+    chunks = []
+    for start in range(0, len(ordered_blocks), ENCODE_CHUNK):
+        symbols = runlength_encode_blocks(ordered_blocks[start:start + ENCODE_CHUNK])
+        if huffman_dict is None:
+            histogram.update(symbols)
+        chunks.append(symbols)
+
+    # Second pass: create the Huffman table from the histogram and encode the chunks with it
+    if huffman_dict is None:
+        huffman_dict = histogram.huffman_tree().traverse()
+    huffman_stream = bitarray()
+    for symbols in chunks:
+        huffman_stream += encode_huffman(symbols.tolist(), huffman_dict)
+    return huffman_stream, huffman_dict
+
+
+@stage()
+def encode_JPEG(image, Q = 50):
+    """
+    Takes as arguments an image array and quality factor and returns the Huffman encoded stream of bits
+    along with the Huffman dictionary, and the size of the padded image
+    """
+    # DCT, quantization and zig-zag unrolling of all 8 x 8 blocks at once, one row of 64 coefficients per block
+    ordered_blocks, padded_shape = forward_transform(image, Q)
+    huffman_stream, huffman_dict = encode_coefficients(ordered_blocks)
+    return huffman_stream, huffman_dict, padded_shape
+
+
+@stage()
+def decode_JPEG(hf_stream, huffman_dict, original_dims, Q=50):
+    """
+    Takes as argument a JPEG-compressed image stream, Huffman dictionary used for encoding and the dimension of original image
+    and reconstructs the original image.
+    """
+    # Decode the Huffman encoded stream to obtain the run-length encoded stream
+    dec_hf_stream = decode_huffman(hf_stream, huffman_dict)
+    return decode_symbols(dec_hf_stream, original_dims, Q)
+
+
+@stage()
+def decode_symbols(dec_hf_stream, original_dims, Q=50):
+    """
+    Takes as argument the Huffman-decoded (run-length encoded) stream of symbols, the dimension of original image
+    and quality factor and reconstructs the original image.
+    """
+    # Calculate padded dimensions (nearest multiple of 8)
+    padded_shape = get_padded_shape(original_dims)
+
+    dec_rn_stream = decode_runlength(dec_hf_stream)
+
+    # Each 64-element chunk of the decoded run-length stream corresponds to a block of size 8x8
+    no_of_chunks = len(dec_rn_stream) // 64
+    ordered_blocks = dec_rn_stream[:no_of_chunks * 64].reshape(no_of_chunks, 64)
+
+    # Dequantize and invert the DCT of all blocks at once and stitch them back into the padded image
+    reconstructed_image = inverse_transform(ordered_blocks, padded_shape, Q)
+
+    # Slice the reconstructed image to match the original dimensions
+    reconstructed_image = reconstructed_image[:original_dims[0], :original_dims[1]]
+
+    return reconstructed_image
+
+
+@stage()
+def encode_tiles(ordered_blocks, tile_starts, huffman_dict=None):
+    """
+    Takes as argument an (N, 64) array of quantized coefficients in zigzag order, with the blocks in tile order, and
+    the index of the first block of every tile followed by N, and returns the Huffman encoded stream of bits, the
+    Huffman dictionary and the bit offset in the stream at which every tile starts. All tiles share the dictionary,
+    and every tile decodes on its own from its offset. As in encode_coefficients, a dictionary can be given.
+    """
+    histogram = SymbolHistogram()
+    tiles = []
+    for start, end in zip(tile_starts, tile_starts[1:]):
+        symbols = runlength_encode_blocks(ordered_blocks[start:end])
+        if huffman_dict is None:
+            histogram.update(symbols)
+        tiles.append(symbols)
+
+    if huffman_dict is None:
+        huffman_dict = histogram.huffman_tree().traverse()
+    huffman_stream = bitarray()
+    tile_offsets = np.empty(len(tiles), dtype=np.uint64)
+    for i, symbols in enumerate(tiles):
+        tile_offsets[i] = len(huffman_stream)
+        huffman_stream += encode_huffman(symbols.tolist(), huffman_dict)
+    return huffman_stream, huffman_dict, tile_offsets
+
+
+def difference_dc(ordered_blocks, segment_starts=(0,)):
+    """
+    Takes as argument an (N, k) array of quantized coefficients in zigzag order and returns a copy in which the DC
+    coefficient of every block is replaced by its difference with the DC coefficient of the block before. The
+    prediction starts again from zero at every given segment start (such as the first block of every tile).
+    """
+    blocks = np.array(ordered_blocks)
+    starts = np.asarray(segment_starts, dtype=np.int64)
+    differences = np.diff(blocks[:, 0], prepend=0)
+    differences[starts] = blocks[starts, 0]
+    blocks[:, 0] = differences
+    return blocks
+
+
+def accumulate_dc(ordered_blocks, segment_starts=(0,)):
+    """
+    Undoes difference_dc in place on an (N, k) array of coefficients with the same segment starts, and returns it
+    """
+    if len(ordered_blocks) == 0:
+        return ordered_blocks
+    starts = np.asarray(segment_starts, dtype=np.int64)
+    totals = np.cumsum(ordered_blocks[:, 0])
+    # Every segment subtracts the running total of the segments before it
+    segment = np.searchsorted(starts, np.arange(len(totals)), side="right") - 1
+    ordered_blocks[:, 0] = totals - np.append(0, totals)[starts][segment]
+    return ordered_blocks
+
+
+# Zigzag limits of the spectral bands of progressive containers: the DC coefficient, then the coefficients each of the
+# 1/4, 1/2 and full scale reconstructions adds to the one before (the top-left 2x2, 4x4 and 8x8 squares of the block)
+SPECTRAL_BANDS = (0,) + tuple(get_zigzag_prefix(size) for size in (1, 2, 4, BLOCK_SIZE))
+PREVIEW_SCALES = (1, 2, 4, 8)
+
+
+def encode_bands(ordered_blocks, bands=SPECTRAL_BANDS):
+    """
+    Takes as argument an (N, 64) array of quantized coefficients in zigzag order and returns the
+    (huffman_stream, huffman_dict) pair of every spectral band: the coefficients of the band in every block, run-length
+    and Huffman encoded with a table of their own. Like in baseline JPEG, the DC band codes the difference between
+    the DC coefficients of consecutive blocks.
+    """
+    encoded = []
+    for start, end in zip(bands, bands[1:]):
+        band = ordered_blocks[:, start:end]
+        if start == 0:
+            band = difference_dc(band)
+        encoded.append(encode_coefficients(band))
+    return encoded
+
+
+@stage()
+def decode_bands(band_planes, bands, n_coefficients=BLOCK_SIZE * BLOCK_SIZE):
+    """
+    Takes as argument the band planes of a progressive container plane, the zigzag band limits and a number of
+    coefficients and returns the (N, n_coefficients) array of the leading quantized coefficients of every block in
+    zigzag order. The payloads of the bands beyond n_coefficients are never read.
+    """
+    padded_shape = get_padded_shape((band_planes[0].height, band_planes[0].width))
+    n_blocks = padded_shape[0] * padded_shape[1] // (BLOCK_SIZE * BLOCK_SIZE)
+
+    columns = []
+    for plane, start, end in zip(band_planes, bands, bands[1:]):
+        if start >= n_coefficients:
+            break
+        band = decode_runlength(decode_plane(plane)).reshape(n_blocks, end - start)
+        if start == 0:
+            accumulate_dc(band)
+        columns.append(band)
+    return np.concatenate(columns, axis=1)[:, :n_coefficients]
+
+
+def calculate_relative_rmse(original, reconstructed):
+    """
+    Takes as argument the original image array and the reconstructed image array and calculates the relative Root Mean Square Error between them
+    Both arrays are converted to float64 first, so uint8 inputs give larger (correct) values than the notebook
+    version, which wrapped around on subtraction and overflowed when squaring.
+    """
+    original = np.asarray(original, dtype=np.float64)
+    reconstructed = np.asarray(reconstructed, dtype=np.float64)
+    rmse = np.sqrt(np.mean((original - reconstructed) ** 2))
+    relative_rmse = rmse / np.sqrt(np.sum(original ** 2))
+    return relative_rmse
+
+
+def calculate_bpp(compressed_image_path, image_shape):
+    """
+    Takes as argument the path of .bin of compressed image and shape of original image and calculate Bits Per Pixel (BPP)
+    """
+    file_size = os.path.getsize(compressed_image_path) * 8  # File size in bits
+    total_pixels = image_shape[0] * image_shape[1]
+    return file_size / total_pixels
+
+
+# Affine YCbCr transforms in the form cv2.transform takes: the 3x3 colour matrix followed by the offset column
+RGB_TO_YCBCR = np.array([[0.299, 0.587, 0.114, 0],
+                         [-0.1687, -0.3313, 0.5, 128],
+                         [0.5, -0.4187, -0.0813, 128]], dtype=np.float32)
+YCBCR_TO_RGB_MATRIX = np.array([[1, 0, 1.402],
+                                [1, -0.344136, -0.714136],
+                                [1, 1.772, 0]])
+YCBCR_TO_RGB = np.hstack([YCBCR_TO_RGB_MATRIX, -YCBCR_TO_RGB_MATRIX @ [[0], [128], [128]]]).astype(np.float32)
+
+
+# RGB to YCbCr conversion
+def rgb_to_ycbcr(image):
+    """
+    Converts an RGB image array to the YCbCr color space and returns the Y, Cb and Cr planes as float32 arrays
+    """
+    return cv2.split(cv2.transform(np.asarray(image, dtype=np.float32), RGB_TO_YCBCR))
+
+
+def subsample_channel(channel, subsampling="4:2:0"):
+    """
+    Downsamples a channel array (or a multi-channel image) by the chroma subsampling factors of the given mode,
+    averaging every 2x2 (4:2:0) or horizontal 2x1 (4:2:2) block of pixels. Odd dimensions are padded by repeating
+    the last row or column, so the result has the rounded-up half size.
+    """
+    horizontal, vertical = SAMPLING_FACTORS[subsampling]
+    channel = np.asarray(channel, dtype=np.float32)
+    if horizontal == vertical == 1:
+        return channel
+
+    pad_rows, pad_columns = -channel.shape[0] % vertical, -channel.shape[1] % horizontal
+    if pad_rows or pad_columns:
+        channel = cv2.copyMakeBorder(channel, 0, pad_rows, 0, pad_columns, cv2.BORDER_REPLICATE)
+    # Shrinking by a whole factor with INTER_AREA is exactly the mean of every block
+    size = (channel.shape[1] // horizontal, channel.shape[0] // vertical)
+    return cv2.resize(channel, size, interpolation=cv2.INTER_AREA)
+
+
+def split_ycbcr(image, subsampling="4:2:0"):
+    """
+    Takes as argument an RGB image array and a chroma subsampling mode and returns the Y plane at full resolution and
+    the Cb and Cr planes subsampled by subsample_channel, as float32 arrays. The conversion is affine, so the
+    chrominance of the averaged RGB pixels equals the average of their chrominance, and only the averaged pixels
+    (a quarter of them for 4:2:0) are converted.
+    """
+    image = np.asarray(image, dtype=np.float32)
+    Y = cv2.transform(image, RGB_TO_YCBCR[:1])
+    Cb, Cr = cv2.split(cv2.transform(subsample_channel(image, subsampling), RGB_TO_YCBCR[1:]))
+    return Y, Cb, Cr
+
+
+def upsample_channel(channel, target_shape):
+    """
+    Upsamples a channel array back to the target shape. Each axis is scaled by the whole factor that covers it
+    (2 along subsampled axes, 1 otherwise) with a separable linear interpolation between the sample centres, the
+    triangle filter of libjpeg's fancy upsampling, and the rows and columns beyond the target shape are cropped.
+    """
+    vertical = -(-target_shape[0] // channel.shape[0])
+    horizontal = -(-target_shape[1] // channel.shape[1])
+    channel = np.asarray(channel, dtype=np.float32)
+    if horizontal == vertical == 1:
+        return channel[:target_shape[0], :target_shape[1]]
+
+    size = (channel.shape[1] * horizontal, channel.shape[0] * vertical)
+    return cv2.resize(channel, size, interpolation=cv2.INTER_LINEAR)[:target_shape[0], :target_shape[1]]
+
+
+# YCbCr to RGB conversion
+def ycbcr_to_rgb(Y, Cb, Cr):
+    """
+    Converts YCbCr channels back to an RGB image array
+    """
+    ycbcr = cv2.merge([np.asarray(plane, dtype=np.float32) for plane in (Y, Cb, Cr)])
+    rgb = cv2.transform(ycbcr, YCBCR_TO_RGB)
+    return np.clip(rgb, 0, 255).astype(np.uint8)
+
+
+def map_planes(function, planes, workers=None):
+    """
+    Takes as argument a function and a list of planes (or tiles) and returns the list of function(plane), with the
+    planes processed concurrently on a pool of threads when there is more than one CPU (at most workers threads if
+    given). The NumPy, SciPy and OpenCV calls of the codec release the GIL. Every plane runs in a copy of the caller's
+    context, so the stages of an active instrumentation trace are recorded.
+    """
+    workers = min(len(planes), workers or os.cpu_count() or 1)
+    if workers < 2:
+        return [function(plane) for plane in planes]
+    contexts = [copy_context() for _ in planes]
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(lambda context, plane: context.run(function, plane), contexts, planes))
+
+
+# Everything an encoder computes before quantization: the DCT coefficients and dimensions of every plane
+TransformedImage = namedtuple("TransformedImage", ["planes", "original_dims", "subsampling"])
+
+
+@stage()
+def transform_image(original, colour=False, subsampling="4:2:0"):
+    """
+    Takes as argument an image array and returns its TransformedImage, holding a (dct_coeff, plane_dims) pair per plane.
+    Colour images are converted to YCbCr and their chrominance is subsampled first (4:4:4, 4:2:2 or 4:2:0), and the
+    planes are transformed concurrently. None of this depends on the quality factor, so the result can be compressed
+    at any number of quality factors with compress_transformed.
+    """
+    if not colour:
+        return TransformedImage([(dct_blocks(original)[0], original.shape)], original.shape, "4:4:4")
+
+    planes = map_planes(lambda channel: (dct_blocks(channel)[0], channel.shape), split_ycbcr(original, subsampling))
+    return TransformedImage(planes, original.shape[:2], subsampling)
+
+
+@stage()
+def compress_transformed(transformed, Q, compressed_file, progressive=False, tile_size=None, static_tables=False):
+    """
+    Takes as argument a TransformedImage, quality factor and the path to a .bin file, and quantizes, run-length
+    and Huffman encodes every plane (concurrently) and saves them to the .bin file.
+    If progressive is set, the planes are split into the spectral bands of SPECTRAL_BANDS, which jpeg_preview decodes
+    one by one, at the cost of slightly larger files.
+    If a tile size is given, the blocks of every plane are coded in tiles of tile_size x tile_size blocks, which
+    decode_region decodes one by one.
+    If static_tables is set, the planes are encoded with the built-in Huffman tables of huffman_tables.py for the
+    quality factor, which the file refers to by ID, instead of tables built for and stored with the image. Their DC
+    coefficients are then coded as differences, restarting at every tile.
+    If the path ends in .jpg or .jpeg, a standard baseline JPEG file is written instead.
+    """
+    if os.path.splitext(compressed_file)[1].lower() in (".jpg", ".jpeg"):
+        write_jfif(compressed_file, transformed.planes, Q, transformed.original_dims, transformed.subsampling)
+        return
+    if progressive and tile_size is not None:
+        raise ValueError("A .bin file is either progressive or tiled, not both.")
+    if progressive and static_tables:
+        raise ValueError("The built-in Huffman tables are trained on whole blocks and cannot code spectral bands.")
+
+    def encode_plane(indexed_plane):
+        index, (dct_coeff, plane_dims) = indexed_plane
+        ordered_blocks = quantize_blocks(dct_coeff, Q)
+        table = select_table("luma" if index == 0 else "chroma", Q) if static_tables else None
+        if progressive:
+            return [(*band, plane_dims) for band in encode_bands(ordered_blocks)]
+        if tile_size is not None:
+            tile_order, tile_starts = get_tile_order(get_padded_shape(plane_dims), tile_size)
+            ordered_blocks = ordered_blocks[tile_order]
+            if table is not None:
+                ordered_blocks = difference_dc(ordered_blocks, tile_starts[:-1])
+            huffman_stream, huffman_dict, tile_offsets = encode_tiles(ordered_blocks, tile_starts, table)
+            return huffman_stream, huffman_dict, plane_dims, tile_offsets
+        if table is not None:
+            ordered_blocks = difference_dc(ordered_blocks)
+        return (*encode_coefficients(ordered_blocks, table), plane_dims)
+
+    planes = map_planes(encode_plane, list(enumerate(transformed.planes)))
+
+    # Save the header, code lengths and Huffman-encoded bitstreams to a .bin container
+    write_container(compressed_file, planes, Q, transformed.original_dims, transformed.subsampling,
+                    SPECTRAL_BANDS if progressive else None, tile_size)
+
+
+def jpeg_compress(image_path, Q, compressed_file, colour=False, subsampling="4:2:0", progressive=False,
+                  tile_size=None, static_tables=False):
+    """
+    Takes as argument the path to original image, quality factor and the path to a .bin file
+    and compress the image using a JPEG and saves it to a .bin file (or a standard JPEG file if it ends in .jpg).
+    Colour images are converted to YCbCr and their chrominance is subsampled ("4:4:4", "4:2:2" or "4:2:0")
+    before compression. If progressive is set, the .bin file stores every plane as spectral bands (see jpeg_preview).
+    If a tile size is given, it stores every plane in independently decodable tiles of that many blocks a side
+    (see decode_region). If static_tables is set, it is coded with the built-in Huffman tables of
+    huffman_tables.py, which saves storing tables for small images and building them.
+    """
+    jpeg_compress_sweep(image_path, [Q], [compressed_file], colour, subsampling, progressive, tile_size,
+                        static_tables)
+
+
+def jpeg_compress_sweep(image_path, quality_factors, compressed_files, colour=False, subsampling="4:2:0",
+                        progressive=False, tile_size=None, static_tables=False):
+    """
+    Takes as argument the path to original image, a list of quality factors and a matching list of paths to .bin files
+    and compresses the image once per quality factor. The image is read, converted and transformed only once;
+    each quality factor then only costs the quantization and entropy coding.
+    """
+    transformed = transform_image(read_image(image_path, colour), colour, subsampling)
+
+    for Q, compressed_file in zip(quality_factors, compressed_files):
+        # Create the output directory if it doesn't exist
+        compressed_folder = os.path.dirname(compressed_file)
+        if compressed_folder:
+            os.makedirs(compressed_folder, exist_ok=True)
+
+        compress_transformed(transformed, Q, compressed_file, progressive, tile_size, static_tables)
+
+
+def jpeg_decompress(compressed_file, Q=None):
+    """
+    Takes as argument the path to the .bin of compressed image and returns the decompressed image,
+    as grayscale or RGB depending on the number of channels stored. The quality factor is read from the file unless given.
+    Standard JPEG files, such as those written by libjpeg, are decoded as well; they carry their own tables.
+    """
+    if is_jfif(compressed_file):
+        channels = read_jfif(compressed_file)[1]
+    else:
+        header, planes = read_container(compressed_file)
+        if Q is None:
+            Q = header.Q
+
+        # Decode the channels concurrently, each straight from the file buffer
+        channels = map_planes(lambda plane: decode_container_plane(plane, header, Q), planes)
+
+    return merge_channels(channels)
+
+
+def jpeg_preview(compressed_file, scale=8, Q=None):
+    """
+    Takes as argument the path to a compressed image and a scale (8, 4, 2 or 1) and returns the image decoded at
+    1 / scale of its size, as grayscale or RGB. Only the top-left 1x1 (the DC coefficient), 2x2 or 4x4 coefficients
+    of every block are used, through an inverse DCT of that size (at scale 8, every pixel is the mean of its block).
+    The planes of progressive containers are read only as far as the bands holding these coefficients; other
+    containers have to be Huffman decoded in full, and standard JPEG files are decoded and shrunk.
+    """
+    if scale not in PREVIEW_SCALES:
+        raise ValueError(f"Preview scale must be one of {PREVIEW_SCALES}.")
+
+    if is_jfif(compressed_file):
+        image = jpeg_decompress(compressed_file)
+        size = (-(-image.shape[1] // scale), -(-image.shape[0] // scale))
+        return cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+
+    header, planes = read_container(compressed_file)
+    if Q is None:
+        Q = header.Q
+    return merge_channels(map_planes(lambda plane: decode_container_plane(plane, header, Q, scale), planes))
+
+
+def decode_container_plane(plane, header, Q, scale=1):
+    """
+    Takes as argument a plane of a container (a tuple of band planes if the container is progressive), the container
+    header, the quality factor and a scale (1, 2, 4 or 8) and returns the plane reconstructed at 1 / scale of its size
+    """
+    progressive = header.bands is not None
+    height, width = (plane[0] if progressive else plane)[:2]
+    if scale == 1 and not progressive and header.tile_size is None and plane.table is None:
+        return decode_symbols(decode_plane(plane), (height, width), Q)
+
+    size = BLOCK_SIZE // scale
+    n_coefficients = get_zigzag_prefix(size)
+    padded_shape = get_padded_shape((height, width))
+    if progressive:
+        ordered_blocks = decode_bands(plane, header.bands, n_coefficients)
+    else:
+        coefficients = decode_runlength(decode_plane(plane))
+        ordered_blocks = coefficients[:len(coefficients) // 64 * 64].reshape(-1, 64)[:, :n_coefficients]
+        if header.tile_size is None:
+            tile_order, tile_starts = None, [0, len(ordered_blocks)]
+        else:
+            tile_order, tile_starts = get_tile_order(padded_shape, header.tile_size)
+        if plane.table is not None:
+            # Planes coded with built-in tables code DC as differences, restarting at every tile
+            accumulate_dc(ordered_blocks, tile_starts[:-1])
+        if tile_order is not None:
+            # Put the blocks coded tile by tile back in raster order
+            raster_blocks = np.empty_like(ordered_blocks)
+            raster_blocks[tile_order] = ordered_blocks
+            ordered_blocks = raster_blocks
+
+    if scale == 1:
+        image = inverse_transform(ordered_blocks, padded_shape, Q)
+    else:
+        image = inverse_transform_scaled(ordered_blocks, padded_shape, size, Q)
+    return image[:-(-height // scale), :-(-width // scale)]
+
+
+def decode_region(compressed_file, y0, x0, h, w, Q=None, workers=1):
+    """
+    Takes as argument the path to a compressed image and the top row, left column, height and width of a region of it
+    and returns the pixels of the region, exactly as jpeg_decompress would decode them, as grayscale or RGB.
+    Only the tiles of a tiled .bin file (see jpeg_compress) that the region touches are decoded, so the time it takes
+    grows with the size of the region rather than of the image; with workers above 1 they are decoded on a pool of
+    that many threads. Other files are decoded in full and cropped.
+    """
+    if is_jfif(compressed_file):
+        header, planes = None, None
+    else:
+        header, planes = read_container(compressed_file)
+    if header is None or header.tile_size is None:
+        image = jpeg_decompress(compressed_file, Q)
+        height, width = image.shape[:2]
+    else:
+        height, width = header.height, header.width
+    if h < 1 or w < 1 or y0 < 0 or x0 < 0 or y0 + h > height or x0 + w > width:
+        raise ValueError(f"Region ({y0}, {x0}, {h}, {w}) is empty or not inside the {height}x{width} image.")
+    if header is None or header.tile_size is None:
+        return image[y0:y0 + h, x0:x0 + w]
+
+    if Q is None:
+        Q = header.Q
+    rows, cols = (y0, y0 + h), (x0, x0 + w)
+    Y = decode_plane_region(planes[0], header.tile_size, Q, rows, cols, workers)
+    if header.channels == 1:
+        return merge_channels([Y])
+
+    horizontal, vertical = SAMPLING_FACTORS[header.subsampling]
+    Cb, Cr = (decode_chroma_region(plane, header.tile_size, Q, rows, cols, (vertical, horizontal), workers)
+              for plane in planes[1:])
+    return ycbcr_to_rgb(Y, Cb, Cr)
+
+
+@stage()
+def decode_plane_region(plane, tile_size, Q, rows, cols, workers=1):
+    """
+    Takes as argument a plane of a tiled container, the side of its tiles in blocks, the quality factor and the
+    (start, end) ranges of the rows and columns of a region of the plane, and returns the pixels of the region. Only
+    the tiles the region touches are Huffman decoded, each from the bit offset the container stores for it.
+    """
+    tile_pixels = tile_size * BLOCK_SIZE
+    padded_shape = get_padded_shape((plane.height, plane.width))
+    n_tile_col = -(-padded_shape[1] // tile_pixels)
+    tile_rows = range(rows[0] // tile_pixels, -(-rows[1] // tile_pixels))
+    tile_cols = range(cols[0] // tile_pixels, -(-cols[1] // tile_pixels))
+
+    payload = bitarray(buffer=plane.payload)
+    tile_ends = np.append(plane.tiles[1:], plane.n_bits)
+
+    def decode_tile(tile):
+        tile_row, tile_col = tile
+        index = tile_row * n_tile_col + tile_col
+        encoded_tile = payload[int(plane.tiles[index]):int(tile_ends[index])]
+        symbols = np.fromiter(iter_decode(plane, encoded_tile), dtype=np.int64)
+        # Tiles along the bottom and right edges are cut short by the padded plane
+        tile_shape = (min(tile_pixels, padded_shape[0] - tile_row * tile_pixels),
+                      min(tile_pixels, padded_shape[1] - tile_col * tile_pixels))
+        ordered_blocks = decode_runlength(symbols).reshape(-1, BLOCK_SIZE * BLOCK_SIZE)
+        if plane.table is not None:
+            accumulate_dc(ordered_blocks)
+        return inverse_transform(ordered_blocks, tile_shape, Q)
+
+    tiles = map_planes(decode_tile, [(row, col) for row in tile_rows for col in tile_cols], workers)
+    region = np.block([tiles[i:i + len(tile_cols)] for i in range(0, len(tiles), len(tile_cols))])
+    top, left = tile_rows[0] * tile_pixels, tile_cols[0] * tile_pixels
+    return region[rows[0] - top:rows[1] - top, cols[0] - left:cols[1] - left]
+
+
+def decode_chroma_region(plane, tile_size, Q, rows, cols, factors, workers=1):
+    """
+    Takes as argument a subsampled chrominance plane of a tiled container, the side of its tiles in blocks, the
+    quality factor, the (start, end) ranges of the rows and columns of a region of the image and the (vertical,
+    horizontal) subsampling factors, and returns the chrominance of the region upsampled to the image resolution,
+    exactly as upsample_channel upsamples the whole plane. Along subsampled axes the interpolation reaches one sample
+    beyond those the region covers, so these are decoded as well, and the edge samples of the plane are repeated.
+    """
+    windows = []
+    for (start, end), factor, n_samples in zip((rows, cols), factors, (plane.height, plane.width)):
+        context = factor - 1
+        first, last = start // factor - context, -(-end // factor) + context
+        windows.append((first, last, max(first, 0), min(last, n_samples)))
+    (top, bottom, row_start, row_end), (left, right, col_start, col_end) = windows
+
+    chroma = decode_plane_region(plane, tile_size, Q, (row_start, row_end), (col_start, col_end), workers)
+    chroma = cv2.copyMakeBorder(chroma, row_start - top, bottom - row_end, col_start - left, right - col_end,
+                                cv2.BORDER_REPLICATE)
+
+    vertical, horizontal = factors
+    upsampled = upsample_channel(chroma, (chroma.shape[0] * vertical, chroma.shape[1] * horizontal))
+    return upsampled[rows[0] - top * vertical:rows[1] - top * vertical,
+                     cols[0] - left * horizontal:cols[1] - left * horizontal]
+
+
+def merge_channels(channels):
+    """
+    Takes as argument the list of decoded planes, Y alone or Y, Cb and Cr each at its own sampled size, and returns
+    the grayscale or RGB image
+    """
+    if len(channels) == 1:
+        # Clip the values to valid image range
+        return (np.clip(channels[0], 0, 255)).astype(np.uint8)
+
+    Y, Cb_downsampled, Cr_downsampled = channels
+
+    # Upsample chrominance channels (nothing to do for 4:4:4)
+    Cb = upsample_channel(Cb_downsampled, Y.shape)
+    Cr = upsample_channel(Cr_downsampled, Y.shape)
+
+    # Convert back to RGB
+    return ycbcr_to_rgb(Y, Cb, Cr)
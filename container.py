@@ -0,0 +1,252 @@
+"""
+Versioned binary container for the JPEG codec, replacing the pickled dictionaries.
+
+Layout (all integers little-endian):
+
+    file header   magic b"JPGC", version (u8), channels (u8), Q (u8), subsampling mode (u8),
+                  height (u32), width (u32) of the original image
+    per plane     height (u32), width (u32) of the coded plane, number of table symbols (u32),
+                  payload size in bits (u64),
+                  code counts for lengths 1..16 (16 x u16),
+                  table symbols in canonical order (i16 each),
+                  Huffman payload, zero-padded to a whole number of bytes
+
+Huffman tables are stored as code lengths only (counts per length plus the symbols in canonical order), and the
+payloads are byte-aligned, so a memory-mapped file can be decoded straight from its buffer.
+
+A plane coded with a built-in table of huffman_tables.py stores none of it: its number of table symbols has the top
+bit set (STATIC_TABLE_FLAG) and holds the ID of the table in its low byte, and the code counts and table symbols are
+left out. Such planes only appear in versions 4 and 5 (below), which readers that do not know the flag reject.
+
+Version 2 (progressive) splits every plane into spectral bands, ranges of zigzag coefficient indices:
+
+    file header   as above, followed by the number of bands (u8) and the band limits (one u8 more than bands),
+                  e.g. 0 1 5 25 64
+    per plane     one record per band, laid out like a version 1 plane, holding the run-length symbols of the
+                  coefficients of that band in every block
+
+The DC coefficients (and the low frequencies needed for reduced-size previews) are then read without touching the
+Huffman payload of the rest of the plane.
+
+Version 3 (tiled) codes the blocks of every plane tile by tile, square tiles of blocks in raster order with the blocks
+of each tile in raster order, so that a region of the image can be decoded without the rest:
+
+    file header   as in version 1, followed by the side of the tiles in blocks (u8)
+    per plane     as in version 1, with the bit offset in the payload at which every tile starts (u64 each, one per
+                  tile in tile order) between the table symbols and the payload
+
+Run lengths never cross blocks, and the DC differences of planes coded with built-in tables restart at every tile, so
+every tile decodes on its own from its offset.
+
+Versions 4 and 5 are versions 1 and 3 whose planes may be coded with built-in tables, laid out the same way otherwise.
+The DC coefficients of such planes are coded as differences from the previous block. Progressive containers always
+store their tables.
+"""
+import mmap
+import struct
+from collections import namedtuple
+
+import numpy as np
+from bitarray import bitarray
+from bitarray.util import canonical_decode
+
+from blocks import BLOCK_SIZE
+from huffman import MAX_CODE_LENGTH, canonical_tables
+from huffman_tables import StaticTable, get_table
+from instrumentation import stage
+
+MAGIC = b"JPGC"
+VERSION = 1
+PROGRESSIVE_VERSION = 2
+TILED_VERSION = 3
+STATIC_VERSION = 4  # Version 1 with planes coded with built-in tables
+STATIC_TILED_VERSION = 5  # Version 3 with planes coded with built-in tables
+SUBSAMPLING_MODES = ("4:4:4", "4:2:2", "4:2:0")
+
+FILE_HEADER = struct.Struct("<4sBBBBII")
+PLANE_HEADER = struct.Struct("<IIIQ")
+STATIC_TABLE_FLAG = 1 << 31
+
+# bands holds the zigzag band limits of a progressive container and tile_size the side of the tiles (in blocks) of a
+# tiled container, each None for the other versions
+ContainerHeader = namedtuple("ContainerHeader",
+                             ["version", "channels", "Q", "subsampling", "height", "width", "bands", "tile_size"])
+# tiles holds the bit offsets of the tiles of a plane of a tiled container, and is None otherwise. table is the
+# StaticTable of a plane coded with a built-in table, which has no count and symbols, and is None otherwise.
+Plane = namedtuple("Plane", ["height", "width", "n_bits", "count", "symbols", "payload", "tiles", "table"],
+                   defaults=(None, None))
+
+
+def get_tile_count(plane_dims, tile_size):
+    """
+    Returns the number of tiles of tile_size x tile_size blocks that cover a plane of the given dimensions
+    """
+    tile_pixels = tile_size * BLOCK_SIZE
+    return -(-plane_dims[0] // tile_pixels) * -(-plane_dims[1] // tile_pixels)
+
+
+def pack_file_header(channels, Q, original_dims, subsampling="4:4:4", bands=None, tile_size=None,
+                     static_tables=False):
+    """
+    Returns the packed file header of a container, of a progressive container if band limits are given and of a
+    tiled container if a tile size is given. static_tables selects the version whose planes may be coded with
+    built-in tables.
+    """
+    if bands is not None and tile_size is not None:
+        raise ValueError("A container is either progressive or tiled, not both.")
+    if bands is not None and static_tables:
+        raise ValueError("A progressive container cannot be coded with built-in tables.")
+    if tile_size is not None and not 1 <= tile_size <= 255:
+        raise ValueError("Tile size must be between 1 and 255 blocks.")
+
+    if bands is not None:
+        version = PROGRESSIVE_VERSION
+    elif tile_size is not None:
+        version = STATIC_TILED_VERSION if static_tables else TILED_VERSION
+    else:
+        version = STATIC_VERSION if static_tables else VERSION
+    header = FILE_HEADER.pack(MAGIC, version, channels, Q,
+                              SUBSAMPLING_MODES.index(subsampling), original_dims[0], original_dims[1])
+    if bands is not None:
+        return header + bytes([len(bands) - 1, *bands])
+    if tile_size is not None:
+        return header + bytes([tile_size])
+    return header
+
+
+def pack_plane_header(huffman_dict, plane_dims, n_bits, tile_offsets=None):
+    """
+    Returns the packed header and code length table of a plane, which come right before its payload of n_bits bits,
+    followed by the bit offsets of its tiles if given. For a StaticTable, only its ID is stored.
+    """
+    if isinstance(huffman_dict, StaticTable):
+        header = PLANE_HEADER.pack(plane_dims[0], plane_dims[1], STATIC_TABLE_FLAG | huffman_dict.id, n_bits)
+    else:
+        count, symbols = canonical_tables(huffman_dict)
+        if symbols.min() < -2 ** 15 or symbols.max() >= 2 ** 15:
+            raise ValueError("Symbols must fit in 16 bits to be stored in the container.")
+
+        code_counts = np.zeros(MAX_CODE_LENGTH, dtype="<u2")
+        code_counts[:len(count) - 1] = count[1:]
+        header = (PLANE_HEADER.pack(plane_dims[0], plane_dims[1], len(symbols), n_bits)
+                  + code_counts.tobytes() + symbols.astype("<i2").tobytes())
+    if tile_offsets is None:
+        return header
+    return header + np.asarray(tile_offsets, dtype="<u8").tobytes()
+
+
+@stage()
+def write_container(compressed_file, planes, Q, original_dims, subsampling="4:4:4", bands=None, tile_size=None):
+    """
+    Takes as argument the path to a .bin file, a list of (huffman_stream, huffman_dict, plane_dims) tuples
+    (one per channel), the quality factor, the original image dimensions and the chroma subsampling mode
+    and writes them to the file. Returns the number of bytes written.
+    If the zigzag band limits are given, a progressive container is written and every plane is a list of such
+    tuples instead, one per band.
+    If the tile size is given, a tiled container is written and every tuple also holds the bit offsets of the tiles
+    of the plane (huffman_stream, huffman_dict, plane_dims, tile_offsets).
+    """
+    static_tables = any(isinstance(huffman_dict, StaticTable)
+                        for plane in planes for _, huffman_dict, *_ in (plane if bands else [plane]))
+    data = bytearray(pack_file_header(len(planes), Q, original_dims, subsampling, bands, tile_size, static_tables))
+
+    for plane in planes:
+        for huffman_stream, huffman_dict, plane_dims, *tile_offsets in (plane if bands else [plane]):
+            if tile_size is not None and len(tile_offsets[0]) != get_tile_count(plane_dims, tile_size):
+                raise ValueError("Number of tile offsets does not match the tiles of the plane.")
+            data += pack_plane_header(huffman_dict, plane_dims, len(huffman_stream),
+                                      tile_offsets[0] if tile_size is not None else None)
+            data += huffman_stream.tobytes()  # Pads the last byte with zeros
+
+    with open(compressed_file, "wb") as f:
+        f.write(data)
+    return len(data)
+
+
+def parse_container(buffer):
+    """
+    Parses a container held in any bytes-like object and returns its header along with a list of planes.
+    The planes of a progressive container are tuples of planes, one per band.
+    The table arrays, tile offsets and payloads of the planes are views into the buffer, nothing is copied.
+    """
+    magic, version, channels, Q, subsampling, height, width = FILE_HEADER.unpack_from(buffer, 0)
+    if magic != MAGIC:
+        raise ValueError("Not a compressed image container.")
+    if version not in (VERSION, PROGRESSIVE_VERSION, TILED_VERSION, STATIC_VERSION, STATIC_TILED_VERSION):
+        raise ValueError(f"Unsupported container version {version}.")
+    static_tables = version in (STATIC_VERSION, STATIC_TILED_VERSION)
+
+    offset = FILE_HEADER.size
+    bands = tile_size = None
+    if version == PROGRESSIVE_VERSION:
+        n_bands = buffer[offset]
+        bands = tuple(buffer[offset + 1:offset + n_bands + 2])
+        offset += n_bands + 2
+    elif version in (TILED_VERSION, STATIC_TILED_VERSION):
+        tile_size = buffer[offset]
+        offset += 1
+    header = ContainerHeader(version, channels, Q, SUBSAMPLING_MODES[subsampling], height, width, bands, tile_size)
+
+    planes = []
+    for _ in range(channels * (len(bands) - 1 if bands else 1)):
+        plane_height, plane_width, n_table, n_bits = PLANE_HEADER.unpack_from(buffer, offset)
+        payload_size = (n_bits + 7) // 8
+        offset += PLANE_HEADER.size
+
+        count = symbols = table = None
+        if n_table & STATIC_TABLE_FLAG:
+            if not static_tables:
+                raise ValueError(f"Plane coded with a built-in table in a container of version {version}.")
+            table = get_table(n_table & 0xFF)
+        else:
+            count = np.zeros(MAX_CODE_LENGTH + 1, dtype=np.uint32)  # count[0] is the (empty) number of 0-bit codes
+            count[1:] = np.frombuffer(buffer, dtype="<u2", count=MAX_CODE_LENGTH, offset=offset)
+            offset += 2 * MAX_CODE_LENGTH
+
+            symbols = np.frombuffer(buffer, dtype="<i2", count=n_table, offset=offset)
+            offset += 2 * n_table
+
+        tiles = None
+        if tile_size is not None:
+            n_tiles = get_tile_count((plane_height, plane_width), tile_size)
+            tiles = np.frombuffer(buffer, dtype="<u8", count=n_tiles, offset=offset)
+            offset += 8 * n_tiles
+
+        payload = memoryview(buffer)[offset:offset + payload_size]
+        offset += payload_size
+
+        planes.append(Plane(plane_height, plane_width, n_bits, count, symbols, payload, tiles, table))
+
+    if bands:
+        n_bands = len(bands) - 1
+        planes = [tuple(planes[i:i + n_bands]) for i in range(0, len(planes), n_bands)]
+    return header, planes
+
+
+def read_container(compressed_file):
+    """
+    Memory-maps the .bin file at the given path and returns its header along with a list of planes.
+    """
+    with open(compressed_file, "rb") as f:
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)  # Stays valid after the file is closed
+    return parse_container(buffer)
+
+
+def iter_decode(plane, encoded_string):
+    """
+    Returns an iterator over the symbols of a bitarray coded with the Huffman table of the given plane
+    """
+    if plane.table is not None:
+        return encoded_string.decode(plane.table.decode_tree)
+    return canonical_decode(encoded_string, plane.count, plane.symbols)
+
+
+@stage()
+def decode_plane(plane):
+    """
+    Decodes the Huffman payload of a plane and returns its run-length encoded symbol stream as a NumPy array.
+    """
+    # Bitarray over the (possibly memory-mapped) payload, cut back to its true length. The cut copies the payload once,
+    # since a bitarray over a foreign buffer cannot be resized, but the padding bits must not be decoded as a symbol
+    encoded_string = bitarray(buffer=plane.payload)[:plane.n_bits]
+    return np.fromiter(iter_decode(plane, encoded_string), dtype=np.int64)
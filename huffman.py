@@ -1,4 +1,11 @@
-from bitarray import bitarray
+import heapq
+import numpy as np
+from bitarray import bitarray, decodetree
+from bitarray.util import canonical_decode, int2ba
+
+from instrumentation import stage
+
+MAX_CODE_LENGTH = 16  # Longest Huffman code allowed, same limit as the JPEG standard
 
 class HuffmanNode:
     def __init__(self, symbol=None, frequency=None):
@@ -11,91 +18,221 @@ class HuffmanNode:
         # Compare nodes by frequency (used for sorting)
         return self.frequency < other.frequency
 
-    def traverse(self, prefix=bitarray(), code_table=None):
+    def code_lengths(self):
         """
-        Recursively traverse the Huffman tree to build the code table given
-        prefix (bitarray): current prefix code (binary sequence) and code_table (dict): dictionary to store symbol-to-code mappings.
+        Walks the Huffman tree iteratively and returns a dictionary mapping every leaf symbol to its depth,
+        i.e. the length of its Huffman code.
         """
-        if code_table is None:
-            code_table = {}
-
-        if self.left is None and self.right is None:  # Leaf node
-            code_table[self.symbol] = prefix
-        else:
-            if self.left:
-                self.left.traverse(prefix + bitarray('0'), code_table)
-            if self.right:
-                self.right.traverse(prefix + bitarray('1'), code_table)
+        code_lengths = {}
+        stack = [(self, 0)]
+        while stack:
+            node, depth = stack.pop()
+            if node.left is None and node.right is None:  # Leaf node
+                code_lengths[node.symbol] = max(depth, 1)  # A lone symbol still needs a 1-bit code
+            else:
+                if node.left:
+                    stack.append((node.left, depth + 1))
+                if node.right:
+                    stack.append((node.right, depth + 1))
+        return code_lengths
+
+    def traverse(self, max_length=MAX_CODE_LENGTH):
+        """
+        Builds the code table of the Huffman tree and returns a dictionary of symbol-to-code (bitarray) mappings.
+        The code lengths are taken from the tree, limited to max_length bits, and assigned canonical codes.
+        """
+        code_lengths = limit_code_lengths(self.code_lengths(), max_length)
+        return canonical_codes(code_lengths)
 
-        return code_table
+def extract_counts(array):
+    """
+    Returns the distinct symbols of the array and their integer occurrence counts as two NumPy arrays.
+    """
+    return np.unique(np.asarray(array, dtype=np.int64), return_counts=True)
 
 def extract_probs(array):
     """
     Returns a dictionary of symbols to their probabilities.
     """
-    # Count occurrences of each symbol
-    symbols_dict = {}
-    for symbol in array:
-        symbols_dict[symbol] = symbols_dict.get(symbol, 0) + 1
-
-    # Calculate probabilities
-    total_length = len(array)
-    for symbol in symbols_dict:
-        symbols_dict[symbol] /= total_length
-    
-    return symbols_dict
+    symbols, counts = extract_counts(array)
+    return dict(zip(symbols.tolist(), (counts / len(array)).tolist()))
 
+@stage()
 def generate_huffman_tree(array):
     """
     Generates the Huffman tree for a given array of symbols and returns the root node of the Huffman tree
     """
-    # Extract probabilities and create nodes
-    symbols_dict = extract_probs(array)
-    sorted_nodes = [HuffmanNode(symbol=symbol, frequency=symbols_dict[symbol]) for symbol in symbols_dict]
-
-    # Build the tree
-    while len(sorted_nodes) > 1:
-        # Sort nodes by frequency
-        sorted_nodes = sorted(sorted_nodes)
+    # Integer counts keep the tree exact; probabilities would only rescale them
+    symbols, counts = extract_counts(array)
+    return build_huffman_tree(symbols, counts)
 
-        # Merge the two smallest nodes
-        smallest, second_smallest = sorted_nodes[0], sorted_nodes[1]
+@stage()
+def build_huffman_tree(symbols, counts):
+    """
+    Generates the Huffman tree from arrays of distinct symbols and their occurrence counts
+    and returns the root node of the Huffman tree
+    """
+    # Heap entries carry an insertion counter so ties are broken deterministically without comparing nodes
+    heap = [(count, order, HuffmanNode(symbol=symbol, frequency=count))
+            for order, (symbol, count) in enumerate(zip(symbols.tolist(), counts.tolist()))]
+    heapq.heapify(heap)
+    order = len(heap)
+
+    # Build the tree by repeatedly merging the two least frequent nodes
+    while len(heap) > 1:
+        _, _, smallest = heapq.heappop(heap)
+        _, _, second_smallest = heapq.heappop(heap)
         new_node = HuffmanNode(symbol=None, frequency=smallest.frequency + second_smallest.frequency)
         new_node.left = smallest
         new_node.right = second_smallest
-
-        # Replace the two smallest nodes with the new node
-        sorted_nodes = sorted_nodes[2:]
-        sorted_nodes.append(new_node)
+        heapq.heappush(heap, (new_node.frequency, order, new_node))
+        order += 1
 
     # Return the root of the Huffman tree
-    return sorted_nodes[0]
+    return heap[0][2]
+
+class SymbolHistogram:
+    """
+    Integer occurrence counts of 16-bit symbols, accumulated one chunk at a time so that the full symbol stream never
+    has to be held in memory. Histograms counted by separate workers can be merged into one before building the table.
+    """
+    OFFSET = 2 ** 15  # Maps the int16 symbol range onto histogram bins
+
+    def __init__(self):
+        self.counts = np.zeros(2 ** 16, dtype=np.int64)
+
+    def update(self, symbols):
+        """
+        Adds the occurrences of the symbols in the given chunk
+        """
+        values, counts = np.unique(np.asarray(symbols, dtype=np.int64), return_counts=True)
+        if len(values) and (values[0] < -self.OFFSET or values[-1] >= self.OFFSET):
+            raise ValueError("Symbols must fit in 16 bits to be counted.")
+        self.counts[values + self.OFFSET] += counts
+
+    def merge(self, other):
+        """
+        Adds the counts of another histogram to this one and returns it
+        """
+        self.counts += other.counts
+        return self
+
+    def huffman_tree(self):
+        """
+        Generates the Huffman tree of the counted symbols and returns its root node
+        """
+        present = np.flatnonzero(self.counts)
+        return build_huffman_tree(present - self.OFFSET, self.counts[present])
+
+def limit_code_lengths(code_lengths, max_length=MAX_CODE_LENGTH):
+    """
+    Takes a dictionary of symbol-to-code-length mappings and returns one in which no code is longer than max_length,
+    using the length adjustment procedure of the JPEG standard (Annex K.3). Symbols keep their relative order,
+    so shorter codes still go to the more frequent symbols.
+    """
+    longest = max(code_lengths.values())
+    if longest <= max_length:
+        return code_lengths
+    if len(code_lengths) > 2 ** max_length:
+        raise ValueError(f"{len(code_lengths)} symbols cannot be coded with at most {max_length} bits.")
+
+    # Number of codes of each length
+    bits = [0] * (longest + 1)
+    for length in code_lengths.values():
+        bits[length] += 1
+
+    # Move pairs of over-long codes up the tree, taking a prefix from a shorter code to keep it complete
+    for i in range(longest, max_length, -1):
+        while bits[i] > 0:
+            j = i - 2
+            while bits[j] == 0:
+                j -= 1
+            bits[i] -= 2
+            bits[i - 1] += 1
+            bits[j + 1] += 2
+            bits[j] -= 1
+
+    # Hand out the new lengths in order of the old ones
+    ordered_symbols = sorted(code_lengths, key=lambda symbol: (code_lengths[symbol], symbol))
+    new_lengths = [length for length in range(1, max_length + 1) for _ in range(bits[length])]
+    return dict(zip(ordered_symbols, new_lengths))
+
+def canonical_codes(code_lengths):
+    """
+    Takes a dictionary of symbol-to-code-length mappings and returns the canonical Huffman code table as a
+    dictionary of symbol-to-code (bitarray) mappings. Codes are assigned in (length, symbol) order.
+    """
+    code_table = {}
+    code = 0
+    previous_length = 0
+    for symbol in sorted(code_lengths, key=lambda symbol: (code_lengths[symbol], symbol)):
+        length = code_lengths[symbol]
+        code <<= length - previous_length  # Append zeros when moving on to longer codes
+        code_table[symbol] = int2ba(code, length)
+        code += 1
+        previous_length = length
+    return code_table
 
 def encode_huffman(symbols, huffman_dict):
     """
     Encodes a sequence of symbols using a dictionary mapping symbols to their Huffman codes (bitarray objects) into a single Huffman-encoded bitarray.
     """
     encoded_stream = bitarray()
-    for symbol in symbols:
-        if symbol not in huffman_dict:
-            raise ValueError(f"Symbol {symbol} not found in Huffman dictionary.")
-        encoded_stream.extend(huffman_dict[symbol])  # Append the corresponding bitarray for the symbol
+    try:
+        # Looks every symbol up and appends its code in C rather than one Python call per symbol
+        encoded_stream.encode(huffman_dict, symbols)
+    except ValueError as error:
+        raise ValueError(f"Symbol not found in Huffman dictionary ({error}).") from None
     return encoded_stream
 
+def encode_huffman_chunks(chunks, huffman_dict, write):
+    """
+    Encodes an iterable of symbol chunks with the Huffman dictionary, passing the encoded bytes to write as soon as
+    they are complete, and returns the total number of bits. Only the bits of an incomplete last byte are carried from
+    one chunk to the next, and the very last byte is padded with zeros.
+    """
+    n_bits = 0
+    carry = bitarray()
+    for symbols in chunks:
+        bits = carry + encode_huffman(np.asarray(symbols).tolist(), huffman_dict)
+        n_whole = len(bits) // 8 * 8
+        write(bits[:n_whole].tobytes())
+        carry = bits[n_whole:]
+        n_bits += n_whole
+
+    write(carry.tobytes())
+    return n_bits + len(carry)
+
+@stage()
 def decode_huffman(encoded_string, huffman_dict):
     """
-    Decodes a Huffman-encoded bitarray using dictionary mapping symbols to their Huffman codes (bitarray objects) into the original sequence of symbols.
+    Decodes a Huffman-encoded bitarray using dictionary mapping symbols to their Huffman codes (bitarray objects) and
+    returns the original sequence of symbols as a NumPy integer array.
     """
-    # Create a reverse mapping from Huffman codes (as strings) to symbols
-    reverse_dict = {code.to01(): symbol for symbol, code in huffman_dict.items()}
+    # bitarray's decodetree is a prefix tree walked in C, so the whole stream is decoded without building
+    # an intermediate Python string per bit
+    decode_tree = decodetree(huffman_dict)
+    return np.fromiter(encoded_string.decode(decode_tree), dtype=np.int64)
 
-    decoded_symbols = []
-    buffer = ""
-    for bit in encoded_string:
-        buffer += str(bit)  # Convert bit (int) to string before concatenation
-        if buffer in reverse_dict:
-            decoded_symbols.append(reverse_dict[buffer])
-            buffer = ""  # Reset buffer after finding a match
+def canonical_tables(huffman_dict):
+    """
+    Takes a canonical Huffman dictionary and returns its compact form: an array with the number of codes of each
+    length (index 0 unused) and the array of symbols in canonical (length, symbol) order. The codes themselves
+    follow from these two arrays, so they are all that needs to be stored.
+    """
+    code_lengths = {symbol: len(code) for symbol, code in huffman_dict.items()}
+    if canonical_codes(code_lengths) != huffman_dict:
+        raise ValueError("Huffman dictionary is not canonical and cannot be stored as code lengths only.")
 
-    return decoded_symbols
+    count = np.zeros(max(code_lengths.values()) + 1, dtype=np.uint32)
+    for length in code_lengths.values():
+        count[length] += 1
+    symbols = np.array(sorted(code_lengths, key=lambda symbol: (code_lengths[symbol], symbol)), dtype=np.int64)
+    return count, symbols
 
+def decode_canonical(encoded_string, count, symbols):
+    """
+    Decodes a canonical Huffman-encoded bitarray given the tables returned by canonical_tables and returns the
+    sequence of symbols as a NumPy integer array, without building a dictionary of codes.
+    """
+    return np.fromiter(canonical_decode(encoded_string, count, symbols), dtype=np.int64)
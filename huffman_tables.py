@@ -0,0 +1,177 @@
+"""
+Built-in static Huffman tables for the run-length symbols of the JPEG codec, trained offline on a corpus.
+
+A .bin plane coded with a built-in table only stores the ID of the table instead of its code lengths, and the encoder
+skips counting the symbols and building a tree. Like in baseline JPEG, the DC coefficient of every block of such a
+plane is coded as its difference with the one of the block before, which makes it as predictable across images as
+the other symbols. There is a luminance and a chrominance table for every range of quality factors, and the encoder
+picks the tables of the range the quality factor falls in (select_table). The tables live in huffman_tables.json;
+their IDs are never reused, so a retrained table is added under a new ID and files written with the old one still
+decode.
+
+Symbols the corpus never produced have no code of their own. They are coded as the escape code of the table followed
+by the 16 bits of their two's complement, so every int16 symbol can be coded by every table.
+
+Run as a script, the module trains a luminance and a chrominance table per range of quality factors (here 1-29,
+30-59 and 60-100) on a set of images and adds them to the file:
+
+    python huffman_tables.py images/*.png --ranges 1 30 60 101 --name caltech
+"""
+import argparse
+import functools
+import json
+import os
+
+import numpy as np
+from bitarray import bitarray, decodetree
+
+from huffman import SymbolHistogram, build_huffman_tree, canonical_codes, limit_code_lengths
+
+TABLES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "huffman_tables.json")
+ESCAPE = 2 ** 15  # Symbol of the escape code, just outside the int16 range of the run-length symbols
+ESCAPE_BITS = 16
+
+PLANE_KINDS = ("luma", "chroma")  # Luminance (and grayscale) planes, and chrominance planes
+
+
+class StaticTable(dict):
+    """
+    A built-in Huffman table: a dictionary mapping every int16 symbol to its code (bitarray), either its own code or
+    the escape code followed by its 16 bits, along with the ID, name, kind of plane and range of quality factors of
+    the table and its decode tree
+    """
+
+    def __init__(self, table_id, name, code_lengths, plane="luma", quality=(1, 101)):
+        codes = canonical_codes(code_lengths)
+        escape = codes.pop(ESCAPE)
+
+        # The 16-bit two's complement of every symbol, big-endian, cut into the 16-bit suffix of each escape code
+        raw = bitarray()
+        raw.frombytes(np.arange(-2 ** 15, 2 ** 15).astype(">i2").tobytes())
+        super().__init__((symbol, escape + raw[i * ESCAPE_BITS:(i + 1) * ESCAPE_BITS])
+                         for i, symbol in enumerate(range(-2 ** 15, 2 ** 15)) if symbol not in codes)
+        self.update(codes)
+
+        self.id = table_id
+        self.name = name
+        self.plane = plane
+        self.quality = tuple(quality)
+        self.code_lengths = code_lengths
+        self.decode_tree = decodetree(self)
+
+
+def read_tables(tables_file=TABLES_FILE):
+    """
+    Returns the dictionary of table ID to {"name", "plane", "quality", "symbols", "lengths"} entries stored in a
+    tables file, or an empty one if the file does not exist
+    """
+    if not os.path.exists(tables_file):
+        return {}
+    with open(tables_file) as f:
+        return {int(table_id): entry for table_id, entry in json.load(f)["tables"].items()}
+
+
+@functools.lru_cache(maxsize=None)
+def builtin_tables():
+    """
+    Returns the entries of the built-in tables file, read once per process
+    """
+    return read_tables()
+
+
+@functools.lru_cache(maxsize=None)
+def get_table(table_id):
+    """
+    Returns the built-in StaticTable with the given ID. Tables are built once per process, on first use.
+    """
+    entry = builtin_tables().get(table_id)
+    if entry is None:
+        raise ValueError(f"Unknown built-in Huffman table {table_id}.")
+    return StaticTable(table_id, entry["name"], dict(zip(entry["symbols"], entry["lengths"])), entry["plane"],
+                       entry["quality"])
+
+
+def select_table(plane, Q):
+    """
+    Returns the built-in StaticTable for a kind of plane ("luma" or "chroma") at the quality factor Q: the one whose
+    range of quality factors holds Q or, failing that, the one with the closest range. The newest table wins ties.
+    """
+    candidates = [(table_id, entry) for table_id, entry in builtin_tables().items() if entry["plane"] == plane]
+    if not candidates:
+        raise ValueError(f"No built-in Huffman table for {plane} planes.")
+
+    def distance(candidate):
+        table_id, entry = candidate
+        low, high = entry["quality"]
+        return max(low - Q, Q - high + 1, 0), -table_id
+    return get_table(min(candidates, key=distance)[0])
+
+
+def train_code_lengths(histogram):
+    """
+    Takes as argument the SymbolHistogram of a corpus and returns the code lengths of its static table, a dictionary
+    mapping every symbol of the corpus and ESCAPE to the length of its code. The escape code is given the count of
+    the symbols seen only once in the corpus, the Good-Turing estimate of how often a symbol the corpus never
+    produced turns up.
+    """
+    present = np.flatnonzero(histogram.counts)
+    counts = histogram.counts[present]
+    escape_count = max(int(np.count_nonzero(counts == 1)), 1)
+
+    symbols = np.append(present - SymbolHistogram.OFFSET, ESCAPE)
+    tree = build_huffman_tree(symbols, np.append(counts, escape_count))
+    return limit_code_lengths(tree.code_lengths())
+
+
+def add_table(code_lengths, name, plane, quality, tables_file=TABLES_FILE):
+    """
+    Stores a table of code lengths for a kind of plane and a (low, high) range of quality factors, high excluded,
+    in the tables file under the next free ID and returns that ID
+    """
+    tables = read_tables(tables_file)
+    table_id = max(tables, default=0) + 1
+    if table_id > 255:
+        raise ValueError("No table ID left, IDs are stored in a single byte.")
+
+    ordered = sorted(code_lengths, key=lambda symbol: (code_lengths[symbol], symbol))
+    tables[table_id] = {"name": name, "plane": plane, "quality": list(quality), "symbols": ordered,
+                        "lengths": [code_lengths[symbol] for symbol in ordered]}
+    with open(tables_file, "w") as f:
+        json.dump({"tables": {str(key): entry for key, entry in sorted(tables.items())}}, f)
+    return table_id
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Train static Huffman tables on a corpus of images")
+    parser.add_argument("images", nargs="+", help="Images of the corpus.")
+    parser.add_argument("--ranges", type=int, nargs="+", default=[1, 30, 60, 101],
+                        help="Limits of the ranges of quality factors to train tables for (default: 1 30 60 101).")
+    parser.add_argument("--step", type=int, default=5,
+                        help="Step between the quality factors the symbols are counted at (default: 5).")
+    parser.add_argument("--subsampling", default="4:2:0", help="Chroma subsampling (default: 4:2:0).")
+    parser.add_argument("--name", default="corpus", help="Name the tables are stored under, with the plane and range.")
+    parser.add_argument("--tables-file", default=TABLES_FILE, help="Tables file to add the tables to.")
+    args = parser.parse_args()
+
+    # The codec imports the container, which imports this module, so it is only imported when training
+    from blocks import quantize_blocks
+    from codec import difference_dc, read_image, runlength_encode_blocks, transform_image
+
+    ranges = list(zip(args.ranges, args.ranges[1:]))
+    histograms = {(plane, quality): SymbolHistogram() for plane in PLANE_KINDS for quality in ranges}
+    for image_path in args.images:
+        transformed = transform_image(read_image(image_path, colour=True), True, args.subsampling)
+        for low, high in ranges:
+            for Q in range(low, high, args.step):
+                for plane, (dct_coeff, _) in zip(("luma", "chroma", "chroma"), transformed.planes):
+                    symbols = runlength_encode_blocks(difference_dc(quantize_blocks(dct_coeff, Q)))
+                    histograms[plane, (low, high)].update(symbols)
+
+    for (plane, quality), histogram in histograms.items():
+        name = f"{args.name}-{plane}-q{quality[0]}-{quality[1] - 1}"
+        table_id = add_table(train_code_lengths(histogram), name, plane, quality, args.tables_file)
+        print(f"Table {table_id}: {name}, {np.count_nonzero(histogram.counts)} symbols")
+
+
+if __name__ == "__main__":
+    main()
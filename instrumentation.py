@@ -0,0 +1,215 @@
+"""
+Opt-in timing and memory instrumentation of the pipeline stages of both codecs.
+
+Functions are marked as stages with the stage decorator, and blocks of code with the timed context manager. Nothing is
+recorded unless a trace is active, and a stage outside of a trace costs a single context variable lookup. Inside
+
+    with tracing(image="cat.png", memory=True) as trace:
+        jpeg_compress("cat.png", 50, "cat.bin", colour=True)
+
+every stage that runs appends an event with its name, nesting depth, start time and wall time to the trace and, with
+memory set, the memory it allocated (net, and peak above its start) as counted by tracemalloc. trace.to_dict() is a
+JSON-serializable record of the image, write_trace appends it to a JSON lines file and aggregate_traces sums the stages
+of such a file. Run as a script, this module prints the summary of a trace file:
+
+    python instrumentation.py traces.jsonl
+
+A trace belongs to the context it was started in. Work handed to other threads is only recorded if it runs in a copy
+of that context (contextvars.copy_context), as the colour planes of the JPEG codec do. tracemalloc counts the whole
+process, so the memory of stages running at the same time is counted towards each of them.
+"""
+import functools
+import json
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
+
+_trace = ContextVar("trace", default=None)  # The active Trace, None when instrumentation is off
+_frames = ContextVar("frames", default=())  # The stages open in this context, innermost last
+_DISABLED = nullcontext()
+
+
+class Trace:
+    """
+    The events recorded for one image, in the order their stages started, along with the fields describing the image
+    """
+
+    def __init__(self, memory=False, **fields):
+        self.fields = fields
+        self.memory = memory
+        self.events = []
+        self.start = time.perf_counter()
+        self.seconds = None
+
+    def to_dict(self):
+        """
+        Returns the trace as a dictionary of its fields, total wall time and list of stage events
+        """
+        return dict(self.fields, seconds=self.seconds, stages=self.events)
+
+
+class _Frame:
+    """
+    A stage in progress: its event, and the traced memory when it started along with the highest peak of memory seen
+    by its finished sub-stages, which reset the tracemalloc peak
+    """
+    __slots__ = ("event", "start", "memory_start", "child_peak")
+
+    def __init__(self, event, memory):
+        self.event = event
+        self.child_peak = 0
+        if memory:
+            self.memory_start, outer_peak = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+            # The enclosing stage loses the peak reached so far to the reset, so it is handed to it directly
+            parents = _frames.get()
+            if parents:
+                parents[-1].child_peak = max(parents[-1].child_peak, outer_peak)
+        self.start = time.perf_counter()
+
+
+class _Stage:
+    """
+    Context manager recording one run of a stage in the active trace
+    """
+    __slots__ = ("name", "trace", "frame", "token")
+
+    def __init__(self, name, trace):
+        self.name = name
+        self.trace = trace
+
+    def __enter__(self):
+        frames = _frames.get()
+        event = {"stage": self.name, "depth": len(frames)}
+        self.trace.events.append(event)
+        self.frame = _Frame(event, self.trace.memory)
+        event["start"] = self.frame.start - self.trace.start
+        self.token = _frames.set(frames + (self.frame,))
+        return event
+
+    def __exit__(self, *exc_info):
+        frame = self.frame
+        frame.event["seconds"] = time.perf_counter() - frame.start
+        _frames.reset(self.token)
+        if self.trace.memory:
+            current, peak = tracemalloc.get_traced_memory()
+            peak = max(peak, frame.child_peak)
+            frame.event["allocated"] = current - frame.memory_start
+            frame.event["peak"] = peak - frame.memory_start
+            parents = _frames.get()
+            if parents:
+                parents[-1].child_peak = max(parents[-1].child_peak, peak)
+        return False
+
+
+def timed(name):
+    """
+    Takes as argument the name of a stage and returns a context manager recording the block it wraps as that stage
+    in the active trace, or doing nothing when no trace is active
+    """
+    trace = _trace.get()
+    return _DISABLED if trace is None else _Stage(name, trace)
+
+
+def stage(name=None):
+    """
+    Decorator recording every call of the function as a stage of the active trace, named after the function unless
+    a name is given
+    """
+    def decorate(function):
+        label = name or function.__name__
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            trace = _trace.get()
+            if trace is None:
+                return function(*args, **kwargs)
+            with _Stage(label, trace):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+@contextmanager
+def tracing(memory=False, **fields):
+    """
+    Context manager that records the stages run inside it into a new Trace, which it yields. The keyword arguments are
+    stored with the trace, e.g. image=path. With memory set, tracemalloc is started for the duration of the trace
+    (unless it is running already) and every event also holds the bytes its stage allocated.
+    """
+    start_tracemalloc = memory and not tracemalloc.is_tracing()
+    if start_tracemalloc:
+        tracemalloc.start()
+    trace = Trace(memory, **fields)
+    token = _trace.set(trace)
+    frames_token = _frames.set(())
+    try:
+        yield trace
+    finally:
+        trace.seconds = time.perf_counter() - trace.start
+        _frames.reset(frames_token)
+        _trace.reset(token)
+        if start_tracemalloc:
+            tracemalloc.stop()
+
+
+def run_traced(function, fields, *args, memory=False, **kwargs):
+    """
+    Calls function(*args, **kwargs) inside a new trace with the given fields and returns its result along with the
+    trace as a dictionary. Pool workers run their jobs through it, so that the traces come back with the results.
+    """
+    with tracing(memory, **fields) as trace:
+        result = function(*args, **kwargs)
+    return result, trace.to_dict()
+
+
+def write_trace(file, record):
+    """
+    Appends a trace dictionary to an open text file as one line of JSON
+    """
+    file.write(json.dumps(record) + "\n")
+    file.flush()
+
+
+def read_traces(trace_file):
+    """
+    Returns the list of trace dictionaries stored in a JSON lines file
+    """
+    with open(trace_file) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def aggregate_traces(records):
+    """
+    Takes as argument a list of trace dictionaries and returns a dictionary mapping each stage name to its number of
+    calls, total and largest wall time and, if memory was traced, largest peak memory, in order of first appearance
+    """
+    summary = {}
+    for record in records:
+        for event in record["stages"]:
+            total = summary.setdefault(event["stage"], {"calls": 0, "seconds": 0.0, "max_seconds": 0.0})
+            total["calls"] += 1
+            total["seconds"] += event["seconds"]
+            total["max_seconds"] = max(total["max_seconds"], event["seconds"])
+            if "peak" in event:
+                total["max_peak"] = max(total.get("max_peak", 0), event["peak"])
+    return summary
+
+
+def main():
+    if len(sys.argv) != 2:
+        print("Usage: python instrumentation.py <traces.jsonl>")
+        sys.exit(1)
+
+    records = read_traces(sys.argv[1])
+    print(f"{len(records)} traces, {sum(record['seconds'] for record in records):.3f}s in total")
+    print(f"{'stage':<32} {'calls':>7} {'seconds':>10} {'max s':>9} {'max peak MB':>12}")
+    for name, total in aggregate_traces(records).items():
+        peak = f"{total['max_peak'] / 1e6:>12.1f}" if "max_peak" in total else f"{'':>12}"
+        print(f"{name:<32} {total['calls']:>7} {total['seconds']:>10.3f} {total['max_seconds']:>9.3f} {peak}")
+
+
+if __name__ == "__main__":
+    main()
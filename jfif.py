@@ -0,0 +1,613 @@
+"""
+Baseline JPEG (JFIF) writer and reader, so that compressed images can be opened by any image viewer or library.
+
+The writer turns the DCT coefficients of the codec into a standard baseline sequential stream (SOF0): the blocks are
+level shifted, quantized with 8-bit tables (DQT), their DC terms are coded as differences from the previous block of
+the same component and their AC terms as (run, size) symbols with EOB and ZRL, using Huffman tables optimized for the
+image (DHT). Colour images are written as one interleaved YCbCr scan with subsampled chrominance (4:2:0 by default),
+grayscale ones as a single component.
+
+The reader decodes baseline and extended sequential Huffman-coded files, such as those written by libjpeg, with any
+sampling factors, restart intervals and number of scans. Only the boundaries of the blocks are found one block at a
+time: the AC terms of a block are decoded by bitarray in C, with a decode tree whose words are a code together with
+the extra bits that follow it, and are then placed in (N, 64) coefficient arrays with NumPy. These go through the
+same batched inverse transform as the planes of the .bin container.
+"""
+import functools
+from collections import namedtuple
+from itertools import chain
+
+import numpy as np
+from bitarray import bitarray, decodetree
+from bitarray.util import ba2int, int2ba
+
+from blocks import BLOCK_SIZE, ZIGZAG_ORDER, get_padded_shape, get_quantization_matrix, inverse_transform, quantize_blocks
+from huffman import build_huffman_tree, canonical_codes, canonical_tables, limit_code_lengths
+
+# Markers (the byte that follows 0xFF)
+SOF0, SOF1, DHT, SOI, EOI, SOS, DQT, DRI, APP0 = 0xC0, 0xC1, 0xC4, 0xD8, 0xD9, 0xDA, 0xDB, 0xDD, 0xE0
+RST0, RST7 = 0xD0, 0xD7
+UNSUPPORTED_FRAMES = set(range(0xC2, 0xD0)) - {DHT, 0xC8, 0xCC}  # Progressive, lossless and arithmetic coding
+
+LEVEL_SHIFT = 128  # Samples are coded as signed values around zero
+DC_SHIFT = LEVEL_SHIFT * BLOCK_SIZE  # DC coefficient of the level shift under the orthonormal DCT
+RESERVED_SYMBOL = 256  # Takes the all-ones code of every table, which baseline streams may not use
+MAX_DC_SIZE, MAX_AC_SIZE = 11, 10  # Largest magnitude categories of 8-bit baseline coefficients
+
+MAX_DIMENSION = 0xFFFF  # Frame headers store each dimension on 16 bits
+SAMPLING_FACTORS = {"4:4:4": (1, 1), "4:2:2": (2, 1), "4:2:0": (2, 2)}  # (horizontal, vertical) of the luma
+MAX_BLOCK_BITS = (BLOCK_SIZE * BLOCK_SIZE) * (16 + MAX_AC_SIZE)  # Longest AC part of a block: 63 terms and an EOB
+EOB_WORD = 0
+DC_BIAS = 1 << 15  # Added to DC differences in lookup tables, to keep them positive
+
+Component = namedtuple("Component", ["id", "h", "v", "tq"])
+# Decode tree of an AC table over words made of a code and its extra bits. steps packs the bit length and the number
+# of coefficient indices covered (run of zeros and term) of every word as length << STEP_BITS | indices, so that one
+# sum gives both for a whole block. Word 0 is the EOB, of eob_bits bits.
+ACTable = namedtuple("ACTable", ["tree", "steps", "eob_bits", "run_array", "coefficient_array"])
+STEP_BITS = 20
+STEP_MASK = (1 << STEP_BITS) - 1
+
+
+def is_jfif(compressed_file):
+    """
+    Returns whether the file at the given path starts with a JPEG start of image marker
+    """
+    with open(compressed_file, "rb") as f:
+        return f.read(2) == bytes([0xFF, SOI])
+
+
+def size_category(values):
+    """
+    Returns the JPEG magnitude category of every value, i.e. the number of bits of its absolute value
+    """
+    return np.frexp(np.abs(values).astype(np.float64))[1]
+
+
+def ramp(counts):
+    """
+    Returns the concatenation of arange(count) for every count
+    """
+    return np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+
+
+def get_mcu_grid(original_dims, sampling):
+    """
+    Returns the number of rows and columns of minimum coded units (MCU) of an image with the given sampling factors
+    """
+    mcu_height = BLOCK_SIZE * max(v for h, v in sampling)
+    mcu_width = BLOCK_SIZE * max(h for h, v in sampling)
+    return -(-original_dims[0] // mcu_height), -(-original_dims[1] // mcu_width)
+
+
+def scan_order(sampling, mcu_grid):
+    """
+    Takes as argument the sampling factors of the components of an interleaved scan and its MCU grid, and returns the
+    component of every block of the scan along with its (row, column) in the block grid of its component, in scan order
+    """
+    components, rows, cols = [], [], []
+    mcu_rows, mcu_cols = mcu_grid
+    for c, (h, v) in enumerate(sampling):
+        # Every MCU holds v x h blocks of the component in raster order, and the MCUs follow each other in raster order
+        mcu_row, mcu_col, row, col = np.meshgrid(np.arange(mcu_rows), np.arange(mcu_cols), np.arange(v), np.arange(h),
+                                                 indexing="ij")
+        components.append(np.full((mcu_rows * mcu_cols, v * h), c))
+        rows.append((mcu_row * v + row).reshape(mcu_rows * mcu_cols, v * h))
+        cols.append((mcu_col * h + col).reshape(mcu_rows * mcu_cols, v * h))
+    return (np.concatenate(components, axis=1).ravel(), np.concatenate(rows, axis=1).ravel(),
+            np.concatenate(cols, axis=1).ravel())
+
+
+def build_jpeg_table(histogram):
+    """
+    Takes as argument the occurrence counts of the 256 symbols of a table and returns its canonical Huffman
+    dictionary, with no code longer than 16 bits and without the all-ones code
+    """
+    present = np.flatnonzero(histogram)
+    symbols = np.append(present, RESERVED_SYMBOL)
+    counts = np.append(histogram[present], 1)
+    code_lengths = limit_code_lengths(build_huffman_tree(symbols, counts).code_lengths())
+
+    # Canonical codes are handed out in (length, symbol) order, so the reserved symbol gets the all-ones code as
+    # long as its code is one of the longest
+    longest = max(code_lengths.values())
+    if code_lengths[RESERVED_SYMBOL] < longest:
+        swapped = next(symbol for symbol, length in code_lengths.items() if length == longest)
+        code_lengths[swapped], code_lengths[RESERVED_SYMBOL] = code_lengths[RESERVED_SYMBOL], longest
+
+    huffman_dict = canonical_codes(code_lengths)
+    del huffman_dict[RESERVED_SYMBOL]
+    return huffman_dict
+
+
+def encode_scan_symbols(ordered_blocks, components):
+    """
+    Takes as argument the (N, 64) quantized and level-shifted coefficients of the blocks of a scan in scan order and
+    the component of every block, and returns one entry per Huffman symbol of the scan, in order:
+    (block, is_ac, symbol, extra bits, number of extra bits) as five arrays
+    """
+    n_blocks = len(ordered_blocks)
+
+    # DC terms are coded as the difference from the previous block of the same component
+    dc = ordered_blocks[:, 0].astype(np.int64)
+    dc_diff = np.empty(n_blocks, dtype=np.int64)
+    for c in np.unique(components):
+        blocks = np.flatnonzero(components == c)
+        dc_diff[blocks] = np.diff(dc[blocks], prepend=0)
+
+    # Every non-zero AC term is coded with the run of zeros before it, preceded by one ZRL per full run of 16 zeros
+    block, k = np.nonzero(ordered_blocks[:, 1:])
+    k = k + 1
+    ac = ordered_blocks[block, k].astype(np.int64)
+    # Cut to the number of terms, so that a scan without any non-zero AC term gives empty masks
+    new_block = block[1:] != block[:-1]
+    first = np.r_[True, new_block][:len(block)]
+    previous_k = np.where(first, 0, np.r_[0, k[:-1]])
+    run = k - previous_k - 1
+    n_zrl = run >> 4
+
+    # Blocks whose last non-zero term comes before the end are closed by an EOB
+    last = np.r_[new_block, True][:len(block)]
+    last_k = np.zeros(n_blocks, dtype=np.int64)
+    last_k[block[last]] = k[last]
+    has_eob = last_k < BLOCK_SIZE * BLOCK_SIZE - 1
+
+    # Position of every symbol: the DC term, then the AC terms with their ZRLs, then the EOB
+    ac_width = np.bincount(block, weights=1 + n_zrl, minlength=n_blocks).astype(np.int64)
+    n_symbols = 1 + ac_width + has_eob
+    block_start = np.cumsum(n_symbols) - n_symbols
+    ac_position = block_start[block] + np.cumsum(1 + n_zrl) - (np.cumsum(ac_width) - ac_width)[block]
+
+    total = n_symbols.sum()
+    symbol_block = np.repeat(np.arange(n_blocks), n_symbols)
+    is_ac = np.ones(total, dtype=bool)
+    symbol = np.zeros(total, dtype=np.int64)  # EOB is symbol 0, and ZRL and EOB have no extra bits
+    extra = np.zeros(total, dtype=np.int64)
+    n_extra = np.zeros(total, dtype=np.int64)
+
+    dc_size = size_category(dc_diff)
+    is_ac[block_start] = False
+    symbol[block_start] = dc_size
+    extra[block_start] = np.where(dc_diff < 0, dc_diff + (1 << dc_size) - 1, dc_diff)
+    n_extra[block_start] = dc_size
+
+    ac_size = size_category(ac)
+    symbol[ac_position] = ((run & 15) << 4) | ac_size
+    extra[ac_position] = np.where(ac < 0, ac + (1 << ac_size) - 1, ac)
+    n_extra[ac_position] = ac_size
+    symbol[np.repeat(ac_position - n_zrl, n_zrl) + ramp(n_zrl)] = 0xF0  # ZRL
+
+    symbol[(block_start + n_symbols - 1)[has_eob]] = 0x00  # EOB
+    return symbol_block, is_ac, symbol, extra, n_extra
+
+
+def pack_entropy_data(codes, code_lengths, extra, n_extra):
+    """
+    Takes as argument the Huffman code of every symbol with its length and the extra bits that follow it, and returns
+    the entropy-coded bytes of the scan, padded with 1 bits and with a zero byte stuffed after every 0xFF
+    """
+    # Every symbol and its extra bits form one word of at most 27 bits, which bitarray encodes in a single pass
+    words = (codes << n_extra) | extra
+    lengths = code_lengths + n_extra
+    keys = (words << 5) | lengths
+    unique_keys = np.unique(keys)
+    word_dict = {key: int2ba(key >> 5, key & 31) for key in unique_keys.tolist()}
+
+    bits = bitarray()
+    bits.encode(word_dict, keys.tolist())
+    bits.extend([1] * (-len(bits) % 8))
+
+    data = np.frombuffer(bits.tobytes(), dtype=np.uint8)
+    return np.insert(data, np.flatnonzero(data == 0xFF) + 1, 0).tobytes()
+
+
+def pack_segment(marker, payload):
+    """
+    Returns a marker segment with the given payload
+    """
+    return bytes([0xFF, marker]) + (len(payload) + 2).to_bytes(2, "big") + payload
+
+
+def write_jfif(compressed_file, planes, Q, original_dims, subsampling="4:2:0"):
+    """
+    Takes as argument the path to a .jpg file, a list of (dct_coeff, plane_dims) pairs (Y alone, or Y, Cb and Cr with
+    the given chroma subsampling), the quality factor and the original image dimensions, and writes the planes as a
+    baseline JFIF file. Returns the number of bytes written.
+    """
+    if max(original_dims) > MAX_DIMENSION:
+        raise ValueError(f"JPEG files are limited to {MAX_DIMENSION} pixels on each side.")
+    sampling = [(1, 1)] if len(planes) == 1 else [SAMPLING_FACTORS[subsampling], (1, 1), (1, 1)]
+    mcu_grid = get_mcu_grid(original_dims, sampling)
+
+    # Baseline tables hold 8-bit entries, so very low quality factors are capped like libjpeg does
+    quantization_matrix = np.minimum(get_quantization_matrix(Q), 255)
+
+    grids = []
+    for (dct_coeff, plane_dims), (h, v) in zip(planes, sampling):
+        shifted = dct_coeff.copy()
+        shifted[:, 0, 0] -= DC_SHIFT
+        ordered_blocks = quantize_blocks(shifted, quantization_matrix=quantization_matrix)
+        ordered_blocks[:, 0] = np.clip(ordered_blocks[:, 0], -2 ** (MAX_DC_SIZE - 1), 2 ** (MAX_DC_SIZE - 1) - 1)
+        ordered_blocks[:, 1:] = np.clip(ordered_blocks[:, 1:], 1 - 2 ** MAX_AC_SIZE, 2 ** MAX_AC_SIZE - 1)
+
+        # Complete the partial MCUs on the right and bottom edges by repeating the last blocks, which costs no bits
+        padded_rows, padded_cols = get_padded_shape(plane_dims)
+        grid = ordered_blocks.reshape(padded_rows // BLOCK_SIZE, padded_cols // BLOCK_SIZE, -1)
+        grids.append(np.pad(grid, ((0, mcu_grid[0] * v - grid.shape[0]), (0, mcu_grid[1] * h - grid.shape[1]), (0, 0)),
+                            mode="edge"))
+
+    components, rows, cols = scan_order(sampling, mcu_grid)
+    ordered_blocks = np.empty((len(components), BLOCK_SIZE * BLOCK_SIZE), dtype=np.int64)
+    for c, grid in enumerate(grids):
+        in_component = components == c
+        ordered_blocks[in_component] = grid[rows[in_component], cols[in_component]]
+
+    # Luma and chroma each get a DC and an AC table, optimized for the symbols of this image
+    block, is_ac, symbol, extra, n_extra = encode_scan_symbols(ordered_blocks, components)
+    table = 2 * np.minimum(components[block], 1) + is_ac  # DC luma, AC luma, DC chroma, AC chroma
+    codes = np.zeros((4, 256), dtype=np.int64)
+    code_lengths = np.zeros((4, 256), dtype=np.int64)
+    dht = b""
+    for t in np.unique(table).tolist():
+        huffman_dict = build_jpeg_table(np.bincount(symbol[table == t], minlength=256))
+        for s, code in huffman_dict.items():
+            codes[t, s], code_lengths[t, s] = ba2int(code), len(code)
+        count, symbols = canonical_tables(huffman_dict)
+        bits = np.zeros(16, dtype=np.uint8)
+        bits[:len(count) - 1] = count[1:]
+        dht += bytes([(t % 2) << 4 | t // 2]) + bits.tobytes() + symbols.astype(np.uint8).tobytes()
+
+    # Frame with one 8-bit quantization table shared by all components, and one interleaved scan
+    frame = (bytes([8]) + original_dims[0].to_bytes(2, "big") + original_dims[1].to_bytes(2, "big")
+             + bytes([len(planes)]))
+    scan = bytes([len(planes)])
+    for c, (h, v) in enumerate(sampling):
+        frame += bytes([c + 1, h << 4 | v, 0])
+        scan += bytes([c + 1, min(c, 1) << 4 | min(c, 1)])
+    scan += bytes([0, BLOCK_SIZE * BLOCK_SIZE - 1, 0])
+
+    data = (bytes([0xFF, SOI])
+            + pack_segment(APP0, b"JFIF\x00\x01\x01\x00\x00\x01\x00\x01\x00\x00")
+            + pack_segment(DQT, bytes([0]) + quantization_matrix.ravel()[ZIGZAG_ORDER].astype(np.uint8).tobytes())
+            + pack_segment(SOF0, frame)
+            + pack_segment(DHT, dht)
+            + pack_segment(SOS, scan)
+            + pack_entropy_data(codes[table, symbol], code_lengths[table, symbol], extra, n_extra)
+            + bytes([0xFF, EOI]))
+
+    with open(compressed_file, "wb") as f:
+        f.write(data)
+    return len(data)
+
+
+def iter_table_codes(bits, values):
+    """
+    Takes as argument the number of codes of each length (1 to 16) and the symbols of a DHT table and yields the
+    (symbol, code, length) of every code of the table
+    """
+    code = 0
+    symbols = iter(values)
+    for length in range(1, 17):
+        for _ in range(bits[length - 1]):
+            yield next(symbols), code, length
+            code += 1
+        code <<= 1
+
+
+@functools.lru_cache(maxsize=64)
+def build_lookup_table(bits, values):
+    """
+    Takes as argument the number of codes of each length (1 to 16) and the symbols of a DC table (as tuples) and
+    returns a list mapping every 16-bit window of the stream to the code it starts with. A code that fits in the window
+    with its extra bits maps to (total length << 16 | difference + DC_BIAS), a longer one to -(code length << 8 |
+    size) and a window that starts no code to 0. Tables are built once per process, most files use the same few.
+    """
+    lookup = np.zeros(1 << 16, dtype=np.int64)
+    for size, code, length in iter_table_codes(bits, values):
+        span = 16 - length - size
+        if span < 0:
+            lookup[code << (16 - length):(code + 1) << (16 - length)] = -(length << 8 | size)
+            continue
+        # Extra bits starting with 0 code negative values, as in encode_scan_symbols
+        extra = np.arange(1 << size)
+        differences = np.where(extra >> max(size - 1, 0), extra, extra - (1 << size) + 1) if size else extra
+        windows = ((code << size | extra) << span)[:, None] + np.arange(1 << span)
+        lookup[windows.ravel()] = np.repeat((length + size) << 16 | (differences + DC_BIAS), 1 << span)
+    return lookup.tolist()
+
+
+@functools.lru_cache(maxsize=64)
+def build_ac_table(bits, values):
+    """
+    Takes as argument the number of codes of each length (1 to 16) and the symbols of an AC table (as tuples) and
+    returns its ACTable, with one word per code and value of its extra bits. Tables are built once per process.
+    """
+    words = {}
+    steps, runs, coefficients = [0], [0], [0]
+    eob_bits = 0
+    for symbol, code, length in iter_table_codes(bits, values):
+        run, size = symbol >> 4, symbol & 15
+        prefix = int2ba(code, length)
+        if symbol == 0:
+            words[EOB_WORD] = prefix
+            eob_bits = length
+            continue
+        if size > MAX_AC_SIZE or (size == 0 and run != 15):  # Never produced by 8-bit baseline encoders
+            continue
+
+        # Extra bits starting with 0 code negative values, as in encode_scan_symbols
+        extra = np.arange(1 << size)
+        values_of_extra = np.where(extra >> max(size - 1, 0), extra, extra - (1 << size) + 1) if size else [0]
+        for value, suffix in zip(np.asarray(values_of_extra).tolist(), get_suffixes(size)):
+            words[len(steps)] = prefix + suffix
+            steps.append((length + size) << STEP_BITS | (run + 1))
+            runs.append(run)
+            coefficients.append(value)
+    return ACTable(decodetree(words), steps, eob_bits, np.array(runs), np.array(coefficients))
+
+
+@functools.lru_cache(maxsize=None)
+def get_suffixes(size):
+    """
+    Returns the list of every bitarray of the given size, in increasing order
+    """
+    return [int2ba(value, size) if size else bitarray() for value in range(1 << size)]
+
+
+def decode_full_block(chunk, ac_table):
+    """
+    Decodes the AC words of a block one at a time, until its EOB or its last AC term, and returns them along with
+    their length in bits
+    """
+    block, n_bits, covered = [], 0, 0
+    try:
+        for word in chunk.decode(ac_table.tree):
+            if word == EOB_WORD:
+                return block, n_bits + ac_table.eob_bits
+            block.append(word)
+            n_bits += ac_table.steps[word] >> STEP_BITS
+            covered += ac_table.steps[word] & STEP_MASK
+            if covered >= BLOCK_SIZE * BLOCK_SIZE - 1:
+                break
+        else:
+            raise ValueError("Entropy-coded data ends in the middle of a block.")
+    except ValueError as error:
+        if "prefix code" not in str(error):
+            raise
+        raise ValueError("Invalid Huffman code in the entropy-coded data.") from None
+    if covered > BLOCK_SIZE * BLOCK_SIZE - 1:
+        raise ValueError("AC coefficients run past the end of a block.")
+    return block, n_bits
+
+
+def decode_segment(segment, unit_components, dc_tables, ac_tables):
+    """
+    Huffman decodes the blocks of one restart interval from its unstuffed bytes, given the component of every block.
+    Returns the DC coefficient of every block, its number of AC words and the AC words of all blocks in order.
+    """
+    # 24-bit window starting at every byte, padded with 1 bits so that reads may run past the end
+    padded = np.concatenate([segment, [0xFF] * 3]).astype(np.int64)
+    windows = ((padded[:-2] << 16) | (padded[1:-1] << 8) | padded[2:]).tolist()
+    bits = bitarray()
+    bits.frombytes(segment.tobytes())
+
+    tables = {c: (dc_tables[c], ac_tables[c].tree, ac_tables[c].steps.__getitem__, ac_tables[c].eob_bits)
+              for c in dc_tables}
+    decode = bitarray.decode
+    differences, blocks = [], []
+    position = 0
+    for c in unit_components:
+        dc_table, tree, get_step, eob_bits = tables[c]
+
+        entry = dc_table[(windows[position >> 3] >> (8 - (position & 7))) & 0xFFFF]
+        if entry <= 0:
+            if not entry:
+                raise ValueError("Invalid Huffman code in the entropy-coded data.")
+            # The extra bits run past the window, read them on their own
+            position += -entry >> 8
+            size = -entry & 0xFF
+            value = ((windows[position >> 3] >> (8 - (position & 7))) & 0xFFFF) >> (16 - size)
+            entry = size << 16 | ((value if value >> (size - 1) else value - (1 << size) + 1) + DC_BIAS)
+        position += entry >> 16
+        differences.append(entry)
+
+        # The AC words up to the EOB, decoded in C. A block ends with an EOB only if it covers at most 62 of its 63
+        # AC indices; blocks running to their last AC term are decoded again one word at a time.
+        chunk = bits[position:position + MAX_BLOCK_BITS]
+        try:
+            block = list(iter(decode(chunk, tree).__next__, EOB_WORD))
+            step = sum(map(get_step, block))
+        except ValueError:
+            step = STEP_MASK
+        if (step & STEP_MASK) < BLOCK_SIZE * BLOCK_SIZE - 1:
+            position += (step >> STEP_BITS) + eob_bits
+        else:
+            block, n_bits = decode_full_block(chunk, ac_tables[c])
+            position += n_bits
+        blocks.append(block)
+    if position > len(bits):
+        raise ValueError("Entropy-coded data ends in the middle of a block.")
+
+    # Every component predicts its DC coefficients from its previous block, starting from 0 in every interval
+    differences = (np.array(differences, dtype=np.int64) & 0xFFFF) - DC_BIAS
+    components = np.array(unit_components)
+    dc = np.empty(len(differences), dtype=np.int64)
+    for c in dc_tables:
+        in_component = components == c
+        dc[in_component] = np.cumsum(differences[in_component])
+    return dc, list(map(len, blocks)), list(chain.from_iterable(blocks))
+
+
+def get_component_dims(original_dims, component, components):
+    """
+    Returns the dimensions of a component, whose sampling factors are relative to the largest of all components
+    """
+    h_max, v_max = max(c.h for c in components), max(c.v for c in components)
+    return -(-original_dims[0] * component.v // v_max), -(-original_dims[1] * component.h // h_max)
+
+
+def decode_scan(data, offset, components, scan_components, restart_interval, storage, dc_tables, ac_tables,
+                original_dims):
+    """
+    Decodes the entropy-coded data of a scan starting at offset into the coefficient storage of its components and
+    returns the offset of the marker that ends it
+    """
+    # Markers are the 0xFF bytes not followed by a stuffed zero. Restart markers split the scan into intervals.
+    ff = offset + np.flatnonzero(data[offset:-1] == 0xFF)
+    markers = ff[data[ff + 1] != 0]
+    is_restart = (data[markers + 1] >= RST0) & (data[markers + 1] <= RST7)
+    end = markers[~is_restart][0] if np.any(~is_restart) else len(data)
+    restarts = markers[is_restart & (markers < end)]
+
+    # The blocks of the scan in order: a single component is coded block by block, several are interleaved by MCU
+    if len(scan_components) == 1:
+        block_rows, block_cols = (-(-size // BLOCK_SIZE) for size in
+                                  get_component_dims(original_dims, components[scan_components[0]], components))
+        row, col = np.divmod(np.arange(block_rows * block_cols), block_cols)
+        unit_components = np.full(len(row), scan_components[0])
+        units_per_mcu = 1
+    else:
+        mcu_grid = get_mcu_grid(original_dims, [(c.h, c.v) for c in components])
+        sampling = [(components[c].h, components[c].v) for c in scan_components]
+        scan_index, row, col = scan_order(sampling, mcu_grid)
+        unit_components = np.array(scan_components)[scan_index]
+        units_per_mcu = sum(h * v for h, v in sampling)
+
+    storage_cols = np.array([cols for _, cols in storage])
+    unit_blocks = row * storage_cols[unit_components] + col
+    unit_list = unit_components.tolist()
+
+    interval = restart_interval * units_per_mcu if restart_interval else len(unit_list)
+    starts = np.r_[offset, restarts + 2]
+    stops = np.r_[restarts, end]
+    dc, counts, words = [], [], []
+    for i, (start, stop) in enumerate(zip(starts.tolist(), stops.tolist())):
+        segment = data[start:stop]
+        stuffed = np.flatnonzero(segment[:-1] == 0xFF) + 1
+        segment = np.delete(segment, stuffed[segment[stuffed] == 0])
+        segment_dc, segment_counts, segment_words = decode_segment(segment, unit_list[i * interval:(i + 1) * interval],
+                                                                   dc_tables, ac_tables)
+        dc.append(segment_dc)
+        counts += segment_counts
+        words += segment_words
+
+    # Every word is one AC term (or a run of 16 zeros), at the index that follows the run of zeros before it
+    dc = np.concatenate(dc)
+    n_units = len(dc)
+    counts = np.array(counts, dtype=np.int64)
+    words = np.array(words, dtype=np.int64)
+    word_units = np.repeat(np.arange(n_units), counts)
+    word_components = unit_components[word_units]
+    runs = np.zeros(len(words), dtype=np.int64)
+    coefficients = np.zeros(len(words), dtype=np.int64)
+    for c in scan_components:
+        in_component = word_components == c
+        runs[in_component] = ac_tables[c].run_array[words[in_component]]
+        coefficients[in_component] = ac_tables[c].coefficient_array[words[in_component]]
+    before = np.cumsum(runs + 1) - (runs + 1)  # Indices advanced over by the words before, across all blocks
+    first_words = np.append(before, 0)[np.cumsum(counts) - counts]
+    k = 1 + before - np.repeat(first_words, counts) + runs
+
+    unit_blocks, unit_components = unit_blocks[:n_units], unit_components[:n_units]
+    for c in scan_components:
+        ordered_blocks, _ = storage[c]
+        ordered_blocks[unit_blocks[unit_components == c], 0] = dc[unit_components == c]
+        in_component = word_components == c
+        ordered_blocks[unit_blocks[word_units[in_component]], k[in_component]] = coefficients[in_component]
+    return end
+
+
+def read_jfif(compressed_file):
+    """
+    Takes as argument the path to a baseline or extended sequential JPEG file and returns the original image
+    dimensions along with the list of its decoded planes (Y alone, or Y, Cb and Cr), each at its own sampled size
+    """
+    with open(compressed_file, "rb") as f:
+        data = np.frombuffer(f.read(), dtype=np.uint8)
+    if data[:2].tobytes() != bytes([0xFF, SOI]):
+        raise ValueError("Not a JPEG file.")
+
+    quantization_tables, huffman_tables = {}, {}
+    components = None
+    restart_interval = 0
+    offset = 2
+    while True:
+        if offset >= len(data) - 1 or data[offset] != 0xFF:
+            raise ValueError("Corrupt JPEG marker structure.")
+        while data[offset] == 0xFF:  # Fill bytes
+            offset += 1
+        marker = int(data[offset])
+        offset += 1
+        if marker == EOI:
+            break
+        if RST0 <= marker <= RST7:
+            continue
+
+        length = int(data[offset]) << 8 | int(data[offset + 1])
+        payload = data[offset + 2:offset + length]
+        offset += length
+
+        if marker == DQT:
+            i = 0
+            while i < len(payload):
+                precision, tq = payload[i] >> 4, payload[i] & 15
+                n_bytes = 128 if precision else 64
+                table = payload[i + 1:i + 1 + n_bytes]
+                if precision:
+                    table = table[0::2].astype(np.int64) << 8 | table[1::2]
+                matrix = np.empty(BLOCK_SIZE * BLOCK_SIZE)
+                matrix[ZIGZAG_ORDER] = table  # Tables are stored in zigzag order
+                quantization_tables[tq] = matrix.reshape(BLOCK_SIZE, BLOCK_SIZE)
+                i += 1 + n_bytes
+        elif marker == DHT:
+            i = 0
+            while i < len(payload):
+                bits = tuple(payload[i + 1:i + 17].tolist())
+                values = tuple(payload[i + 17:i + 17 + sum(bits)].tolist())
+                table_class = payload[i] >> 4
+                huffman_tables[(table_class, payload[i] & 15)] = (build_ac_table if table_class else
+                                                                  build_lookup_table)(bits, values)
+                i += 17 + len(values)
+        elif marker in (SOF0, SOF1):
+            if payload[0] != 8:
+                raise ValueError("Only 8-bit JPEG files are supported.")
+            original_dims = (int(payload[1]) << 8 | int(payload[2]), int(payload[3]) << 8 | int(payload[4]))
+            if original_dims[0] == 0:
+                raise ValueError("JPEG files whose height is only given after the scan are not supported.")
+            components = [Component(*(int(value) for value in (payload[6 + 3 * i], payload[7 + 3 * i] >> 4,
+                                                               payload[7 + 3 * i] & 15, payload[8 + 3 * i])))
+                          for i in range(payload[5])]
+            if len(components) not in (1, 3):
+                raise ValueError("Only grayscale and YCbCr JPEG files are supported.")
+
+            # Zigzag-ordered coefficients of every component over its whole MCU-aligned block grid, in raster order
+            mcu_grid = get_mcu_grid(original_dims, [(c.h, c.v) for c in components])
+            storage = [(np.zeros((mcu_grid[0] * c.v * mcu_grid[1] * c.h, BLOCK_SIZE * BLOCK_SIZE), dtype=np.int64),
+                        mcu_grid[1] * c.h) for c in components]
+        elif marker in UNSUPPORTED_FRAMES:
+            raise ValueError("Only baseline and extended sequential Huffman-coded JPEG files are supported.")
+        elif marker == DRI:
+            restart_interval = int(payload[0]) << 8 | int(payload[1])
+        elif marker == SOS:
+            if components is None:
+                raise ValueError("JPEG scan found before the frame header.")
+            ids = [c.id for c in components]
+            scan_components = [ids.index(payload[1 + 2 * i]) for i in range(payload[0])]
+            dc_tables = {c: huffman_tables[(0, payload[2 + 2 * i] >> 4)] for i, c in enumerate(scan_components)}
+            ac_tables = {c: huffman_tables[(1, payload[2 + 2 * i] & 15)] for i, c in enumerate(scan_components)}
+            offset = decode_scan(data, offset, components, scan_components, restart_interval, storage,
+                                 dc_tables, ac_tables, original_dims)
+        # Application and comment segments are skipped
+
+    # Every plane goes through the batched inverse transform of the codec
+    planes = []
+    for component, (coefficients, storage_cols) in zip(components, storage):
+        plane_dims = get_component_dims(original_dims, component, components)
+        padded_shape = get_padded_shape(plane_dims)
+        grid = coefficients.reshape(-1, storage_cols, BLOCK_SIZE * BLOCK_SIZE)
+        ordered_blocks = grid[:padded_shape[0] // BLOCK_SIZE, :padded_shape[1] // BLOCK_SIZE].reshape(
+            -1, BLOCK_SIZE * BLOCK_SIZE)
+        plane = inverse_transform(ordered_blocks, padded_shape,
+                                  quantization_matrix=quantization_tables[component.tq]) + LEVEL_SHIFT
+        planes.append(plane[:plane_dims[0], :plane_dims[1]])
+    return original_dims, planes
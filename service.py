@@ -0,0 +1,536 @@
+"""
+Local compression service exposing the JPEG codec and the edge codec over HTTP, on a TCP port or a Unix socket.
+
+Starting a Python process and importing NumPy, SciPy, OpenCV and scikit-image costs far more than compressing a small
+image, so the service keeps a pool of worker processes that import both codecs and run a small image through each of
+them (which also builds the built-in Huffman tables) before the first request arrives. The HTTP side is plain
+asyncio from the standard library: HTTP/1.1 with keep-alive, one request at a time per connection.
+
+Requests wait in a bounded queue for a free worker. When the queue is full, the service answers 503 with a
+Retry-After header at once instead of buffering more work than it can do, so clients see the overload and can back
+off. A batch takes as many places in the queue as it has items, and is refused as a whole if they do not fit: with 503
+if the queue is too busy, or with 413 if the batch is larger than the whole queue, where retrying would never help.
+
+A worker process that dies (killed, or crashed in native code) breaks the whole pool: the requests it and the other
+workers were running are answered with 500, and the service starts and warms up a new pool before taking more
+requests from the queue. If the new workers fail to warm up, the service stops.
+
+Endpoints (images in any format OpenCV reads, parameters in the query string):
+
+    POST /jpeg/compress     Q, colour, subsampling, progressive, tile_size, static_tables, format (bin or jpg)
+                            -> the compressed file, as codec.jpeg_compress writes it
+    POST /jpeg/decompress   a .bin or .jpg file, format (png or npy) -> the decoded image
+    POST /edge/compress     q, d, sigma, threshold, edge_backend, sample_backend, layout
+                            -> the compressed data of edge_codec.compress
+    POST /edge/decompress   compressed data, tol, max_iter, format (png or npy) -> the reconstructed image
+    POST /batch             JSON list of {"path": "/jpeg/compress", "query": {"Q": 50}, "body": <base64>} -> JSON
+                            list of {"status": 200, "body": <base64>} or {"status": 400, "error": "..."}, in order
+    GET  /health            JSON counters of the service
+
+    python service.py --port 8080 --workers 4 --queue 64
+    python service.py --unix /tmp/codec.sock
+
+benchmarks/load_service.py generates load against it and reports latency percentiles and throughput.
+"""
+import argparse
+import asyncio
+import base64
+import io
+import json
+import multiprocessing
+import os
+import signal
+import struct
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from http import HTTPStatus
+from urllib.parse import parse_qsl, urlencode, urlsplit
+
+import cv2
+import numpy as np
+
+# Appended, so that the root modules win any name clash with the edge codec's
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "Research_paper", "homogeneous_diffusion"))
+from codec import jpeg_compress, jpeg_decompress
+from edge_codec import SIGMA, THRESHOLD, compress as edge_compress, decompress as edge_decompress
+from utils.entropy import EDGE_BACKENDS, LAYOUTS, SAMPLE_BACKENDS
+
+MAX_BODY = 64 * 2 ** 20  # Largest request body accepted, in bytes
+RETRY_AFTER = 1  # Seconds a client is asked to wait when the queue is full
+
+
+class RequestError(ValueError):
+    """
+    A request the service cannot handle, answered with the given HTTP status
+    """
+
+    def __init__(self, message, status=HTTPStatus.BAD_REQUEST):
+        super().__init__(message)
+        self.status = status
+
+
+def get_param(query, name, default, kind=int):
+    """
+    Returns the query parameter converted by kind, or the default if it is missing
+    """
+    if name not in query:
+        return default
+    try:
+        return kind(query[name])
+    except ValueError:
+        raise RequestError(f"Invalid value for {name}: {query[name]!r}.") from None
+
+
+def get_flag(query, name):
+    """
+    Returns whether a yes/no query parameter is set
+    """
+    return str(query.get(name, "0")).lower() in ("1", "true", "yes")
+
+
+def get_choice(query, name, default, choices):
+    """
+    Returns a query parameter that has to be one of the given choices, or the default if it is missing
+    """
+    value = query.get(name, default)
+    if value not in choices:
+        raise RequestError(f"{name} must be one of {', '.join(map(str, choices))}.")
+    return value
+
+
+def decode_image(body, colour=True):
+    """
+    Decodes an image file held in bytes and returns it as an RGB (or grayscale) array
+    """
+    image = cv2.imdecode(np.frombuffer(body, dtype=np.uint8), cv2.IMREAD_COLOR if colour else cv2.IMREAD_GRAYSCALE)
+    if image is None:
+        raise RequestError("The request body is not an image.")
+    return cv2.cvtColor(image, cv2.COLOR_BGR2RGB) if colour else image
+
+
+def encode_image(image, image_format):
+    """
+    Returns the content type and bytes of an RGB (or grayscale) array as a PNG file or a NumPy .npy file
+    """
+    if image_format == "npy":
+        buffer = io.BytesIO()
+        np.save(buffer, image)
+        return "application/x-npy", buffer.getvalue()
+    ok, encoded = cv2.imencode(".png", cv2.cvtColor(image, cv2.COLOR_RGB2BGR) if image.ndim == 3 else image)
+    return "image/png", encoded.tobytes()
+
+
+def jpeg_compress_job(body, query, folder):
+    suffix = "." + get_choice(query, "format", "bin", ("bin", "jpg"))
+    colour = get_flag(query, "colour")
+    image_path, compressed_file = os.path.join(folder, "image.png"), os.path.join(folder, "image" + suffix)
+    cv2.imwrite(image_path, cv2.cvtColor(decode_image(body, colour), cv2.COLOR_RGB2BGR) if colour
+                else decode_image(body, colour))
+
+    tile_size = get_param(query, "tile_size", None)
+    jpeg_compress(image_path, get_param(query, "Q", 50), compressed_file, colour,
+                  get_choice(query, "subsampling", "4:2:0", ("4:4:4", "4:2:2", "4:2:0")),
+                  get_flag(query, "progressive"), tile_size, get_flag(query, "static_tables"))
+    with open(compressed_file, "rb") as f:
+        return "application/octet-stream", f.read()
+
+
+def jpeg_decompress_job(body, query, folder):
+    image_format = get_choice(query, "format", "png", ("png", "npy"))
+    compressed_file = os.path.join(folder, "image.bin")
+    with open(compressed_file, "wb") as f:
+        f.write(body)
+    return encode_image(jpeg_decompress(compressed_file), image_format)
+
+
+def edge_compress_job(body, query, folder):
+    data = edge_compress(decode_image(body), get_param(query, "q", 4), get_param(query, "d", 3),
+                         get_param(query, "sigma", SIGMA, float), get_param(query, "threshold", THRESHOLD, float),
+                         scratch_dir=folder,
+                         edge_backend=get_choice(query, "edge_backend", "context", EDGE_BACKENDS),
+                         sample_backend=get_choice(query, "sample_backend", "lzma", SAMPLE_BACKENDS),
+                         layout=get_choice(query, "layout", "compact", LAYOUTS))
+    return "application/octet-stream", data
+
+
+def edge_decompress_job(body, query, folder):
+    image_format = get_choice(query, "format", "png", ("png", "npy"))
+    options = {}
+    if "tol" in query:
+        options["tol"] = get_param(query, "tol", None, float)
+    if "max_iter" in query:
+        options["max_iter"] = get_param(query, "max_iter", None)
+    return encode_image(edge_decompress(body, scratch_dir=folder, **options), image_format)
+
+
+# Handlers of the endpoints, run in the worker processes: (body, query, scratch folder) -> (content type, bytes)
+OPERATIONS = {
+    "/jpeg/compress": jpeg_compress_job,
+    "/jpeg/decompress": jpeg_decompress_job,
+    "/edge/compress": edge_compress_job,
+    "/edge/decompress": edge_decompress_job,
+}
+
+
+def run_operation(path, query, body):
+    """
+    Runs the operation of an endpoint in a worker process and returns its (status, content type, bytes). Invalid
+    requests and inputs the codecs reject (ValueError, or struct.error on a truncated header) are answered with 400,
+    any other failure with 500, so that a bug in a codec is not reported as the client's fault.
+    """
+    try:
+        with tempfile.TemporaryDirectory() as folder:
+            content_type, payload = OPERATIONS[path](body, query, folder)
+        return HTTPStatus.OK, content_type, payload
+    except RequestError as error:
+        return error.status, "text/plain", str(error).encode()
+    except (ValueError, struct.error) as error:
+        return HTTPStatus.BAD_REQUEST, "text/plain", f"{type(error).__name__}: {error}".encode()
+    except Exception as error:
+        return HTTPStatus.INTERNAL_SERVER_ERROR, "text/plain", f"{type(error).__name__}: {error}".encode()
+
+
+def warm_up_operation(path, query, body):
+    """
+    Runs an operation during the warm-up of a worker and returns its output, or raises RuntimeError if it failed
+    """
+    status, _, payload = run_operation(path, query, body)
+    if status != HTTPStatus.OK:
+        raise RuntimeError(f"Warm-up of {path} with {query} failed with {int(status)}: "
+                           f"{payload.decode(errors='replace')}")
+    return payload
+
+
+def warm_worker(barrier):
+    """
+    Initializer of the worker processes: runs a small image through every operation, so that every module, table
+    and cache they use is loaded before the first request. The barrier is kept for get_worker_pid. A failed
+    operation raises RuntimeError, which breaks the pool instead of leaving a worker that cannot serve.
+    """
+    global startup_barrier
+    startup_barrier = barrier
+    rng = np.random.default_rng(0)
+    image = cv2.GaussianBlur(rng.integers(0, 256, (64, 64, 3), dtype=np.uint8), (7, 7), 2)
+    png = cv2.imencode(".png", image)[1].tobytes()
+    for query in ({"colour": "1"}, {"colour": "1", "static_tables": "1"}, {}):
+        compressed = warm_up_operation("/jpeg/compress", query, png)
+        warm_up_operation("/jpeg/decompress", {}, compressed)
+    compressed = warm_up_operation("/edge/compress", {}, png)
+    warm_up_operation("/edge/decompress", {}, compressed)
+
+
+def get_worker_pid():
+    """
+    Waits until every worker process is running this function and returns the process ID of this one
+    """
+    startup_barrier.wait()
+    return os.getpid()
+
+
+class CompressionService:
+    """
+    The HTTP front end of a pool of worker processes, with a queue of at most queue_size requests waiting for them
+    """
+
+    def __init__(self, workers=None, queue_size=64, max_body=MAX_BODY):
+        self.workers = workers or os.cpu_count() or 1
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.max_body = max_body
+        self.pool = self.create_pool()
+        self.restarting = asyncio.Lock()
+        self.stopped = asyncio.Event()  # Set when the service cannot go on, with the reason in error
+        self.error = None
+        self.counters = {"requests": 0, "completed": 0, "rejected": 0, "failed": 0, "in_flight": 0, "restarts": 0}
+        self.dispatchers = []
+        self.started = time.time()
+
+    def create_pool(self):
+        """
+        Returns a new pool of worker processes, which only start and warm up once it is given jobs
+        """
+        # Workers are started fresh rather than forked from the event loop's process, and warm up on their own
+        context = multiprocessing.get_context("spawn")
+        return ProcessPoolExecutor(self.workers, mp_context=context, initializer=warm_worker,
+                                   initargs=(context.Barrier(self.workers),))
+
+    async def warm_pool(self):
+        """
+        Starts all the worker processes of the pool and waits until every one of them is warm. Returns the number of
+        worker processes, or raises BrokenProcessPool if one of them failed to warm up.
+        """
+        loop = asyncio.get_running_loop()
+        # Every job starts a new process and holds it at the barrier, so each process runs one of them
+        pids = await asyncio.gather(*(loop.run_in_executor(self.pool, get_worker_pid) for _ in range(self.workers)))
+        return len(set(pids))
+
+    async def start(self):
+        """
+        Starts all the worker processes, waits until every one of them is warm and starts taking requests from the
+        queue. Returns the number of worker processes.
+        """
+        try:
+            n_workers = await self.warm_pool()
+        except BrokenProcessPool:
+            self.pool.shutdown(cancel_futures=True)
+            raise RuntimeError("The worker processes failed to warm up, see their errors above.") from None
+        self.dispatchers = [asyncio.create_task(self.dispatch()) for _ in range(self.workers)]
+        return n_workers
+
+    async def close(self):
+        for dispatcher in self.dispatchers:
+            dispatcher.cancel()
+        self.pool.shutdown(cancel_futures=True)
+
+    async def dispatch(self):
+        """
+        Hands the queued requests to the pool one at a time, so that a worker is never given more than one
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            path, query, body, future = await self.queue.get()
+            self.counters["in_flight"] += 1
+            pool = self.pool
+            try:
+                result = await loop.run_in_executor(pool, run_operation, path, query, body)
+                broken = False
+            except Exception as error:  # A worker process died, or the job could not be sent to one
+                result = HTTPStatus.INTERNAL_SERVER_ERROR, "text/plain", f"{type(error).__name__}: {error}".encode()
+                broken = isinstance(error, BrokenProcessPool)
+            finally:
+                self.counters["in_flight"] -= 1
+            if not future.cancelled():
+                future.set_result(result)
+            if broken:
+                await self.restart_pool(pool)
+
+    async def restart_pool(self, broken_pool):
+        """
+        Replaces a broken pool with a new, warm one. Every dispatcher whose job was lost calls this, and only the
+        first one restarts the pool. If the new workers fail to warm up too, the service is stopped.
+        """
+        async with self.restarting:
+            if self.pool is not broken_pool:
+                return
+            broken_pool.shutdown(wait=False, cancel_futures=True)
+            self.counters["restarts"] += 1
+            self.pool = self.create_pool()
+            try:
+                await self.warm_pool()
+            except BrokenProcessPool:
+                self.error = "A worker process died and the new worker processes failed to warm up."
+                self.stopped.set()
+
+    def enqueue(self, operations):
+        """
+        Queues a list of (path, query, body) operations and returns their futures, or raises a 503 RequestError if
+        they do not all fit in the queue right now, and a 413 one if they could never fit in it
+        """
+        if len(operations) > self.queue.maxsize:
+            raise RequestError(f"Batches are limited to {self.queue.maxsize} items.",
+                               HTTPStatus.REQUEST_ENTITY_TOO_LARGE)
+        if self.queue.maxsize - self.queue.qsize() < len(operations):
+            self.counters["rejected"] += 1
+            raise RequestError("The service is busy, try again later.", HTTPStatus.SERVICE_UNAVAILABLE)
+        loop = asyncio.get_running_loop()
+        futures = []
+        for path, query, body in operations:
+            futures.append(loop.create_future())
+            self.queue.put_nowait((path, query, body, futures[-1]))
+        return futures
+
+    async def respond(self, method, target, body):
+        """
+        Returns the (status, content type, bytes) answering a request
+        """
+        url = urlsplit(target)
+        query = dict(parse_qsl(url.query))
+        if url.path == "/health":
+            health = dict(self.counters, workers=self.workers, queued=self.queue.qsize(), queue_size=self.queue.maxsize,
+                          uptime=time.time() - self.started)
+            return HTTPStatus.OK, "application/json", json.dumps(health).encode()
+        if method != "POST":
+            raise RequestError("Use POST.", HTTPStatus.METHOD_NOT_ALLOWED)
+
+        if url.path == "/batch":
+            try:
+                items = json.loads(body)
+                operations = [(item["path"], {name: str(value) for name, value in item.get("query", {}).items()},
+                               base64.b64decode(item.get("body", ""))) for item in items]
+            except (ValueError, KeyError, TypeError, AttributeError):
+                raise RequestError("A batch is a JSON list of {\"path\", \"query\", \"body\"} objects.") from None
+            unknown = [path for path, _, _ in operations if path not in OPERATIONS]
+            if unknown:
+                raise RequestError(f"Unknown operation {unknown[0]} in the batch.", HTTPStatus.NOT_FOUND)
+
+            results = await asyncio.gather(*self.enqueue(operations))
+            answer = [{"status": int(status), "body": base64.b64encode(payload).decode()} if status == HTTPStatus.OK
+                      else {"status": int(status), "error": payload.decode()} for status, _, payload in results]
+            return HTTPStatus.OK, "application/json", json.dumps(answer).encode()
+
+        if url.path not in OPERATIONS:
+            raise RequestError(f"No endpoint at {url.path}.", HTTPStatus.NOT_FOUND)
+        return await self.enqueue([(url.path, query, body)])[0]
+
+    async def handle_connection(self, reader, writer):
+        """
+        Serves the requests of one connection, one after the other, until the client closes it
+        """
+        try:
+            while True:
+                request = await read_message(reader, self.max_body, request=True)
+                if request is None:
+                    break
+                (method, target), headers, body = request
+
+                self.counters["requests"] += 1
+                try:
+                    status, content_type, payload = await self.respond(method, target, body)
+                except RequestError as error:
+                    status, content_type, payload = error.status, "text/plain", str(error).encode()
+                if status != HTTPStatus.SERVICE_UNAVAILABLE:  # Already counted as rejected
+                    self.counters["completed" if status < 500 else "failed"] += 1
+
+                extra = {"Retry-After": str(RETRY_AFTER)} if status == HTTPStatus.SERVICE_UNAVAILABLE else {}
+                keep_alive = headers.get("connection", "").lower() != "close"
+                write_message(writer, f"HTTP/1.1 {int(status)} {HTTPStatus(status).phrase}", payload,
+                              dict(extra, **{"Content-Type": content_type,
+                                             "Connection": "keep-alive" if keep_alive else "close"}))
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except RequestError as error:  # The request itself could not be read
+            write_message(writer, f"HTTP/1.1 {int(error.status)} {error.status.phrase}", str(error).encode(),
+                          {"Content-Type": "text/plain", "Connection": "close"})
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+
+async def read_message(reader, max_body=MAX_BODY, request=False):
+    """
+    Reads an HTTP/1.1 request (or response) from a stream and returns its start line split in its first two
+    words, its headers (lowercase names) and its body, or None if the stream ended before a new message
+    """
+    start_line = await reader.readline()
+    if not start_line:
+        return None
+    words = start_line.decode("latin-1").split()
+    if len(words) < 2:
+        raise RequestError("Malformed start line.")
+
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+
+    try:
+        length = int(headers.get("content-length", 0))
+    except ValueError:
+        raise RequestError("Invalid Content-Length.") from None
+    if length > max_body:
+        # Read past the body without keeping it, so the client gets to read the answer instead of a reset connection
+        while length > 0:
+            length -= len(await reader.readexactly(min(length, 2 ** 16)))
+        raise RequestError(f"Bodies are limited to {max_body} bytes.", HTTPStatus.REQUEST_ENTITY_TOO_LARGE)
+    body = await reader.readexactly(length) if length else b""
+    return (words[0], words[1]), headers, body
+
+
+def write_message(writer, start_line, body, headers):
+    """
+    Writes an HTTP/1.1 message with the given start line, headers and body to a stream
+    """
+    lines = [start_line, f"Content-Length: {len(body)}"] + [f"{name}: {value}" for name, value in headers.items()]
+    writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + body)
+
+
+class ServiceClient:
+    """
+    Minimal HTTP/1.1 client of the service over one keep-alive connection, to a TCP port or a Unix socket
+    """
+
+    def __init__(self, host="127.0.0.1", port=8080, unix=None):
+        self.host, self.port, self.unix = host, port, unix
+        self.reader = self.writer = None
+
+    async def connect(self):
+        if self.unix:
+            self.reader, self.writer = await asyncio.open_unix_connection(self.unix)
+        else:
+            self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+
+    async def request(self, method, path, body=b"", query=None):
+        """
+        Sends a request and returns the status, headers and body of the response
+        """
+        if self.writer is None:
+            await self.connect()
+        target = path + ("?" + urlencode(query) if query else "")
+        write_message(self.writer, f"{method} {target} HTTP/1.1", body,
+                      {"Host": self.host if not self.unix else "localhost", "Connection": "keep-alive"})
+        await self.writer.drain()
+        response = await read_message(self.reader, max_body=2 ** 62)
+        if response is None:
+            raise ConnectionError("The service closed the connection.")
+        (_, status), headers, payload = response
+        if headers.get("connection", "").lower() == "close":
+            await self.close()
+        return int(status), headers, payload
+
+    async def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.reader = self.writer = None
+
+
+async def serve(host="127.0.0.1", port=8080, unix=None, workers=None, queue_size=64, max_body=MAX_BODY):
+    """
+    Starts the service and serves until SIGINT or SIGTERM, or until it cannot replace its broken worker pool
+    """
+    service = CompressionService(workers, queue_size, max_body)
+    start = time.perf_counter()
+    n_workers = await service.start()
+    if unix:
+        server = await asyncio.start_unix_server(service.handle_connection, unix)
+        address = unix
+    else:
+        server = await asyncio.start_server(service.handle_connection, host, port)
+        address = f"http://{host}:{port}"
+    print(f"Serving on {address} with {n_workers} warm workers (ready in {time.perf_counter() - start:.1f}s)",
+          flush=True)
+
+    loop = asyncio.get_running_loop()
+    for signal_number in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signal_number, service.stopped.set)
+    async with server:
+        await service.stopped.wait()
+    await service.close()
+    if unix and os.path.exists(unix):
+        os.remove(unix)
+    if service.error:
+        raise SystemExit(service.error)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve the JPEG and edge codecs over HTTP")
+    parser.add_argument("--host", default="127.0.0.1", help="Address to listen on (default: 127.0.0.1).")
+    parser.add_argument("--port", type=int, default=8080, help="TCP port to listen on (default: 8080).")
+    parser.add_argument("--unix", default=None, help="Listen on this Unix socket instead of a TCP port.")
+    parser.add_argument("--workers", type=int, default=None, help="Number of worker processes (default: all cores).")
+    parser.add_argument("--queue", type=int, default=64,
+                        help="Requests that may wait for a worker before the service answers 503 (default: 64).")
+    parser.add_argument("--max-body", type=int, default=MAX_BODY, help="Largest request body in bytes.")
+    args = parser.parse_args()
+    asyncio.run(serve(args.host, args.port, args.unix, args.workers, args.queue, args.max_body))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,306 @@
+"""
+Streaming JPEG encoder and decoder whose memory use is proportional to the image width rather than its area.
+
+The encoder reads the image in stripes of 8 rows (16 rows for colour images whose chrominance is subsampled
+vertically, as in 4:2:0) and pushes each stripe through the DCT, quantization and run-length encoding. The first pass only counts a histogram of the
+run-length symbols, spilling them to temporary files as compact int16 chunks unless asked not to. The Huffman tables are
+then built from the histograms, and the second pass entropy codes the symbols chunk by chunk straight into the output
+file, reading them back from the spill files or regenerating them from the image. The output is the same container
+jpeg_decompress reads. The decoder mirrors this, decoding one block row at a time into a memory-mapped output.
+
+Sources and outputs are memory-mapped when they are .npy or binary .pgm/.ppm files. Other image formats are decoded
+with OpenCV, which loads the whole image.
+"""
+import os
+import tempfile
+from itertools import islice
+
+import numpy as np
+from bitarray import bitarray
+
+from blocks import BLOCK_SIZE, dct_blocks, get_padded_shape, inverse_transform, quantize_blocks
+from codec import (accumulate_dc, decode_runlength, read_image, runlength_encode_blocks, split_ycbcr, upsample_channel,
+                   ycbcr_to_rgb)
+from jfif import SAMPLING_FACTORS
+from container import iter_decode, pack_file_header, pack_plane_header, read_container
+from huffman import SymbolHistogram, encode_huffman_chunks
+
+SPILL_CHUNK = 1 << 20  # Number of spilled symbols entropy coded per step
+DECODE_CHUNK = 1 << 16  # Number of symbols decoded per step
+
+
+def read_netpbm_header(f):
+    """
+    Reads the header of a binary PGM (P5) or PPM (P6) file and returns (magic, height, width, offset of the pixel data)
+    """
+    fields = []
+    while len(fields) < 4:
+        line = f.readline()
+        if not line:
+            raise ValueError("Truncated PGM/PPM header.")
+        fields += line.split(b"#")[0].split()
+    magic, width, height, maxval = fields[0], int(fields[1]), int(fields[2]), int(fields[3])
+    if magic not in (b"P5", b"P6") or maxval > 255:
+        raise ValueError("Only 8-bit binary PGM (P5) and PPM (P6) files can be memory-mapped.")
+    return magic, height, width, f.tell()
+
+
+def open_image_source(image_path, colour=False):
+    """
+    Returns the image at the given path as an array whose row slices are read on demand: a memory map for .npy and
+    binary .pgm/.ppm files, or the fully decoded image for any other format. Colour images are in RGB order.
+    """
+    extension = os.path.splitext(image_path)[1].lower()
+    if extension == ".npy":
+        source = np.load(image_path, mmap_mode="r")
+    elif extension in (".pgm", ".ppm"):
+        with open(image_path, "rb") as f:
+            magic, height, width, offset = read_netpbm_header(f)
+        shape = (height, width, 3) if magic == b"P6" else (height, width)
+        source = np.memmap(image_path, dtype=np.uint8, mode="r", offset=offset, shape=shape)
+    else:
+        source = read_image(image_path, colour)
+
+    if source.ndim != (3 if colour else 2):
+        raise ValueError(f"Expected a {'colour' if colour else 'grayscale'} image, got shape {source.shape}.")
+    return source
+
+
+def create_image_output(output_path, shape):
+    """
+    Creates an uint8 image file of the given shape at the given path (.npy, .pgm or .ppm) and returns it memory-mapped
+    for writing
+    """
+    extension = os.path.splitext(output_path)[1].lower()
+    if extension == ".npy":
+        return np.lib.format.open_memmap(output_path, mode="w+", dtype=np.uint8, shape=shape)
+    if extension in (".pgm", ".ppm"):
+        header = b"%s\n%d %d\n255\n" % (b"P6" if len(shape) == 3 else b"P5", shape[1], shape[0])
+        with open(output_path, "wb") as f:
+            f.write(header)
+            f.truncate(len(header) + int(np.prod(shape)))
+        return np.memmap(output_path, dtype=np.uint8, mode="r+", offset=len(header), shape=shape)
+    raise ValueError("Streaming output must be a .npy, .pgm or .ppm file.")
+
+
+def get_plane_dims(original_dims, colour, subsampling="4:2:0"):
+    """
+    Returns the dimensions of the planes coded for an image: Y alone, or Y followed by Cb and Cr subsampled by the
+    factors of the given chroma subsampling mode
+    """
+    if not colour:
+        return [original_dims]
+    horizontal, vertical = SAMPLING_FACTORS[subsampling]
+    chroma_dims = (-(-original_dims[0] // vertical), -(-original_dims[1] // horizontal))
+    return [original_dims, chroma_dims, chroma_dims]
+
+
+def get_stripe_rows(colour, subsampling="4:2:0"):
+    """
+    Returns the number of image rows in a stripe: one row of luma blocks, or as many as cover one row of chrominance
+    blocks when the chrominance is subsampled vertically
+    """
+    return BLOCK_SIZE * SAMPLING_FACTORS[subsampling][1] if colour else BLOCK_SIZE
+
+
+def stripe_planes(rows, colour, subsampling="4:2:0"):
+    """
+    Takes as argument a stripe of image rows and returns the stripe of every plane, exactly as the whole-image encoder
+    would see it: colour stripes are converted to YCbCr and their chrominance is subsampled. Stripes have a multiple
+    of the vertical subsampling factor as number of rows, so no block of averaged chrominance pixels straddles two
+    stripes.
+    """
+    if not colour:
+        return [rows]
+    return list(split_ycbcr(rows, subsampling))
+
+
+def encode_stripe(plane_stripe, Q):
+    """
+    Transforms, quantizes and run-length encodes the blocks of a plane stripe and returns its symbols as an int16 array
+    """
+    dct_coeff, padded_shape = dct_blocks(plane_stripe)
+    return runlength_encode_blocks(quantize_blocks(dct_coeff, Q))
+
+
+def iter_stripe_symbols(source, Q, colour=False, subsampling="4:2:0"):
+    """
+    Yields, for every stripe of the source image, the list of the run-length symbols of each of its planes
+    """
+    stripe_rows = get_stripe_rows(colour, subsampling)
+    for row in range(0, source.shape[0], stripe_rows):
+        rows = np.asarray(source[row:row + stripe_rows])
+        yield [encode_stripe(plane_stripe, Q) for plane_stripe in stripe_planes(rows, colour, subsampling)]
+
+
+def iter_spill(spill):
+    """
+    Yields the symbols spilled to a file in chunks of SPILL_CHUNK
+    """
+    spill.seek(0)
+    while True:
+        symbols = np.fromfile(spill, dtype="<i2", count=SPILL_CHUNK)
+        if len(symbols) == 0:
+            return
+        yield symbols
+
+
+def stream_compress(image_path, Q, compressed_file, colour=False, spill=True, spill_dir=None, subsampling="4:2:0"):
+    """
+    Takes as argument the path to original image, quality factor and the path to a .bin file and compresses the image
+    stripe by stripe into the .bin file, with memory use proportional to the image width. Colour images have their
+    chrominance subsampled by the given mode ("4:4:4", "4:2:2" or "4:2:0"), as jpeg_compress does.
+    If spill is set, the symbols of the first pass go to a temporary folder inside spill_dir (the system default if not
+    given) and are read back for the second pass. Otherwise the second pass transforms the image again, which needs no
+    disk space but costs a second pass over the image per plane.
+    """
+    if subsampling not in SAMPLING_FACTORS:
+        raise ValueError(f"Unknown chroma subsampling mode {subsampling!r}, expected one of "
+                         f"{', '.join(SAMPLING_FACTORS)}.")
+    source = open_image_source(image_path, colour)
+    original_dims = source.shape[:2]
+    plane_dims = get_plane_dims(original_dims, colour, subsampling)
+
+    with tempfile.TemporaryDirectory(dir=spill_dir) as spill_folder:
+        spills = [open(os.path.join(spill_folder, f"plane{i}.int16"), "w+b") if spill else None
+                  for i in range(len(plane_dims))]
+        histograms = [SymbolHistogram() for _ in plane_dims]
+
+        # First pass: transform every stripe and count its symbols, spilling them if asked to
+        for stripe_symbols in iter_stripe_symbols(source, Q, colour, subsampling):
+            for symbols, spill_file, histogram in zip(stripe_symbols, spills, histograms):
+                histogram.update(symbols)
+                if spill_file:
+                    symbols.astype("<i2").tofile(spill_file)
+
+        # Second pass: build each table from its histogram and entropy code the symbols into the container
+        with open(compressed_file, "wb") as f:
+            f.write(pack_file_header(len(plane_dims), Q, original_dims, subsampling if colour else "4:4:4"))
+            for i, (dims, spill_file, histogram) in enumerate(zip(plane_dims, spills, histograms)):
+                huffman_dict = histogram.huffman_tree().traverse()
+                if spill_file:
+                    chunks = iter_spill(spill_file)
+                else:
+                    chunks = (stripe_symbols[i]
+                              for stripe_symbols in iter_stripe_symbols(source, Q, colour, subsampling))
+
+                header_offset = f.tell()
+                f.write(pack_plane_header(huffman_dict, dims, 0))
+                n_bits = encode_huffman_chunks(chunks, huffman_dict, f.write)
+
+                # The payload length is only known now, so fill it in
+                f.seek(header_offset)
+                f.write(pack_plane_header(huffman_dict, dims, n_bits))
+                f.seek(0, os.SEEK_END)
+
+        for spill_file in spills:
+            if spill_file:
+                spill_file.close()
+
+
+def iter_symbols(plane):
+    """
+    Yields the Huffman-decoded symbols of a plane straight from its payload, without copying it
+    """
+    try:
+        yield from iter_decode(plane, bitarray(buffer=plane.payload))
+    except ValueError:
+        # The zero padding of the last byte ends in an incomplete code. The block rows only ever consume the real
+        # symbols, so anything decoded from the padding is ignored.
+        return
+
+
+def iter_block_rows(plane, Q):
+    """
+    Decodes a plane one row of 8x8 blocks at a time and yields each as a (8, padded width) image stripe
+    """
+    padded_width = get_padded_shape((plane.height, plane.width))[1]
+    n_coefficients = padded_width // BLOCK_SIZE * BLOCK_SIZE * BLOCK_SIZE
+    n_block_rows = get_padded_shape((plane.height, plane.width))[0] // BLOCK_SIZE
+
+    symbols = iter_symbols(plane)
+    exhausted = False
+    carry = np.empty(0, dtype=np.int64)  # A trailing zero-run marker whose count is in the next chunk
+    coefficients = np.empty(0, dtype=np.int64)
+    previous_dc = 0  # Planes coded with built-in tables code DC as differences, running on from row to row
+    for _ in range(n_block_rows):
+        while len(coefficients) < n_coefficients and not exhausted:
+            decoded = np.fromiter(islice(symbols, DECODE_CHUNK), dtype=np.int64)
+            exhausted = len(decoded) < DECODE_CHUNK
+            chunk = np.concatenate([carry, decoded])
+            if exhausted:
+                # The real stream never ends on a marker, so trailing zeros can only come from the padding
+                chunk = np.trim_zeros(chunk, "b")
+                carry = chunk[:0]
+            else:
+                # Run counts are never zero, so a zero symbol is always a marker followed by its count
+                cut = len(chunk) - 1 if chunk[-1] == 0 else len(chunk)
+                chunk, carry = chunk[:cut], chunk[cut:]
+            coefficients = np.concatenate([coefficients, decode_runlength(chunk)])
+
+        if len(coefficients) < n_coefficients:
+            raise ValueError("Compressed plane ends before all of its blocks were decoded.")
+        ordered_blocks = coefficients[:n_coefficients].reshape(-1, BLOCK_SIZE * BLOCK_SIZE)
+        coefficients = coefficients[n_coefficients:]
+        if plane.table is not None:
+            ordered_blocks[0, 0] += previous_dc
+            previous_dc = accumulate_dc(ordered_blocks)[-1, 0]
+        yield inverse_transform(ordered_blocks, (BLOCK_SIZE, padded_width), Q)
+
+
+def iter_upsampled_rows(block_rows, chroma_dims, factors):
+    """
+    Takes as argument an iterator over the block rows of a chrominance plane, as yielded by iter_block_rows, the
+    dimensions of the plane and its (vertical, horizontal) subsampling factors, and yields every block row upsampled
+    by these factors, exactly as upsample_channel upsamples the whole plane. When the plane is subsampled vertically,
+    the interpolation reaches one row into the neighbouring block rows, so every block row is upsampled along with
+    the last row of the one before and the first row of the one after, repeating the edge rows of the plane as
+    upsample_channel does.
+    """
+    height, width = chroma_dims
+    vertical, horizontal = factors
+    upcoming = next(block_rows)[:, :width]
+    above = upcoming[:1]
+    for row in range(0, height, BLOCK_SIZE):
+        current = upcoming[:height - row]
+        upcoming = next(block_rows)[:, :width] if row + BLOCK_SIZE < height else current[-1:]
+        window = np.concatenate([above, current, upcoming[:1]])
+        yield upsample_channel(window, (vertical * len(window), horizontal * width))[vertical:-vertical]
+        above = current[-1:]
+
+
+def stream_decompress(compressed_file, output_path):
+    """
+    Takes as argument the path to a .bin of compressed image and the path of the output image (.npy, .pgm or .ppm)
+    and decompresses the image into it one stripe at a time. Colour chrominance is upsampled by the subsampling mode
+    of the container with the same interpolation as jpeg_decompress, which only needs one more row of chrominance on
+    either side of the stripe.
+    """
+    header, planes = read_container(compressed_file)
+    if header.bands is not None or header.tile_size is not None:
+        raise ValueError("Progressive and tiled containers cannot be decoded stripe by stripe, use jpeg_decompress "
+                         "instead.")
+    height, width = header.height, header.width
+
+    if header.channels == 1:
+        output = create_image_output(output_path, (height, width))
+        for row, stripe in zip(range(0, height, BLOCK_SIZE), iter_block_rows(planes[0], header.Q)):
+            rows = min(BLOCK_SIZE, height - row)
+            output[row:row + rows] = np.clip(stripe[:rows, :width], 0, 255).astype(np.uint8)
+        output.flush()
+        return
+
+    horizontal, vertical = SAMPLING_FACTORS[header.subsampling]
+    output = create_image_output(output_path, (height, width, 3))
+    luma = iter_block_rows(planes[0], header.Q)
+    blue, red = (iter_upsampled_rows(iter_block_rows(plane, header.Q), (plane.height, plane.width),
+                                     (vertical, horizontal))
+                 for plane in planes[1:])
+    stripe_rows = get_stripe_rows(True, header.subsampling)
+    for row in range(0, height, stripe_rows):
+        rows = min(stripe_rows, height - row)
+        # One row of luma blocks per vertical subsampling step covers one row of chrominance blocks
+        Y = np.concatenate([next(luma) for _ in range((rows + BLOCK_SIZE - 1) // BLOCK_SIZE)])
+        Cb, Cr = next(blue), next(red)
+        output[row:row + rows] = ycbcr_to_rgb(Y[:rows, :width], Cb[:rows, :width], Cr[:rows, :width])
+    output.flush()